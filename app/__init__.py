@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 import time
@@ -13,9 +14,10 @@ from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_
 
 from app.auth.router import router as auth_router
 from app.config import configure_logging, load_config
+from app.db import engine
 from app.scheduler import init_scheduler
-from app.services.inbound_queue import spawn_workers, stop_workers
-from app.utils.realtime import start_metrics_push_task, websocket_router
+from app.services.inbound_queue import INBOUND_QUEUE_IN_PROCESS_WORKERS, spawn_workers, stop_workers
+from app.utils.realtime import broadcast_relay_listener, start_metrics_push_task, websocket_router
 from app.views import router as webhook_router
 
 # Define metrics at module level to prevent duplicate registration
@@ -36,24 +38,34 @@ def create_app() -> FastAPI:
         init_models()
         logging.info(f"startup: initializing scheduler in pid {pid}")
         init_scheduler(app)
-        # Start inbound queue workers (configurable via env, default few workers for low memory)
+        # Start inbound queue workers (configurable via env, default few workers for low memory).
+        # With INBOUND_QUEUE_ENABLED these are the only consumers of /webhook messages, unless
+        # INBOUND_QUEUE_IN_PROCESS_WORKERS=false hands the queue to standalone `python -m app.worker` processes.
         try:
             num_workers = int(os.environ.get("INBOUND_QUEUE_WORKERS", "2"))
         except Exception:
             num_workers = 2
-        stop_event, tasks = spawn_workers(max(1, num_workers))
+        if INBOUND_QUEUE_IN_PROCESS_WORKERS:
+            stop_event, tasks = spawn_workers(max(1, num_workers))
+        else:
+            logging.info(f"startup: in-process inbound queue workers disabled in pid {pid}")
+            stop_event, tasks = asyncio.Event(), []
+        # Relay realtime events raised by standalone worker processes to this process's clients
+        if engine.dialect.name == "postgresql":
+            tasks.append(asyncio.create_task(broadcast_relay_listener(stop_event)))
         app.state.inbound_queue_stop_event = stop_event
         app.state.inbound_queue_tasks = tasks
         yield
+        # Stop inbound queue workers first so in-flight items stop using the HTTP clients
+        with suppress(Exception):
+            await stop_workers(app.state.inbound_queue_stop_event, app.state.inbound_queue_tasks)
         # Shutdown: close HTTP clients
         logging.info("shutdown: closing HTTP clients")
-        from app.utils.http_client import async_client, sync_client
+        from app.utils.http_client import async_client, async_llm_client, sync_client
 
         await async_client.aclose()
+        await async_llm_client.aclose()
         sync_client.close()
-        # Stop inbound queue workers
-        with suppress(Exception):
-            await stop_workers(app.state.inbound_queue_stop_event, app.state.inbound_queue_tasks)
 
     app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
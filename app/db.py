@@ -145,6 +145,37 @@ class ConversationModel(Base):
     )
 
 
+class ConversationSummaryModel(Base):
+    """Rolling LLM summary of the conversation history that no longer fits the context window."""
+
+    __tablename__ = "conversation_summaries"
+
+    wa_id: Mapped[str] = mapped_column(String, primary_key=True)
+    summary: Mapped[str] = mapped_column(Text, nullable=False)
+    # Highest conversation.id folded into the summary
+    covered_until_id: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime, server_default=func.current_timestamp(), onupdate=func.current_timestamp()
+    )
+
+
+class ResponseChainModel(Base):
+    """Last stored OpenAI response of a conversation, continued with previous_response_id on the next turn."""
+
+    __tablename__ = "llm_response_chains"
+
+    wa_id: Mapped[str] = mapped_column(String, primary_key=True)
+    response_id: Mapped[str] = mapped_column(String, nullable=False)
+    # Highest conversation.id the response has seen as input
+    anchor_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    # Input tokens of the response: the size of the server-side history the next turn builds on
+    input_tokens: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # Text the response answered with; its stored copy is the one assistant row the next turn leaves out
+    reply: Mapped[str | None] = mapped_column(Text, nullable=True)
+    # UTC; the chain is abandoned once it is older than the provider keeps stored responses
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
 class ReservationModel(Base):
     __tablename__ = "reservations"
 
@@ -227,6 +258,10 @@ class InboundMessageQueueModel(Base):
     )
     # When claimed by a worker
     locked_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True, index=True)
+    # Earliest time a failed item may be retried (exponential backoff); NULL means immediately
+    next_attempt_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    # Last processing error, kept for dead-lettered (failed) items
+    last_error: Mapped[str | None] = mapped_column(Text, nullable=True)
 
     __table_args__ = (
         # De-duplication for known message ids (skip NULLs to allow inserts when unknown)
@@ -239,6 +274,17 @@ class InboundMessageQueueModel(Base):
         if "postgresql" in str(engine.url)
         else Index("idx_inbound_message_queue_message_id", "message_id"),
         Index("idx_inbound_queue_status_created", "status", "created_at"),
+        # Per-conversation claim checks (busy/earlier pending row for the same wa_id)
+        Index("idx_inbound_queue_wa_id_status_id", "wa_id", "status", "id"),
+        # Claim scans only touch live rows, however many done rows accumulate
+        Index(
+            "idx_inbound_queue_pending_claim",
+            "created_at",
+            "id",
+            "next_attempt_at",
+            postgresql_where=text("status = 'pending'"),
+        ),
+        Index("idx_inbound_queue_processing_locked", "locked_at", postgresql_where=text("status = 'processing'")),
     )
 
 
@@ -275,6 +321,32 @@ def init_models() -> None:
                 conn.exec_driver_sql(
                     "CREATE UNIQUE INDEX IF NOT EXISTS uq_inbound_message_queue_message_id_not_null ON inbound_message_queue (message_id) WHERE message_id IS NOT NULL;"
                 )
+            with contextlib.suppress(Exception):
+                conn.exec_driver_sql(
+                    "CREATE INDEX IF NOT EXISTS idx_inbound_queue_wa_id_status_id ON inbound_message_queue (wa_id, status, id);"
+                )
+            conn.exec_driver_sql(
+                "ALTER TABLE IF EXISTS inbound_message_queue ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP;"
+            )
+            conn.exec_driver_sql(
+                "ALTER TABLE IF EXISTS inbound_message_queue ADD COLUMN IF NOT EXISTS last_error TEXT;"
+            )
+            with contextlib.suppress(Exception):
+                conn.exec_driver_sql(
+                    "CREATE INDEX IF NOT EXISTS idx_inbound_queue_pending_claim ON inbound_message_queue (created_at, id, next_attempt_at) WHERE status = 'pending';"
+                )
+            with contextlib.suppress(Exception):
+                conn.exec_driver_sql(
+                    "CREATE INDEX IF NOT EXISTS idx_inbound_queue_processing_locked ON inbound_message_queue (locked_at) WHERE status = 'processing';"
+                )
+            # Dead-letter view: items that exhausted their processing attempts
+            with contextlib.suppress(Exception):
+                conn.exec_driver_sql(
+                    "CREATE OR REPLACE VIEW inbound_message_dead_letters AS "
+                    "SELECT id, message_id, wa_id, attempts, last_error, created_at, updated_at "
+                    "FROM inbound_message_queue WHERE status = 'failed';"
+                )
+            conn.exec_driver_sql("ALTER TABLE IF EXISTS llm_response_chains ADD COLUMN IF NOT EXISTS reply TEXT;")
             conn.exec_driver_sql("ALTER TABLE IF EXISTS customers ADD COLUMN IF NOT EXISTS age INTEGER;")
             conn.exec_driver_sql("ALTER TABLE IF EXISTS customers ADD COLUMN IF NOT EXISTS age_recorded_at DATE;")
             conn.exec_driver_sql(
@@ -337,6 +409,11 @@ def get_session() -> Session:
     return SessionLocal()
 
 
+def psycopg_conninfo() -> str:
+    """Return the database URL as a plain libpq URL for direct psycopg connections (e.g. LISTEN)."""
+    return engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+
+
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
     """Yield an AsyncSession for async database operations.
 
@@ -1 +1,4 @@
+from .safety import RetryLaterError as RetryLaterError
+from .safety import ToolCallsRanError as ToolCallsRanError
+from .safety import retry_deadline as retry_deadline
 from .safety import retry_decorator as retry_decorator
@@ -1,20 +1,121 @@
+import contextlib
+import contextvars
+import datetime
+import email.utils
 import functools
+import inspect
 import logging
+import os
+import random
 import time
 import traceback
+from collections.abc import Iterator
 
 import httpx
 import openai
 from anthropic import AnthropicError, APIConnectionError, APIError, APIStatusError, RateLimitError
 from openai import APITimeoutError
-from tenacity import retry, retry_if_exception_type, stop_after_delay, wait_exponential
+from tenacity import RetryError, retry, retry_if_exception_type
 
-from app.metrics import RETRY_ATTEMPTS, RETRY_EXHAUSTED, RETRY_LAST_TIMESTAMP
+from app.metrics import RETRY_ATTEMPTS, RETRY_DEFERRED, RETRY_EXHAUSTED, RETRY_LAST_TIMESTAMP
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+
+# In-process retries stay short: past this budget the caller gets RetryLaterError and reschedules durably
+LLM_RETRY_BUDGET_SECONDS = _env_float("LLM_RETRY_BUDGET_SECONDS", 60)
+LLM_RETRY_MAX_ATTEMPTS = max(int(_env_float("LLM_RETRY_MAX_ATTEMPTS", 5)), 1)
+LLM_RETRY_BACKOFF_BASE_SECONDS = _env_float("LLM_RETRY_BACKOFF_BASE_SECONDS", 1)
+LLM_RETRY_BACKOFF_MAX_SECONDS = _env_float("LLM_RETRY_BACKOFF_MAX_SECONDS", 8)
+
+# Absolute time.monotonic() deadline of the request being served (e.g. the customer's reply deadline)
+_retry_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("retry_deadline", default=None)
+
+
+class RetryLaterError(Exception):
+    """Transient failures outlasted the in-process retry budget; ``retry_after`` is the provider's hint, if any.
+
+    Raised instead of sleeping for minutes while a thread, a conversation lock and the typing indicator are
+    held, so the caller can hand the work back to the durable queue.
+    """
+
+    def __init__(self, retry_after: float | None, attempts: int) -> None:
+        hint = f"retry after {retry_after:.1f}s" if retry_after is not None else "retry later"
+        super().__init__(f"{hint} ({attempts} attempts)")
+        self.retry_after = retry_after
+        self.attempts = attempts
+
+
+class ToolCallsRanError(Exception):
+    """A turn failed after it ran tools; running it again, now or later, could book or cancel twice."""
+
+
+@contextlib.contextmanager
+def retry_deadline(seconds: float) -> Iterator[None]:
+    """Bound the in-process retries of everything called in this context to ``seconds`` from now."""
+    deadline = time.monotonic() + max(0.0, seconds)
+    current = _retry_deadline.get()
+    token = _retry_deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _retry_deadline.reset(token)
+
+
+def retry_after_seconds(exc: BaseException | None) -> float | None:
+    """Seconds requested by the provider's ``retry-after-ms``/``Retry-After`` response headers, if any."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        value = headers.get("retry-after-ms")
+        if value:
+            return max(0.0, float(value) / 1000)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            when = email.utils.parsedate_to_datetime(value)
+            return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except Exception:
+        return None
+
+
+def _backoff_seconds(retry_state) -> float:
+    """Full-jitter exponential backoff capped at seconds, never shorter than the provider's Retry-After."""
+    ceiling = min(
+        LLM_RETRY_BACKOFF_MAX_SECONDS, LLM_RETRY_BACKOFF_BASE_SECONDS * 2 ** max(0, retry_state.attempt_number - 1)
+    )
+    backoff = random.uniform(0, ceiling)
+    requested = retry_after_seconds(retry_state.outcome.exception())
+    return max(backoff, requested or 0.0)
+
+
+def _deadline_reached(retry_state) -> bool:
+    if retry_state.attempt_number >= LLM_RETRY_MAX_ATTEMPTS:
+        return True
+    deadline = retry_state.start_time + LLM_RETRY_BUDGET_SECONDS
+    context_deadline = _retry_deadline.get()
+    if context_deadline is not None:
+        deadline = min(deadline, context_deadline)
+    # Stop now rather than sleep past the deadline; the upcoming sleep was computed just before
+    return time.monotonic() + retry_state.upcoming_sleep > deadline
 
 
 def retry_decorator(func):
     """
     A modular retry decorator to handle retries for API calls.
+
+    Transient provider errors are retried in-process with jittered backoff capped at a few seconds, honouring
+    ``Retry-After``, until LLM_RETRY_BUDGET_SECONDS or the caller's ``retry_deadline`` runs out. Then
+    RetryLaterError tells the caller when to try again instead of blocking for hours.
     """
 
     def _record_retry(retry_state):
@@ -26,8 +127,8 @@ def retry_decorator(func):
 
     # The retry function from tenacity
     retry_func = retry(
-        wait=wait_exponential(multiplier=3, min=10, max=3600),
-        stop=stop_after_delay(10800),  # Stop retrying after ~3 hours total delay
+        wait=_backoff_seconds,
+        stop=_deadline_reached,
         retry=retry_if_exception_type(
             (
                 httpx.ConnectError,
@@ -48,25 +149,52 @@ def retry_decorator(func):
         after=_record_retry,
     )(func)
 
+    def _retry_later(e: RetryError) -> RetryLaterError:
+        last_error = e.last_attempt.exception()
+        attempts = e.last_attempt.attempt_number
+        logging.warning(f"Retry budget of {func.__name__} spent after {attempts} attempts: {last_error}")
+        RETRY_DEFERRED.labels(function=func.__name__, exception_type=type(last_error).__name__).inc()
+        return RetryLaterError(retry_after_seconds(last_error), attempts)
+
+    def _record_exhausted(e):
+        # Log detailed error after all retries are exhausted
+        logging.error(f"ALL RETRIES EXHAUSTED for {func.__name__}: {e}")
+        logging.error("=============== RETRY FAILURE DETAILS ===============")
+        logging.error(traceback.format_exc())
+        logging.error("====================================================")
+        # Increment metric for exhausted retries with function and exception type labels
+        try:
+            exception_name = type(e).__name__
+        except Exception:
+            exception_name = "Unknown"
+        try:
+            RETRY_EXHAUSTED.labels(function=func.__name__, exception_type=exception_name).inc()
+        except Exception:
+            pass
+
+    if inspect.iscoroutinefunction(func):
+        # tenacity wraps coroutine functions with AsyncRetrying, sleeping via asyncio between attempts
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                return await retry_func(*args, **kwargs)
+            except RetryError as e:
+                raise _retry_later(e) from e.last_attempt.exception()
+            except Exception as e:
+                _record_exhausted(e)
+                # Re-raise the exception so it can be handled by the caller
+                raise
+
+        return async_wrapper
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         try:
             return retry_func(*args, **kwargs)
+        except RetryError as e:
+            raise _retry_later(e) from e.last_attempt.exception()
         except Exception as e:
-            # Log detailed error after all retries are exhausted
-            logging.error(f"ALL RETRIES EXHAUSTED for {func.__name__}: {e}")
-            logging.error("=============== RETRY FAILURE DETAILS ===============")
-            logging.error(traceback.format_exc())
-            logging.error("====================================================")
-            # Increment metric for exhausted retries with function and exception type labels
-            try:
-                exception_name = type(e).__name__
-            except Exception:
-                exception_name = "Unknown"
-            try:
-                RETRY_EXHAUSTED.labels(function=func.__name__, exception_type=exception_name).inc()
-            except Exception:
-                pass
+            _record_exhausted(e)
             # Re-raise the exception so it can be handled by the caller
             raise
 
@@ -7,21 +7,23 @@ from fastapi import HTTPException, Request
 from app.config import config
 
 
-def validate_signature(payload: str, signature: str) -> bool:
+def validate_signature(payload: str | bytes, signature: str) -> bool:
     """
     Validate the incoming payload's signature against our expected signature.
+    Raw request bytes are hashed as-is; str payloads are UTF-8 encoded first.
     """
     expected_signature = hmac.new(
         bytes(config["APP_SECRET"], "latin-1"),
-        msg=payload.encode("utf-8"),
+        msg=payload if isinstance(payload, bytes) else payload.encode("utf-8"),
         digestmod=hashlib.sha256,
     ).hexdigest()
     return hmac.compare_digest(expected_signature, signature)
 
 
-async def verify_signature(request: Request):
+async def verify_signature(request: Request) -> bytes:
     """
     Dependency for FastAPI to ensure that incoming requests are signed correctly.
+    Returns the raw request body so handlers can parse it without reading or decoding it again.
     """
     signature_header = request.headers.get("X-Hub-Signature-256", "")
     if not signature_header.startswith("sha256="):
@@ -29,7 +31,7 @@ async def verify_signature(request: Request):
         raise HTTPException(status_code=403, detail="Invalid signature")
     signature = signature_header[7:]  # Remove 'sha256='
     body = await request.body()
-    payload = body.decode("utf-8")
-    if not validate_signature(payload, signature):
+    if not validate_signature(body, signature):
         logging.info("Signature verification failed!")
         raise HTTPException(status_code=403, detail="Invalid signature")
+    return body
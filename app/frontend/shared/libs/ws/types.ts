@@ -5,6 +5,7 @@ import type { UpdateType as BaseUpdateType } from '@/shared/libs/realtime-utils'
 export type UpdateType =
 	| BaseUpdateType
 	| 'conversation_typing'
+	| 'conversation_stream'
 	| 'typing_ack'
 	| 'typing_nack'
 	| 'vacation_update_ack'
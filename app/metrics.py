@@ -1,5 +1,5 @@
 import psutil
-from prometheus_client import Counter, Gauge
+from prometheus_client import Counter, Gauge, Histogram
 
 
 def monitor_system_metrics() -> None:
@@ -52,6 +52,11 @@ RETRY_EXHAUSTED = Counter(
     "api_retry_exhausted_total", "Number of times retries were exhausted", ["function", "exception_type"]
 )
 
+# In-process retry budget spent: the caller was asked to retry later (e.g. via the inbound queue)
+RETRY_DEFERRED = Counter(
+    "api_retry_deferred_total", "Number of times the in-process retry budget ran out", ["function", "exception_type"]
+)
+
 # Gauge to record the timestamp (seconds since epoch) of the most recent retry per exception type
 RETRY_LAST_TIMESTAMP = Gauge(
     "api_retry_last_timestamp_seconds", "Unix timestamp of last retry attempt", ["exception_type"]
@@ -166,6 +171,20 @@ INBOUND_QUEUE_CLAIMED = Counter("inbound_queue_claimed_total", "Total queue item
 
 INBOUND_QUEUE_PROCESSED = Counter("inbound_queue_processed_total", "Total inbound queue items processed successfully")
 
+INBOUND_QUEUE_COALESCED = Counter(
+    "inbound_queue_coalesced_total",
+    "Inbound messages folded into the LLM turn of an earlier message from the same customer",
+)
+
+INBOUND_QUEUE_DEAD_LETTERED = Counter(
+    "inbound_queue_dead_lettered_total", "Inbound queue items marked failed after exhausting their attempts"
+)
+
+INBOUND_QUEUE_REPLIES_DEFERRED = Counter(
+    "inbound_queue_replies_deferred_total",
+    "LLM replies handed back to the queue with a scheduled retry after the in-process retry budget ran out",
+)
+
 INBOUND_QUEUE_PROCESSING_ERRORS = Counter(
     "inbound_queue_processing_errors_total", "Total inbound queue items that failed during processing"
 )
@@ -179,3 +198,110 @@ INBOUND_QUEUE_LENGTH = Gauge("inbound_queue_length", "Current number of pending
 INBOUND_QUEUE_OLDEST_AGE_SECONDS = Gauge(
     "inbound_queue_oldest_age_seconds", "Age in seconds of the oldest pending inbound queue item"
 )
+
+INBOUND_QUEUE_LISTENER_CONNECTED = Gauge(
+    "inbound_queue_listener_connected", "Whether the inbound queue LISTEN/NOTIFY connection is up (1) or not (0)"
+)
+
+CONVERSATION_LOCKS_LIVE = Gauge("conversation_locks_live", "Per-wa_id conversation locks currently held or awaited")
+
+CONVERSATION_LOCK_WAITERS = Gauge(
+    "conversation_lock_waiters", "Coroutines currently waiting to acquire a per-wa_id conversation lock"
+)
+
+CONVERSATION_LOCK_WAIT_SECONDS = Histogram(
+    "conversation_lock_wait_seconds",
+    "Time spent waiting to acquire a per-wa_id conversation lock",
+    buckets=(0.001, 0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+
+LLM_CONTEXT_CACHE_LOOKUPS = Counter(
+    "llm_context_cache_lookups_total",
+    "LLM context history lookups by outcome (hit, delta, stale, miss)",
+    ["result"],
+)
+
+LLM_CONTEXT_SUMMARY_REFRESHES = Counter(
+    "llm_context_summary_refreshes_total",
+    "Background rolling-summary refreshes by outcome (ok, skipped, empty, error)",
+    ["result"],
+)
+
+LLM_GOVERNOR_WAIT_SECONDS = Histogram(
+    "llm_governor_wait_seconds",
+    "Time LLM requests queued in the rate governor before being sent, by provider and priority",
+    ["provider", "priority"],
+    buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+
+LLM_GOVERNOR_IN_FLIGHT = Gauge("llm_governor_in_flight", "LLM requests currently admitted", ["provider", "model"])
+
+LLM_GOVERNOR_QUEUED = Gauge("llm_governor_queued", "LLM requests waiting for admission", ["provider", "model"])
+
+LLM_ANSWER_CACHE_LOOKUPS = Counter(
+    "llm_answer_cache_lookups_total",
+    "Answer cache lookups of conversation-opening questions (hit, miss, uncacheable)",
+    ["result"],
+)
+
+LLM_ANSWER_CACHE_INVALIDATIONS = Counter(
+    "llm_answer_cache_invalidations_total", "Answer cache clears by reason (config, vacations)", ["reason"]
+)
+
+OPENAI_RESPONSE_CHAIN_TURNS = Counter(
+    "openai_response_chain_turns_total",
+    "OpenAI turns by input mode (chained on previous_response_id, full history, broken chain retried in full)",
+    ["mode"],
+)
+
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "LLM tokens by provider, model and kind (input, output, cache_read, cache_write)",
+    ["provider", "model", "kind"],
+)
+
+LLM_API_CALL_SECONDS = Histogram(
+    "llm_api_call_seconds",
+    "Duration of single LLM API round trips by provider, model and outcome (ok, error)",
+    ["provider", "model", "outcome"],
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120),
+)
+
+LLM_TOOL_SECONDS = Histogram(
+    "llm_tool_seconds",
+    "Duration of LLM tool executions by tool name",
+    ["tool"],
+    buckets=(0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+LLM_TURN_ROUND_TRIPS = Histogram(
+    "llm_turn_round_trips",
+    "Model round trips per LLM turn (1 = answered without tools)",
+    ["provider"],
+    buckets=(1, 2, 3, 4, 6, 8, 10, 15),
+)
+
+LLM_TURN_SECONDS = Histogram(
+    "llm_turn_seconds",
+    "Total latency of an LLM turn (retries, failover and tool calls included) by provider and outcome",
+    ["provider", "outcome"],
+    buckets=(0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300),
+)
+
+LLM_PROVIDER_ATTEMPTS = Counter(
+    "llm_provider_attempts_total",
+    "Routed LLM turn attempts by provider and outcome (ok, error, timeout, cancelled)",
+    ["provider", "outcome"],
+)
+
+LLM_PROVIDER_FAILOVERS = Counter(
+    "llm_provider_failovers_total",
+    "Routed LLM turns that moved from a failed provider to the next one",
+    ["from_provider", "to_provider"],
+)
+
+LLM_HEDGED_REQUESTS = Counter(
+    "llm_hedged_requests_total",
+    "Hedged LLM turns by the attempt that answered (primary, hedge, none)",
+    ["winner"],
+)
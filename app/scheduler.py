@@ -21,6 +21,7 @@ from app.metrics import (
     monitor_system_metrics,
 )
 from app.services.backup import S3DatabaseBackupService, build_config_from_environment
+from app.services.inbound_queue import INBOUND_QUEUE_RETENTION_DAYS, purge_done_items
 from app.utils.service_utils import get_tomorrow_reservations, parse_time
 from app.utils.whatsapp_utils import append_message, send_whatsapp_template
 
@@ -155,6 +156,18 @@ def collect_garbage_job():
     logging.info(f"Garbage collection manually triggered: collected {collected} objects")
 
 
+def purge_inbound_queue_job():
+    """Delete processed inbound queue rows older than the retention period."""
+    try:
+        deleted = purge_done_items(INBOUND_QUEUE_RETENTION_DAYS)
+        logging.info(
+            f"Inbound queue retention: deleted {deleted} done items older than {INBOUND_QUEUE_RETENTION_DAYS} days"
+        )
+    except Exception as e:
+        logging.error(f"Inbound queue retention job failed: {e}")
+        FUNCTION_ERRORS.labels(function="purge_inbound_queue_job").inc()
+
+
 # Listener function for APScheduler missed job events
 def scheduler_listener(event):
     if event.code == EVENT_JOB_MISSED:
@@ -252,6 +265,16 @@ def init_scheduler(app):
         collect_garbage_job, "interval", hours=1, id="gc_collect", replace_existing=True, misfire_grace_time=300
     )
 
+    # Schedule inbound queue retention cleanup every day at 03:00
+    retention_trigger = CronTrigger(hour=3, minute=0, timezone=tz)
+    scheduler.add_job(
+        purge_inbound_queue_job,
+        retention_trigger,
+        id="inbound_queue_retention",
+        replace_existing=True,
+        misfire_grace_time=300,
+    )
+
     scheduler.start()
     app.state.scheduler = scheduler
     logging.info(f"Scheduler started with TIMEZONE={tz}, job count={len(scheduler.get_jobs())} in pid {pid}")
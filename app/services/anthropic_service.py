@@ -1,5 +1,6 @@
 import asyncio
 import datetime
+import functools
 import inspect
 import json
 import logging
@@ -7,26 +8,34 @@ from zoneinfo import ZoneInfo
 
 import httpx
 from anthropic import (
-    Anthropic,
     AnthropicError,
     APIConnectionError,
     APITimeoutError,
+    AsyncAnthropic,
     AuthenticationError,
     BadRequestError,
     RateLimitError,
 )
 
 from app.config import config
-from app.decorators import retry_decorator
+from app.decorators import ToolCallsRanError, retry_decorator
 from app.metrics import LLM_API_ERRORS, LLM_EMPTY_RESPONSES, LLM_RETRY_ATTEMPTS, LLM_TOOL_EXECUTION_ERRORS
-from app.services.toolkit.registry import DEFAULT_TOOL_REGISTRY, ToolRegistry
-from app.utils import append_message, parse_unix_timestamp, retrieve_messages
-from app.utils.http_client import sync_client
+from app.services.context_window import SUMMARY_CONTEXT_HEADER, build_context, schedule_summary_refresh
+from app.services.llm_instrumentation import api_call, record_tokens
+from app.services.rate_governor import estimate_tokens, rate_limited
+from app.services.toolkit.execution import (
+    ToolAuditLog,
+    call_tool_async,
+    tool_audit_body,
+    tool_calls_ran,
+)
+from app.services.toolkit.registry import DEFAULT_TOOL_REGISTRY, ToolRegistry, compiled_tools
+from app.utils.http_client import async_llm_client
+from app.utils.reply_stream import ReplyInterruptedError, active_reply_stream
 
 ANTHROPIC_API_KEY = config.get("ANTHROPIC_API_KEY")
 
-# Create Anthropic client
-client = Anthropic(api_key=ANTHROPIC_API_KEY, http_client=sync_client)
+async_client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY, http_client=async_llm_client)
 
 
 def map_anthropic_error(e):
@@ -69,8 +78,179 @@ def _is_retryable_anthropic_exception(e: Exception) -> bool:
     return isinstance(e, retryable_types)
 
 
+# Anthropic accepts at most four cache_control breakpoints per request
+MAX_CACHE_BREAKPOINTS = 4
+# Breakpoints reserved for the conversation: the stable history and the growing tool-loop transcript
+MESSAGE_CACHE_BREAKPOINTS = 2
+
+
+def _system_prompt_blocks(system_prompt, summary=None):
+    text = system_prompt or "You are a helpful assistant that can answer questions and help with tasks."
+    blocks = [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+    if summary:
+        # Separate breakpoint: the summary changes far less often than the history, far more often than the prompt
+        blocks.append(
+            {"type": "text", "text": f"{SUMMARY_CONTEXT_HEADER}\n{summary}", "cache_control": {"type": "ephemeral"}}
+        )
+    return blocks
+
+
+def _tool_specs(toolkit: ToolRegistry, max_breakpoints=MAX_CACHE_BREAKPOINTS):
+    """Claude tool specs of the registry, built once per (registry, breakpoint allowance)."""
+    max_breakpoints = max(max_breakpoints, 0)
+    return compiled_tools(
+        toolkit, f"anthropic:{max_breakpoints}", functools.partial(_build_tool_specs, max_breakpoints=max_breakpoints)
+    )
+
+
+def _build_tool_specs(toolkit: ToolRegistry, max_breakpoints):
+    # Keep only the last declared tool breakpoints that fit next to the system and message ones
+    declared = [t["name"] for t in toolkit.definitions if t.get("cache_control")]
+    keep = set(declared[len(declared) - max_breakpoints :]) if max_breakpoints > 0 else set()
+    return [
+        {
+            "name": t["name"],
+            "description": t["description"],
+            "input_schema": t["schema"],
+            **({"cache_control": t["cache_control"]} if t["name"] in keep else {}),
+        }
+        for t in toolkit.definitions
+    ]
+
+
+def _with_cache_breakpoint(message):
+    """Copy of a user message whose last content block is marked as a prompt-cache breakpoint."""
+    content = message["content"]
+    if isinstance(content, str):
+        if not content:
+            return message
+        blocks = [{"type": "text", "text": content}]
+    elif isinstance(content, list) and content and isinstance(content[-1], dict):
+        blocks = list(content)
+    else:
+        return message
+    blocks[-1] = {**blocks[-1], "cache_control": {"type": "ephemeral"}}
+    return {**message, "content": blocks}
+
+
+def _cached_messages(messages, stable_count):
+    """
+    Request messages with cache breakpoints on the last history message (stable for the whole turn) and on
+    the newest tool-loop message, so each follow-up request only pays full price for the latest tool results.
+    """
+    marked = list(messages)
+    for index in {stable_count - 1, len(marked) - 1}:
+        if 0 <= index < len(marked) and marked[index].get("role") == "user":
+            marked[index] = _with_cache_breakpoint(marked[index])
+    return marked
+
+
+def _record_usage(model, response):
+    """Export token usage, including prompt-cache reads and writes, from a Messages API response."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    record_tokens(
+        "anthropic",
+        model,
+        input=getattr(usage, "input_tokens", None),
+        output=getattr(usage, "output_tokens", None),
+        cache_read=getattr(usage, "cache_read_input_tokens", None),
+        cache_write=getattr(usage, "cache_creation_input_tokens", None),
+    )
+
+
+def _tool_result_content(output):
+    if isinstance(output, dict):
+        return json.dumps(output.get("message", output))
+    return json.dumps(output) if isinstance(output, list) else str(output)
+
+
+def _start_tool_uses(wa_id, response, function_map, audit):
+    """Collect the tool_use blocks of a response as (block, function, input) and persist their arguments."""
+    tool_uses = []
+    for block in response.content:
+        if block.type != "tool_use":
+            continue
+        function = function_map.get(block.name)
+        tool_input = block.input if isinstance(block.input, dict) else {}
+        if function and "wa_id" in inspect.signature(function).parameters and not tool_input.get("wa_id", ""):
+            tool_input["wa_id"] = wa_id
+        logging.info(f"Tool used: {block.name}")
+        audit.add("Tool", block.name, tool_audit_body(tool_input))
+        tool_uses.append((block, function, tool_input))
+    return tool_uses
+
+
+def _tool_use_outcome(tool_name, function, output=None, error=None):
+    """Return (tool_result content, audit body) for a finished tool call; audit body is None if nothing ran."""
+    if function is None:
+        logging.error(f"Function '{tool_name}' not implemented.")
+        LLM_TOOL_EXECUTION_ERRORS.labels(tool_name=tool_name, provider="anthropic").inc()
+        return f"Error: Tool '{tool_name}' is not implemented", None
+    if error is not None:
+        logging.error(f"Error executing function {tool_name}: {error}")
+        LLM_TOOL_EXECUTION_ERRORS.labels(tool_name=tool_name, provider="anthropic").inc()
+        return f"Error: {str(error)}", str(error)
+    logging.info(f"Tool output for {tool_name}: {str(output)[:500]}...")
+    return _tool_result_content(output), tool_audit_body(output)
+
+
+async def _run_tool_use_async(tool_name, function, tool_input):
+    if function is None:
+        return _tool_use_outcome(tool_name, None)
+    try:
+        return _tool_use_outcome(tool_name, function, await call_tool_async(function, tool_input))
+    except Exception as e:
+        return _tool_use_outcome(tool_name, function, error=e)
+
+
+def _finish_tool_uses(audit, tool_uses, outcomes):
+    """Record tool results in call order and build the tool_result blocks answering one turn."""
+    tool_results = []
+    for (block, _function, _input), (content, audit_body) in zip(tool_uses, outcomes, strict=True):
+        if audit_body is not None:
+            audit.add("Result", block.name, audit_body)
+        tool_results.append({"type": "tool_result", "tool_use_id": block.id, "content": content})
+    return tool_results
+
+
+def _now_strings(tz):
+    now = datetime.datetime.now(tz=ZoneInfo(tz))
+    return now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S")
+
+
+def _rate_limited_tokens(response):
+    """Tokens counted against the provider's per-minute limits (cache reads are not)."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    return sum(
+        getattr(usage, attribute, None) or 0
+        for attribute in ("input_tokens", "cache_creation_input_tokens", "output_tokens")
+    )
+
+
+async def _create_message_async(request_args, reply):
+    """Create a message; with a reply stream its text is fed to the stream as it is generated."""
+    tokens = estimate_tokens([request_args.get("system"), request_args.get("messages")], request_args.get("max_tokens"))
+    async with rate_limited("anthropic", request_args["model"], tokens) as grant:
+        with api_call("anthropic", request_args["model"]):
+            if reply is None:
+                response = await async_client.beta.messages.create(**request_args)
+            else:
+                async with async_client.beta.messages.stream(**request_args) as message_stream:
+                    async for text in message_stream.text_stream:
+                        reply.feed(text)
+                    response = await message_stream.get_final_message()
+        grant.settle(_rate_limited_tokens(response))
+    if reply is not None:
+        reply.flush()
+    return response
+
+
 @retry_decorator
-def run_claude(
+async def run_claude_async(
     wa_id,
     model,
     system_prompt=None,
@@ -81,269 +261,103 @@ def run_claude(
     toolkit: ToolRegistry = DEFAULT_TOOL_REGISTRY,
 ):
     """
-    Run Claude with the conversation history and handle tool calls.
-    Returns the generated message along with date and time.
-    Raises exceptions for error cases to enable retry functionality.
-
-    Args:
-        wa_id (str): WhatsApp ID of the user
-        model (str): Claude model to use.
-        system_prompt (str, optional): System prompt to use.
-        max_tokens (int, optional): Maximum tokens for response.
-        thinking (dict, optional): Extended thinking configuration dict or None to disable.
-        stream (bool, optional): Whether to stream responses.
-        timezone (str, optional): Timezone for timestamps.
+    Run Claude with the conversation history and handle tool calls, on AsyncAnthropic.
+
+    The tool loop runs as coroutines on the event loop: async tools are awaited directly and sync tools
+    run in a worker thread, so an in-flight conversation holds no thread while waiting on the API.
+    With ``stream`` the text of every response is fed to the caller's active reply stream as it arrives.
+    Returns (response_text, date_str, time_str) and raises for errors to enable retry functionality.
     """
-    # Create system prompt structure if custom prompt provided
-    if system_prompt:
-        system_prompt_obj = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
-    else:
-        # Default empty system prompt
-        system_prompt_obj = [
-            {
-                "type": "text",
-                "text": "You are a helpful assistant that can answer questions and help with tasks.",
-                "cache_control": {"type": "ephemeral"},
-            }
-        ]
-
-    # Use timezone from parameters or fallback to UTC
     tz = timezone or "UTC"
-
-    # Get conversation history
-    input_chat = retrieve_messages(wa_id)
-
+    reply = active_reply_stream() if stream else None
+    if reply is not None:
+        reply.restart()
+    context = await asyncio.to_thread(build_context, wa_id, "anthropic")
+    schedule_summary_refresh(wa_id, context)
+    input_chat = context.messages
+    system_prompt_obj = _system_prompt_blocks(system_prompt, context.summary)
     function_map = toolkit.functions
-    tool_specs = [
-        {
-            "name": t["name"],
-            "description": t["description"],
-            "input_schema": t["schema"],
-            **({"cache_control": t["cache_control"]} if t.get("cache_control") else {}),
-        }
-        for t in toolkit.definitions
-    ]
+    tool_specs = _tool_specs(toolkit, MAX_CACHE_BREAKPOINTS - len(system_prompt_obj) - MESSAGE_CACHE_BREAKPOINTS)
+    stable_count = len(input_chat)
+    audit = ToolAuditLog(wa_id)
 
-    # Prepare API request arguments, with optional thinking inclusion
     def prepare_request_args(enable_thinking=False):
         req_kwargs = {
             "model": model,
             "system": system_prompt_obj,
-            "messages": input_chat,
+            "messages": _cached_messages(input_chat, stable_count),
             "tools": tool_specs,
             "max_tokens": max_tokens,
-            "stream": stream,
             "betas": ["token-efficient-tools-2025-02-19"],
         }
-        # Always include thinking when configured for extended reasoning
         if thinking and enable_thinking:
             req_kwargs["thinking"] = thinking
-
         return req_kwargs
 
     try:
-        # Initial request to Claude
         logging.info(f"Making initial Claude API request for {wa_id}")
-        response = client.beta.messages.create(**prepare_request_args())
+        response = await _create_message_async(prepare_request_args(), reply)
+        _record_usage(model, response)
         logging.info(f"Initial response stop reason: {response.stop_reason}")
 
-        # Extract ALL thinking and redacted_thinking blocks in their original order
         all_thinking_blocks = [block for block in response.content if block.type in ["thinking", "redacted_thinking"]]
-        # logging.info(f"All thinking blocks: {all_thinking_blocks}")
 
-        # Process tool calls if present
         while response.stop_reason == "tool_use":
-            # Find the tool use block
-            tool_use_block = next((block for block in response.content if block.type == "tool_use"), None)
-
-            if not tool_use_block:
+            tool_uses = _start_tool_uses(wa_id, response, function_map, audit)
+            if not tool_uses:
                 logging.error("Tool use indicated but no tool_use block found in content")
                 LLM_API_ERRORS.labels(provider="anthropic", error_type="invalid_response").inc()
                 break
 
-            # Extract tool details
-            tool_name = tool_use_block.name
-            tool_input = tool_use_block.input
-            tool_use_id = tool_use_block.id
-
-            logging.info(f"Tool used: {tool_name}")
-            if tool_input:
-                logging.info(f"Tool input: {json.dumps(tool_input)}")
-            # Persist tool call (arguments)
-            try:
-                pretty_args = json.dumps(tool_input or {}, ensure_ascii=False, indent=2)
-                from html import escape as _escape
-
-                html_args = (
-                    f'<details class="details">'
-                    f"<summary>Tool: {tool_name}</summary>"
-                    f'<div><pre><code class="language-json">{_escape(pretty_args)}</code></pre></div>'
-                    f"</details>"
-                )
-                d, t = parse_unix_timestamp(int(datetime.datetime.now(datetime.timezone.utc).timestamp()))
-                append_message(wa_id, "tool", html_args, d, t)
-            except Exception as _persist_args_err:
-                logging.error(f"Persist tool args failed for {tool_name}: {_persist_args_err}")
-
-            # Prepare the assistant's response content with correct ordering:
-            # 1. All thinking blocks must come first if present
-            # 2. Followed by the tool_use block
-            assistant_content = []
-            assistant_content.extend(all_thinking_blocks)  # Add all thinking blocks
-            assistant_content.append(tool_use_block)
-
-            # Execute tool if available
-            function = function_map.get(tool_name)
-            if function:
-                sig = inspect.signature(function)
-
-                # If the function takes a 'wa_id' parameter, add it
-                if "wa_id" in sig.parameters and not tool_input.get("wa_id", ""):
-                    tool_input["wa_id"] = wa_id
-
-                try:
-                    # Execute tool function (synchronous or asynchronous)
-                    if inspect.iscoroutinefunction(function):
-                        output = asyncio.run(function(**tool_input))
-                    else:
-                        output = function(**tool_input)
-
-                    # Log tool output
-                    if isinstance(output, dict | list):
-                        logging.info(f"Tool output for {tool_name}: {json.dumps(output)[:500]}...")
-                    else:
-                        logging.info(f"Tool output for {tool_name}: {str(output)[:500]}...")
-
-                    # Add the assistant message with thinking and tool use, exactly as received
-                    input_chat.append({"role": "assistant", "content": assistant_content})
-
-                    # Add tool result as user message
-                    input_chat.append(
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "tool_result",
-                                    "tool_use_id": tool_use_id,
-                                    "content": json.dumps(output.get("message", output))
-                                    if isinstance(output, dict | list)
-                                    else str(output),
-                                }
-                            ],
-                        }
-                    )
-                    # Persist tool result
-                    try:
-                        pretty_out = (
-                            json.dumps(output, ensure_ascii=False, indent=2)
-                            if isinstance(output, dict | list)
-                            else str(output)
-                        )
-                        from html import escape as _escape
-
-                        html_out = (
-                            f'<details class="details">'
-                            f"<summary>Result: {tool_name}</summary>"
-                            f'<div><pre><code class="language-json">{_escape(pretty_out)}</code></pre></div>'
-                            f"</details>"
-                        )
-                        d2, t2 = parse_unix_timestamp(int(datetime.datetime.now(datetime.timezone.utc).timestamp()))
-                        append_message(wa_id, "tool", html_out, d2, t2)
-                    except Exception as _persist_out_err:
-                        logging.error(f"Persist tool result failed for {tool_name}: {_persist_out_err}")
-
-                except Exception as e:
-                    # Handle tool execution errors
-                    logging.error(f"Error executing function {tool_name}: {e}")
-                    LLM_TOOL_EXECUTION_ERRORS.labels(tool_name=tool_name, provider="anthropic").inc()
-
-                    # Add the assistant message with thinking and tool use
-                    input_chat.append({"role": "assistant", "content": assistant_content})
-
-                    # Add error result
-                    input_chat.append(
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "tool_result", "tool_use_id": tool_use_id, "content": f"Error: {str(e)}"}
-                            ],
-                        }
-                    )
-                    # Persist error as result
-                    try:
-                        from html import escape as _escape
-
-                        html_out = (
-                            f'<details class="details">'
-                            f"<summary>Result: {tool_name}</summary>"
-                            f'<div><pre><code class="language-json">{_escape(str(e))}</code></pre></div>'
-                            f"</details>"
-                        )
-                        d3, t3 = parse_unix_timestamp(int(datetime.datetime.now(datetime.timezone.utc).timestamp()))
-                        append_message(wa_id, "tool", html_out, d3, t3)
-                    except Exception:
-                        pass
+            input_chat.append({"role": "assistant", "content": [*all_thinking_blocks, *(use[0] for use in tool_uses)]})
+            outcomes = await asyncio.gather(
+                *(_run_tool_use_async(block.name, function, tool_input) for block, function, tool_input in tool_uses)
+            )
+            input_chat.append({"role": "user", "content": _finish_tool_uses(audit, tool_uses, outcomes)})
 
-            else:
-                # Handle unimplemented tool
-                logging.error(f"Function '{tool_name}' not implemented.")
-                LLM_TOOL_EXECUTION_ERRORS.labels(tool_name=tool_name, provider="anthropic").inc()
-
-                # Add the assistant message with thinking and tool use
-                input_chat.append({"role": "assistant", "content": assistant_content})
-
-                # Add error about unimplemented tool
-                input_chat.append(
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "tool_result",
-                                "tool_use_id": tool_use_id,
-                                "content": f"Error: Tool '{tool_name}' is not implemented",
-                            }
-                        ],
-                    }
-                )
-
-            # Follow-up request after tool result
             logging.info(f"Making follow-up Claude API request for {wa_id}")
-            response = client.beta.messages.create(**prepare_request_args())
+            response = await _create_message_async(prepare_request_args(), reply)
+            _record_usage(model, response)
             logging.info(f"Follow-up response stop reason: {response.stop_reason}")
 
-        # Extract final text response
-        final_response = next(
-            (block.text for block in response.content if hasattr(block, "text")),
-            None,
-        )
-
-        # Format and return the response
+        final_response = next((block.text for block in response.content if hasattr(block, "text")), None)
+        date_str, time_str = _now_strings(tz)
         if final_response:
-            now = datetime.datetime.now(tz=ZoneInfo(tz))
-            date_str = now.strftime("%Y-%m-%d")
-            time_str = now.strftime("%H:%M:%S")
-
             logging.info(f"Generated message for {wa_id}: {final_response[:100]}...")
             return final_response, date_str, time_str
-        else:
-            # No text content found in response
-            logging.error("No text content in Claude response; returning None without retry")
-            LLM_EMPTY_RESPONSES.labels(provider="anthropic", response_type="no_text_content").inc()
-            now = datetime.datetime.now(tz=ZoneInfo(tz))
-            date_str = now.strftime("%Y-%m-%d")
-            time_str = now.strftime("%H:%M:%S")
-            return None, date_str, time_str
+        logging.error("No text content in Claude response; returning None without retry")
+        LLM_EMPTY_RESPONSES.labels(provider="anthropic", response_type="no_text_content").inc()
+        return None, date_str, time_str
 
     except Exception as e:
-        # Handle and log API errors
         error_type = map_anthropic_error(e)
         if error_type == "unknown":
             error_type = f"unknown::{type(e).__name__}"
-        logging.error("======================================================")
         logging.error(f"CLAUDE API ERROR for wa_id={wa_id}: {e} (type: {error_type})")
-        logging.error("This error will trigger the retry mechanism")
-        logging.error("======================================================")
         LLM_API_ERRORS.labels(provider="anthropic", error_type=error_type).inc()
+        if reply is not None and reply.delivered:
+            # Retrying would send the opening of the reply a second time
+            raise ReplyInterruptedError(f"{type(e).__name__}: {e}") from e
+        if tool_calls_ran():
+            # Retrying or deferring the turn would run its tools again
+            raise ToolCallsRanError(f"{type(e).__name__}: {e}") from e
         if _is_retryable_anthropic_exception(e):
             LLM_RETRY_ATTEMPTS.labels(provider="anthropic", error_type=error_type).inc()
         raise  # Re-raise for retry
+    finally:
+        await audit.aflush()
+
+
+async def complete_claude_async(model, system_prompt, prompt, max_tokens=1024):
+    """Single tool-free completion (used for background housekeeping such as history summaries)."""
+    async with rate_limited("anthropic", model, estimate_tokens([system_prompt, prompt], max_tokens)) as grant:
+        with api_call("anthropic", model):
+            response = await async_client.messages.create(
+                model=model,
+                system=system_prompt,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=max_tokens,
+            )
+        grant.settle(_rate_limited_tokens(response))
+    _record_usage(model, response)
+    return next((block.text for block in response.content if getattr(block, "type", None) == "text"), "")
@@ -0,0 +1,192 @@
+"""Token-budgeted LLM context with a rolling summary of older history.
+
+``build_context`` packs the newest messages into a per-provider token budget (LLM_CONTEXT_TOKEN_BUDGET,
+overridable per provider with LLM_CONTEXT_TOKEN_BUDGET_<PROVIDER>). Whatever falls out of the window is
+folded into a summary persisted in ``conversation_summaries``. Async runners refresh it in the
+background through ``schedule_summary_refresh``, so a turn never waits for summarization.
+"""
+
+import asyncio
+import logging
+import math
+import os
+from dataclasses import dataclass
+
+from sqlalchemy import select
+
+from app.db import ConversationModel, ConversationSummaryModel, get_session
+from app.metrics import LLM_CONTEXT_SUMMARY_REFRESHES
+from app.utils.service_utils import context_messages_limit, retrieve_context_rows
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+
+LLM_CONTEXT_TOKEN_BUDGET = int(_env_float("LLM_CONTEXT_TOKEN_BUDGET", 12000))
+# Conservative for Arabic text, which tokenizes denser than English
+LLM_CONTEXT_CHARS_PER_TOKEN = max(_env_float("LLM_CONTEXT_CHARS_PER_TOKEN", 3.0), 0.5)
+LLM_CONTEXT_SUMMARY_ENABLED = os.environ.get("LLM_CONTEXT_SUMMARY_ENABLED", "true").lower() in ("1", "true", "yes")
+# Fewer unsummarized messages than this wait for the next turn instead of costing a summary call
+LLM_CONTEXT_SUMMARY_MIN_MESSAGES = int(_env_float("LLM_CONTEXT_SUMMARY_MIN_MESSAGES", 4))
+LLM_CONTEXT_SUMMARY_BATCH_MESSAGES = int(_env_float("LLM_CONTEXT_SUMMARY_BATCH_MESSAGES", 200))
+LLM_CONTEXT_SUMMARY_MAX_TOKENS = int(_env_float("LLM_CONTEXT_SUMMARY_MAX_TOKENS", 600))
+
+# Per-message framing overhead (role markers, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You maintain a running summary of a customer conversation for a reservations assistant. "
+    "Merge the new messages into the previous summary. Keep names, phone numbers, dates, times, "
+    "reservations made or cancelled, preferences and open requests; drop greetings and small talk. "
+    "Write at most a few short paragraphs in the language of the conversation and return only the summary."
+)
+
+SUMMARY_CONTEXT_HEADER = "Summary of the earlier conversation with this customer:"
+
+
+@dataclass(frozen=True)
+class ContextWindow:
+    messages: list[dict[str, str]]
+    summary: str | None = None
+    # Messages with a lower conversation id are outside the window and should be folded into the summary
+    summarize_before_id: int | None = None
+    # Conversation id of the newest message in the window
+    last_id: int | None = None
+
+
+def estimate_tokens(text: str | None) -> int:
+    return math.ceil(len(text or "") / LLM_CONTEXT_CHARS_PER_TOKEN) + MESSAGE_OVERHEAD_TOKENS
+
+
+def token_budget(provider: str) -> int:
+    value = os.environ.get(f"LLM_CONTEXT_TOKEN_BUDGET_{provider.upper()}")
+    if value:
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    return LLM_CONTEXT_TOKEN_BUDGET
+
+
+def build_context(wa_id: str, provider: str) -> ContextWindow:
+    """Return the newest messages that fit the provider's token budget plus the stored summary."""
+    rows = retrieve_context_rows(wa_id)
+    budget = token_budget(provider)
+    start = len(rows)
+    used = 0
+    if budget > 0:
+        while start > 0:
+            cost = estimate_tokens(rows[start - 1][2])
+            # The newest message is always kept, however long it is
+            if used + cost > budget and start < len(rows):
+                break
+            used += cost
+            start -= 1
+    else:
+        start = 0
+    # Provider histories must open with a user turn
+    while start < len(rows) - 1 and rows[start][1] != "user":
+        start += 1
+    window = rows[start:]
+    messages = [{"role": role, "content": content} for _id, role, content in window]
+    last_id = window[-1][0] if window else None
+
+    limit = context_messages_limit()
+    truncated = start > 0 or (limit > 0 and len(rows) >= limit)
+    if not (LLM_CONTEXT_SUMMARY_ENABLED and window and truncated):
+        return ContextWindow(messages, last_id=last_id)
+    return ContextWindow(messages, load_summary(wa_id), summarize_before_id=window[0][0], last_id=last_id)
+
+
+def load_summary(wa_id: str) -> str | None:
+    """Stored rolling summary of ``wa_id``, if any; failures only cost the summary."""
+    if not LLM_CONTEXT_SUMMARY_ENABLED:
+        return None
+    try:
+        with get_session() as session:
+            record = session.get(ConversationSummaryModel, wa_id)
+            return record.summary if record is not None else None
+    except Exception as e:
+        logging.warning(f"Loading conversation summary failed for {wa_id}: {e}")
+        return None
+
+
+def with_summary(system_prompt: str | None, summary: str | None) -> str | None:
+    """Append the rolling summary to a plain-text system prompt (OpenAI instructions, Gemini)."""
+    if not summary:
+        return system_prompt
+    return f"{system_prompt or ''}\n\n{SUMMARY_CONTEXT_HEADER}\n{summary}".strip()
+
+
+_refresh_tasks: dict[str, asyncio.Task] = {}
+
+
+def schedule_summary_refresh(wa_id: str, context: ContextWindow) -> None:
+    """Fold messages that left the window into the summary in the background (one task per wa_id)."""
+    if context.summarize_before_id is None:
+        return
+    running = _refresh_tasks.get(wa_id)
+    if running is not None and not running.done():
+        return
+    task = asyncio.get_running_loop().create_task(refresh_summary(wa_id, context.summarize_before_id))
+    _refresh_tasks[wa_id] = task
+    task.add_done_callback(lambda t: _refresh_tasks.pop(wa_id, None) if _refresh_tasks.get(wa_id) is t else None)
+
+
+def _unsummarized_rows(wa_id: str, before_id: int) -> tuple[str | None, list]:
+    with get_session() as session:
+        record = session.get(ConversationSummaryModel, wa_id)
+        covered = record.covered_until_id if record is not None else 0
+        rows = session.execute(
+            select(ConversationModel.id, ConversationModel.role, ConversationModel.message)
+            .where(
+                ConversationModel.wa_id == wa_id,
+                ConversationModel.id > covered,
+                ConversationModel.id < before_id,
+                ConversationModel.role != "tool",
+            )
+            .order_by(ConversationModel.id.asc())
+            .limit(LLM_CONTEXT_SUMMARY_BATCH_MESSAGES)
+        ).all()
+        return (record.summary if record is not None else None), rows
+
+
+def _save_summary(wa_id: str, summary: str, covered_until_id: int) -> None:
+    with get_session() as session:
+        record = session.get(ConversationSummaryModel, wa_id)
+        if record is None:
+            session.add(ConversationSummaryModel(wa_id=wa_id, summary=summary, covered_until_id=covered_until_id))
+        elif covered_until_id > record.covered_until_id:
+            record.summary = summary
+            record.covered_until_id = covered_until_id
+        session.commit()
+
+
+async def refresh_summary(wa_id: str, before_id: int) -> None:
+    try:
+        previous, rows = await asyncio.to_thread(_unsummarized_rows, wa_id, before_id)
+        if len(rows) < max(LLM_CONTEXT_SUMMARY_MIN_MESSAGES, 1):
+            LLM_CONTEXT_SUMMARY_REFRESHES.labels(result="skipped").inc()
+            return
+        transcript = "\n".join(f"{'Customer' if row.role == 'user' else 'Assistant'}: {row.message}" for row in rows)
+        prompt = f"Previous summary:\n{previous or '(none)'}\n\nNew messages:\n{transcript}"
+
+        from app.services.llm_instrumentation import detach_turn
+        from app.services.llm_service import get_llm_service
+        from app.services.rate_governor import PRIORITY_BACKGROUND, llm_priority
+
+        # Summaries queue behind customer and system-agent turns and are not counted in the turn that started them
+        with llm_priority(PRIORITY_BACKGROUND), detach_turn():
+            summary = await get_llm_service().complete(SUMMARY_SYSTEM_PROMPT, prompt, LLM_CONTEXT_SUMMARY_MAX_TOKENS)
+        if not summary:
+            LLM_CONTEXT_SUMMARY_REFRESHES.labels(result="empty").inc()
+            return
+        await asyncio.to_thread(_save_summary, wa_id, summary.strip(), rows[-1].id)
+        LLM_CONTEXT_SUMMARY_REFRESHES.labels(result="ok").inc()
+    except Exception as e:
+        LLM_CONTEXT_SUMMARY_REFRESHES.labels(result="error").inc()
+        logging.warning(f"Conversation summary refresh failed for {wa_id}: {e}")
@@ -26,6 +26,7 @@ from app.services.domain.config.config_schemas import (
     NotificationPreferencesConfig,
     SlotCapacityConfig,
 )
+from app.utils.answer_cache import invalidate_answers
 
 logger = logging.getLogger(__name__)
 
@@ -446,6 +447,7 @@ def update_config(
 
         # Clear cache
         _config_cache = None
+        invalidate_answers("config")
 
         # Return updated config
         return get_config(session)
@@ -482,6 +484,7 @@ def create_config(config_data: AppConfigCreate, session: Session | None = None)
 
         # Clear cache
         _config_cache = None
+        invalidate_answers("config")
 
         return get_config(session)
     finally:
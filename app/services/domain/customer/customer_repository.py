@@ -2,7 +2,15 @@ import logging
 
 from sqlalchemy import func
 
-from app.db import ConversationModel, CustomerModel, ReservationModel, get_session
+from app.db import (
+    ConversationModel,
+    ConversationSummaryModel,
+    CustomerModel,
+    ReservationModel,
+    ResponseChainModel,
+    get_session,
+)
+from app.utils.service_utils import context_cache
 
 from .customer_models import (
     Customer,
@@ -199,6 +207,19 @@ class CustomerRepository:
                 .filter(ConversationModel.wa_id == old_wa_id)
                 .update({ConversationModel.wa_id: new_wa_id}, synchronize_session=False)
             )
+            # The rolling summary follows the history unless the target already has its own
+            if session.get(ConversationSummaryModel, new_wa_id) is None:
+                session.query(ConversationSummaryModel).filter(ConversationSummaryModel.wa_id == old_wa_id).update(
+                    {ConversationSummaryModel.wa_id: new_wa_id}, synchronize_session=False
+                )
+            else:
+                session.query(ConversationSummaryModel).filter(ConversationSummaryModel.wa_id == old_wa_id).delete(
+                    synchronize_session=False
+                )
+            # Stored OpenAI responses hold the old history; the next turn starts a new chain
+            session.query(ResponseChainModel).filter(ResponseChainModel.wa_id.in_([old_wa_id, new_wa_id])).delete(
+                synchronize_session=False
+            )
             logger.info(
                 "CustomerRepository.update_wa_id updated dependents reservations=%s conversations=%s",
                 res_rows,
@@ -215,6 +236,7 @@ class CustomerRepository:
                 )
 
             session.commit()
+            context_cache.invalidate(old_wa_id, new_wa_id)
 
             total_rows = (res_rows or 0) + (conv_rows or 0) + 1
             if resulting_name is None:
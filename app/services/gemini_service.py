@@ -20,7 +20,7 @@ from google.api_core.exceptions import (
 from google.genai import types
 
 from app.config import config, load_config
-from app.decorators import retry_decorator
+from app.decorators import ToolCallsRanError, retry_decorator
 from app.metrics import (
     FUNCTION_ERRORS,
     LLM_API_ERRORS,
@@ -28,8 +28,11 @@ from app.metrics import (
     LLM_RETRY_ATTEMPTS,
     LLM_TOOL_EXECUTION_ERRORS,
 )
-from app.services.toolkit.registry import DEFAULT_TOOL_REGISTRY, ToolRegistry
-from app.utils import append_message, parse_unix_timestamp, retrieve_messages
+from app.services.context_window import build_context, schedule_summary_refresh, with_summary
+from app.services.llm_instrumentation import api_call, record_tokens
+from app.services.rate_governor import estimate_tokens, rate_limited
+from app.services.toolkit.execution import ToolAuditLog, call_tool_async, tool_audit_body, tool_calls_ran
+from app.services.toolkit.registry import DEFAULT_TOOL_REGISTRY, ToolRegistry, compiled_tools
 
 load_config()
 
@@ -79,15 +82,36 @@ def _is_retryable_gemini_exception(e: Exception) -> bool:
     return isinstance(e, GoogleAPIError | ResourceExhausted | DeadlineExceeded | TimeoutError)
 
 
-# Create function declarations dynamically from assistant_functions
-_FUNCTION_DECLARATION_CACHE: dict[str, list[types.FunctionDeclaration]] = {}
+def create_function_declarations(toolkit: ToolRegistry) -> list[types.FunctionDeclaration]:
+    """Gemini function declarations of the registry, built once per registry."""
+    return compiled_tools(toolkit, "gemini", _build_function_declarations)
+
+
+def _gemini_tools(toolkit: ToolRegistry) -> list[types.Tool]:
+    return compiled_tools(
+        toolkit, "gemini:tools", lambda t: [types.Tool(function_declarations=create_function_declarations(t))]
+    )
+
 
+def _generate_content_config(toolkit: ToolRegistry, max_tokens: int | None) -> types.GenerateContentConfig:
+    """Request config (sampling and tools) shared by every async turn with the same registry and limit."""
+    max_output_tokens = max_tokens if max_tokens else 4096
+    return compiled_tools(
+        toolkit,
+        f"gemini:config:{max_output_tokens}",
+        lambda t: types.GenerateContentConfig(
+            temperature=0.7,
+            top_p=0.95,
+            top_k=64,
+            max_output_tokens=max_output_tokens,
+            tools=_gemini_tools(t),
+            automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True),
+        ),
+    )
 
-def create_function_declarations(toolkit: ToolRegistry):
-    cache_key = toolkit.name or "default"
-    if cache_key in _FUNCTION_DECLARATION_CACHE:
-        return _FUNCTION_DECLARATION_CACHE[cache_key]
 
+# Create function declarations dynamically from assistant_functions
+def _build_function_declarations(toolkit: ToolRegistry) -> list[types.FunctionDeclaration]:
     declarations = []
 
     # Define schema type mapping for conversions
@@ -218,32 +242,11 @@ def create_function_declarations(toolkit: ToolRegistry):
             )
         )
 
-    _FUNCTION_DECLARATION_CACHE[cache_key] = declarations
     return declarations
 
 
-@retry_decorator
-def run_gemini(wa_id, model, system_prompt, max_tokens=None, timezone=None, toolkit: ToolRegistry = DEFAULT_TOOL_REGISTRY):
-    """
-    Run Gemini with the conversation history and handle tool calls.
-    Returns the generated message along with date and time.
-    Raises exceptions for error cases to enable retry functionality.
-
-    Args:
-        wa_id (str): WhatsApp ID of the user
-        model (str): Gemini model to use.
-        system_prompt (str): System prompt to use.
-        max_tokens (int, optional): Maximum tokens for response.
-        timezone (str, optional): Timezone for timestamps.
-    """
-    # Use timezone from parameters or fallback to UTC
-    tz = timezone or "UTC"
-
-    # Retrieve conversation history
-    messages_history = retrieve_messages(wa_id)
-    function_map = toolkit.functions
-
-    # Convert messages to Gemini format
+def _build_contents(system_prompt, messages_history):
+    """Convert the stored conversation history into Gemini contents, preceded by the system prompt."""
     contents = []
 
     # Add system message as the first user message
@@ -314,153 +317,74 @@ def run_gemini(wa_id, model, system_prompt, max_tokens=None, timezone=None, tool
             if parts:
                 contents.append(types.Content(role=gemini_role, parts=parts))
 
+    return contents
+
+
+async def _execute_function_call_async(wa_id, function_call, function_map):
+    """Execute a single Gemini function call; returns (response dict, audit body or None if nothing ran)."""
+    function_name = function_call.name
+    function_args = dict(function_call.args or {})
+    function = function_map.get(function_name)
+    if not function:
+        logging.error(f"Function {function_name} not found")
+        LLM_TOOL_EXECUTION_ERRORS.labels(tool_name=function_name, provider="gemini").inc()
+        return {"error": f"Function {function_name} not found"}, None
+    if "wa_id" in inspect.signature(function).parameters and "wa_id" not in function_args:
+        function_args["wa_id"] = wa_id
     try:
-        # Create function declarations
-        function_declarations = create_function_declarations(toolkit)
-
-        # Set up model parameters
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "top_k": 64,
-            "max_output_tokens": max_tokens if max_tokens else 4096,
-        }
+        result = await call_tool_async(function, function_args)
+    except Exception as e:
+        FUNCTION_ERRORS.labels(function=function_name).inc()
+        LLM_TOOL_EXECUTION_ERRORS.labels(tool_name=function_name, provider="gemini").inc()
+        logging.error(f"Error executing {function_name}: {e}", exc_info=True)
+        result = {"error": f"Error executing {function_name}: {str(e)}"}
+    return (result if isinstance(result, dict) else {"result": result}), tool_audit_body(result)
 
-        # Make request to Gemini API
-        logging.info(f"Making Gemini API request for {wa_id}")
 
-        # Create the model with the specified model name
-        model_instance = client.get_genai_model(model)
+@retry_decorator
+async def run_gemini_async(
+    wa_id, model, system_prompt, max_tokens=None, timezone=None, toolkit: ToolRegistry = DEFAULT_TOOL_REGISTRY
+):
+    """
+    Run Gemini with the conversation history on the google-genai async client (``client.aio``).
+    Function calls are answered with function_response parts; tools run as coroutines.
+    Returns (response_text, date_str, time_str) and raises for errors to enable retry functionality.
+    """
+    tz = timezone or "UTC"
+    context = await asyncio.to_thread(build_context, wa_id, "gemini")
+    schedule_summary_refresh(wa_id, context)
+    messages_history = context.messages
+    system_prompt = with_summary(system_prompt, context.summary)
+    contents = _build_contents(system_prompt, messages_history)
+    function_map = toolkit.functions
+    audit = ToolAuditLog(wa_id)
 
-        # Generate content with function calling
-        response = model_instance.generate_content(
-            contents,
-            generation_config=generation_config,
-            tools=[types.Tool(function_declarations=function_declarations)],
-        )
+    try:
+        generate_config = _generate_content_config(toolkit, max_tokens)
+        logging.info(f"Making Gemini API request for {wa_id}")
+        response = await _generate_content_async(model, contents, generate_config)
 
-        # Process function calls if present with maximum iteration limit to prevent infinite loops
         max_iterations = 10
         iteration_count = 0
-
-        while (
-            hasattr(response, "candidates")
-            and response.candidates
-            and hasattr(response.candidates[0], "function_calls")
-            and response.candidates[0].function_calls
-            and iteration_count < max_iterations
-        ):
+        while response.function_calls and iteration_count < max_iterations:
             iteration_count += 1
-            function_calls = response.candidates[0].function_calls
-            logging.info(
-                f"Gemini function call iteration {iteration_count}/{max_iterations}, processing {len(function_calls)} function calls"
-            )
-
-            # Process each function call
+            function_calls = response.function_calls
+            if response.candidates and response.candidates[0].content:
+                contents.append(response.candidates[0].content)
             for function_call in function_calls:
-                function_name = function_call.name
-                function_args = {}
-
-                # Extract function arguments
-                for arg_name, arg_value in function_call.args.items():
-                    function_args[arg_name] = arg_value
-
-                logging.info(f"Function call: {function_name} with args: {function_args}")
-                # Persist tool call (arguments)
-                try:
-                    pretty_args = json.dumps(function_args or {}, ensure_ascii=False, indent=2)
-                    from html import escape as _escape
-
-                    html_args = (
-                        f'<details class="details">'
-                        f"<summary>Tool: {function_name}</summary>"
-                        f'<div><pre><code class="language-json">{_escape(pretty_args)}</code></pre></div>'
-                        f"</details>"
-                    )
-                    d, t = parse_unix_timestamp(int(datetime.datetime.now(datetime.timezone.utc).timestamp()))
-                    append_message(wa_id, "tool", html_args, d, t)
-                except Exception as _persist_args_err:
-                    logging.error(f"Persist tool args failed for {function_name}: {_persist_args_err}")
-
-                # Execute the function if it exists
-                function = function_map.get(function_name)
-                if function:
-                    sig = inspect.signature(function)
-
-                    # Add wa_id if the function expects it
-                    if "wa_id" in sig.parameters and "wa_id" not in function_args:
-                        function_args["wa_id"] = wa_id
-
-                    try:
-                        # Execute function (async or sync)
-                        if inspect.iscoroutinefunction(function):
-                            result = asyncio.run(function(**function_args))
-                        else:
-                            result = function(**function_args)
-
-                        # Convert result to string if needed
-                        if isinstance(result, dict | list):
-                            result_str = json.dumps(result)
-                        else:
-                            result_str = str(result)
-
-                        # Log result (truncated for large outputs)
-                        logging.info(f"Function result: {result_str[:500]}...")
-
-                    except Exception as e:
-                        # Use both metrics for now during transition
-                        FUNCTION_ERRORS.labels(function=function_name).inc()
-                        LLM_TOOL_EXECUTION_ERRORS.labels(tool_name=function_name, provider="gemini").inc()
-                        result_str = f"Error executing {function_name}: {str(e)}"
-                        logging.error(result_str, exc_info=True)
-                else:
-                    result_str = f"Function {function_name} not found"
-                    logging.error(result_str)
-                    LLM_TOOL_EXECUTION_ERRORS.labels(tool_name=function_name, provider="gemini").inc()
-
-                # Add function call and result to conversation
-                contents.append(
-                    types.Content(
-                        role="model",
-                        parts=[
-                            types.Part.from_text(text=f"I need to call {function_name}({json.dumps(function_args)})")
-                        ],
-                    )
-                )
-
-                contents.append(
-                    types.Content(
-                        role="user",
-                        parts=[types.Part.from_text(text=f"Result of {function_name}: {result_str}")],
-                    )
-                )
-                # Persist tool result
-                try:
-                    from html import escape as _escape
-
-                    pretty_out = (
-                        result_str
-                        if isinstance(result_str, str)
-                        else json.dumps(result_str, ensure_ascii=False, indent=2)
-                    )
-                    html_out = (
-                        f'<details class="details">'
-                        f"<summary>Result: {function_name}</summary>"
-                        f'<div><pre><code class="language-json">{_escape(pretty_out)}</code></pre></div>'
-                        f"</details>"
-                    )
-                    d2, t2 = parse_unix_timestamp(int(datetime.datetime.now(datetime.timezone.utc).timestamp()))
-                    append_message(wa_id, "tool", html_out, d2, t2)
-                except Exception as _persist_out_err:
-                    logging.error(f"Persist tool result failed for {function_name}: {_persist_out_err}")
+                audit.add("Tool", function_call.name, tool_audit_body(dict(function_call.args or {})))
+            outcomes = await asyncio.gather(
+                *(_execute_function_call_async(wa_id, function_call, function_map) for function_call in function_calls)
+            )
+            parts = []
+            for function_call, (result, audit_body) in zip(function_calls, outcomes, strict=True):
+                if audit_body is not None:
+                    audit.add("Result", function_call.name, audit_body)
+                parts.append(types.Part.from_function_response(name=function_call.name, response=result))
+            contents.append(types.Content(role="user", parts=parts))
 
-            # Generate follow-up response
             try:
-                response = model_instance.generate_content(
-                    contents,
-                    generation_config=generation_config,
-                    tools=[types.Tool(function_declarations=function_declarations)],
-                )
+                response = await _generate_content_async(model, contents, generate_config)
             except Exception as e:
                 logging.error(f"Error generating Gemini follow-up response in iteration {iteration_count}: {e}")
                 break
@@ -469,32 +393,17 @@ def run_gemini(wa_id, model, system_prompt, max_tokens=None, timezone=None, tool
             logging.warning(
                 f"Gemini function call loop reached maximum iterations ({max_iterations}), breaking to prevent infinite loop"
             )
-        else:
-            logging.debug(f"Gemini function call loop completed after {iteration_count} iterations")
-
-        # Extract final text response
-        if hasattr(response, "text"):
-            final_response = response.text
-        elif hasattr(response, "candidates") and response.candidates and hasattr(response.candidates[0], "content"):
-            final_response = response.candidates[0].content.parts[0].text
-        else:
-            final_response = None
 
+        final_response = response.text
+        now = datetime.datetime.now(tz=ZoneInfo(tz))
+        date_str = now.strftime("%Y-%m-%d")
+        time_str = now.strftime("%H:%M:%S")
         if final_response:
-            # Generate current timestamp in the specified timezone
-            now = datetime.datetime.now(tz=ZoneInfo(tz))
-            date_str = now.strftime("%Y-%m-%d")
-            time_str = now.strftime("%H:%M:%S")
-
             logging.info(f"Generated message for {wa_id}: {final_response[:100]}...")
             return final_response, date_str, time_str
-        else:
-            logging.error("No text content in Gemini response")
-            LLM_EMPTY_RESPONSES.labels(provider="gemini", response_type="no_text_content").inc()
-            now = datetime.datetime.now(tz=ZoneInfo(tz))
-            date_str = now.strftime("%Y-%m-%d")
-            time_str = now.strftime("%H:%M:%S")
-            return None, date_str, time_str
+        logging.error("No text content in Gemini response")
+        LLM_EMPTY_RESPONSES.labels(provider="gemini", response_type="no_text_content").inc()
+        return None, date_str, time_str
 
     except Exception as e:
         error_type = map_gemini_error(e)
@@ -502,6 +411,43 @@ def run_gemini(wa_id, model, system_prompt, max_tokens=None, timezone=None, tool
             error_type = f"unknown::{type(e).__name__}"
         logging.error(f"GEMINI API ERROR for wa_id={wa_id}: {e} (type: {error_type})", exc_info=True)
         LLM_API_ERRORS.labels(provider="gemini", error_type=error_type).inc()
+        if tool_calls_ran():
+            # Retrying or deferring the turn would run its tools again
+            raise ToolCallsRanError(f"{type(e).__name__}: {e}") from e
         if _is_retryable_gemini_exception(e):
             LLM_RETRY_ATTEMPTS.labels(provider="gemini", error_type=error_type).inc()
         raise  # Re-raise for retry handling
+    finally:
+        await audit.aflush()
+
+
+async def _generate_content_async(model, contents, config):
+    """generate_content on the async client, admitted by the rate governor."""
+    tokens = estimate_tokens([config.system_instruction, contents], config.max_output_tokens)
+    async with rate_limited("gemini", model, tokens) as grant:
+        with api_call("gemini", model):
+            response = await client.aio.models.generate_content(model=model, contents=contents, config=config)
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            grant.settle(getattr(usage, "total_token_count", None))
+    _record_usage(model, response)
+    return response
+
+
+def _record_usage(model, response):
+    """Export token usage from ``usage_metadata``; thinking tokens are counted as output."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_token_count", None) or 0
+    cached = getattr(usage, "cached_content_token_count", None) or 0
+    output = (getattr(usage, "candidates_token_count", None) or 0) + (getattr(usage, "thoughts_token_count", None) or 0)
+    record_tokens("gemini", model, input=prompt_tokens - cached, output=output, cache_read=cached)
+
+
+async def complete_gemini_async(model, system_prompt, prompt, max_tokens=1024):
+    """Single tool-free completion (used for background housekeeping such as history summaries)."""
+    response = await _generate_content_async(
+        model, prompt, types.GenerateContentConfig(system_instruction=system_prompt, max_output_tokens=max_tokens)
+    )
+    return response.text or ""
@@ -2,49 +2,115 @@ import asyncio
 import datetime
 import json
 import logging
+import os
+import time
 from collections.abc import Awaitable
+from dataclasses import dataclass, field
 from typing import TYPE_CHECKING, Protocol, cast
 
-from sqlalchemy import func, select, update
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, exists, func, or_, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased
 
 if TYPE_CHECKING:
     pass
 
-from app.db import InboundMessageQueueModel, get_session
+from app.db import InboundMessageQueueModel, engine, get_session, psycopg_conninfo
+from app.decorators import RetryLaterError, ToolCallsRanError, retry_deadline
 from app.metrics import (
     INBOUND_QUEUE_CLAIM_FAILURES,
     INBOUND_QUEUE_CLAIMED,
+    INBOUND_QUEUE_COALESCED,
+    INBOUND_QUEUE_DEAD_LETTERED,
     INBOUND_QUEUE_ENQUEUE_DUPLICATE,
     INBOUND_QUEUE_ENQUEUED,
     INBOUND_QUEUE_LENGTH,
+    INBOUND_QUEUE_LISTENER_CONNECTED,
     INBOUND_QUEUE_OLDEST_AGE_SECONDS,
     INBOUND_QUEUE_PROCESSED,
     INBOUND_QUEUE_PROCESSING_ERRORS,
+    INBOUND_QUEUE_REPLIES_DEFERRED,
 )
 from app.services.llm_service import get_llm_service
-from app.utils.whatsapp_utils import process_whatsapp_message
+from app.utils.service_utils import retrieve_context_rows
+from app.utils.whatsapp_utils import ReplyFailedError, process_whatsapp_message, reply_to_conversation
 
 
 class _LLMRunner(Protocol):
     def run(self, wa_id: str) -> Awaitable[tuple[str | None, str, str]]: ...
 
 
-QUEUE_POLL_INTERVAL_SECONDS = 0.5  # tight loop with sleep; very low memory footprint
+QUEUE_POLL_INTERVAL_SECONDS = 0.5  # used only when LISTEN/NOTIFY is unavailable
+QUEUE_IDLE_FALLBACK_POLL_SECONDS = 30.0  # safety poll while LISTEN is connected (stale re-claims, missed notifies)
+QUEUE_METRICS_INTERVAL_SECONDS = 15.0
+QUEUE_LISTEN_RECONNECT_SECONDS = 5.0
+QUEUE_NOTIFY_CHANNEL = "inbound_message_queue"
 MAX_CLAIM_BATCH = 1  # claim strictly one item per worker iteration to keep memory low
 CLAIM_STALE_AFTER_SECONDS = 300  # re-claim abandoned items after 5 minutes
+CLAIM_HEARTBEAT_SECONDS = 60  # items being processed refresh locked_at this often, so only abandoned ones go stale
 MAX_PROCESSING_ATTEMPTS = 3
+RETRY_BACKOFF_BASE_SECONDS = 30  # failed items wait 30s, 60s, 120s, ... before the next attempt
+RETRY_BACKOFF_MAX_SECONDS = 3600
+RETENTION_DELETE_BATCH_SIZE = 5000
 
+try:
+    INBOUND_QUEUE_RETENTION_DAYS = int(os.environ.get("INBOUND_QUEUE_RETENTION_DAYS", "7"))
+except ValueError:
+    INBOUND_QUEUE_RETENTION_DAYS = 7
 
-def enqueue_inbound(payload: dict[str, object], message_id: str | None, wa_id: str | None) -> tuple[bool, int | None]:
+# When enabled (default), /webhook only verifies, enqueues and acks; workers do all processing.
+# Set INBOUND_QUEUE_ENABLED=false to fall back to in-process BackgroundTasks handling.
+INBOUND_QUEUE_ENABLED = os.environ.get("INBOUND_QUEUE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Set to false when the queue is consumed by standalone worker processes (python -m app.worker)
+INBOUND_QUEUE_IN_PROCESS_WORKERS = os.environ.get("INBOUND_QUEUE_IN_PROCESS_WORKERS", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# A customer's message is answered within this many seconds of being sent or not at all (dead letter).
+# LLM outages past the in-process retry budget are waited out by rescheduled reply jobs, not sleeping workers.
+try:
+    LLM_REPLY_DEADLINE_SECONDS = float(os.environ.get("LLM_REPLY_DEADLINE_SECONDS", "1800"))
+except ValueError:
+    LLM_REPLY_DEADLINE_SECONDS = 1800.0
+
+# Debounce window for rapid-fire text messages from one customer: consecutive pending messages
+# are answered in a single LLM turn once the customer has been quiet for this long (0 disables).
+try:
+    INBOUND_COALESCE_WINDOW_SECONDS = float(os.environ.get("INBOUND_COALESCE_WINDOW_SECONDS", "0"))
+except ValueError:
+    INBOUND_COALESCE_WINDOW_SECONDS = 0.0
+INBOUND_COALESCE_MAX_WAIT_SECONDS = max(INBOUND_COALESCE_WINDOW_SECONDS * 4, 10.0)
+INBOUND_COALESCE_MAX_MESSAGES = 10
+
+
+def extract_message_identity(body: dict[str, object]) -> tuple[str | None, str | None]:
+    """Return (message_id, wa_id) from a WhatsApp webhook payload, or Nones when absent."""
+    try:
+        value = body["entry"][0]["changes"][0]["value"]  # type: ignore[index]
+        message = value["messages"][0]
+        message_id = message.get("id")
+        contacts = value.get("contacts") or []
+        wa_id = (contacts[0].get("wa_id") if contacts else None) or message.get("from")
+        return (str(message_id) if message_id else None, str(wa_id) if wa_id else None)
+    except Exception:
+        return None, None
+
+
+def enqueue_inbound(
+    payload: dict[str, object], message_id: str | None, wa_id: str | None, payload_text: str | None = None
+) -> tuple[bool, int | None]:
     """
     Persist inbound webhook payload into the DB-backed queue.
+    payload_text, when given, is the original JSON body and is stored as-is instead of re-serializing payload.
     Returns (created, id) where created indicates new insert (False if duplicate by message_id).
     """
-    try:
-        payload_text = json.dumps(payload, ensure_ascii=False)
-    except Exception:
-        payload_text = str(payload)
+    if payload_text is None:
+        try:
+            payload_text = json.dumps(payload, ensure_ascii=False)
+        except Exception:
+            payload_text = str(payload)
 
     with get_session() as session:
         # De-duplicate by message_id when present
@@ -68,12 +134,76 @@ def enqueue_inbound(payload: dict[str, object], message_id: str | None, wa_id: s
             attempts=0,
         )
         session.add(row)
-        session.commit()
+        if _notify_supported():
+            # NOTIFY is transactional: listeners only see it once the row is committed
+            session.execute(
+                text("SELECT pg_notify(:channel, :payload)"), {"channel": QUEUE_NOTIFY_CHANNEL, "payload": wa_id or ""}
+            )
+        try:
+            session.commit()
+        except IntegrityError:
+            # Concurrent redelivery won the race on the unique message_id index
+            session.rollback()
+            INBOUND_QUEUE_ENQUEUE_DUPLICATE.labels(source="webhook").inc()
+            return False, None
         INBOUND_QUEUE_ENQUEUED.labels(source="webhook").inc()
         # Avoid strict typing on ORM identity; return None to keep API simple
         return True, None
 
 
+def _notify_supported() -> bool:
+    return engine.dialect.name == "postgresql"
+
+
+@dataclass
+class QueueWakeup:
+    """Wakes idle workers when the LISTEN connection receives a queue notification.
+
+    A semaphore (not an Event) so a notification arriving between a failed claim and the
+    wait is not lost; surplus permits only cost one empty claim each.
+    """
+
+    signal: asyncio.Semaphore = field(default_factory=lambda: asyncio.Semaphore(0))
+    listening: bool = False
+
+    def notify(self) -> None:
+        self.signal.release()
+
+    async def wait(self, stop_event: asyncio.Event) -> None:
+        if stop_event.is_set():
+            return
+        timeout = QUEUE_IDLE_FALLBACK_POLL_SECONDS if self.listening else QUEUE_POLL_INTERVAL_SECONDS
+        try:
+            await asyncio.wait_for(self.signal.acquire(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def notification_listener(stop_event: asyncio.Event, wakeup: QueueWakeup) -> None:
+    """Hold a dedicated LISTEN connection and wake one worker per queue notification."""
+    import psycopg
+
+    while not stop_event.is_set():
+        try:
+            conn = await psycopg.AsyncConnection.connect(psycopg_conninfo(), autocommit=True)
+            async with conn:
+                await conn.execute(f"LISTEN {QUEUE_NOTIFY_CHANNEL}")
+                wakeup.listening = True
+                INBOUND_QUEUE_LISTENER_CONNECTED.set(1)
+                # Catch up on anything enqueued while we were disconnected
+                wakeup.notify()
+                async for _notify in conn.notifies():
+                    wakeup.notify()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Inbound queue LISTEN connection failed: {e}")
+        finally:
+            wakeup.listening = False
+            INBOUND_QUEUE_LISTENER_CONNECTED.set(0)
+        await asyncio.sleep(QUEUE_LISTEN_RECONNECT_SECONDS)
+
+
 def _update_queue_metrics(session: Session) -> None:
     try:
         pending_count = (
@@ -106,27 +236,47 @@ def _update_queue_metrics(session: Session) -> None:
 
 
 def _claim_one(session: Session) -> InboundMessageQueueModel | None:
+    """Claim the next item while keeping each wa_id strictly ordered across workers and processes.
+
+    A pending row is eligible only if it is the oldest pending row of its wa_id and that wa_id has
+    no row in "processing". Concurrent claimers either still see the older row as pending or see it
+    as processing, so a customer is never claimed twice; other customers are picked up in parallel.
+    A row waiting out its retry backoff (``next_attempt_at``) also holds back its customer's later rows.
+    """
     now = datetime.datetime.utcnow()
     stale_cutoff = now - datetime.timedelta(seconds=CLAIM_STALE_AFTER_SECONDS)
 
-    # Try to claim a pending item
+    # Re-claim abandoned items first so their conversation is not blocked behind them
     row = session.execute(
         select(InboundMessageQueueModel)
-        .where(InboundMessageQueueModel.status == "pending")
-        .order_by(InboundMessageQueueModel.created_at.asc())
+        .where(
+            InboundMessageQueueModel.status == "processing",
+            InboundMessageQueueModel.locked_at < stale_cutoff,
+        )
+        .order_by(InboundMessageQueueModel.locked_at.asc())
         .with_for_update(skip_locked=True)
         .limit(1)
     ).scalar_one_or_none()
 
     if row is None:
-        # Try to re-claim stale processing items
+        busy = aliased(InboundMessageQueueModel)
+        earlier = aliased(InboundMessageQueueModel)
         row = session.execute(
             select(InboundMessageQueueModel)
             .where(
-                InboundMessageQueueModel.status == "processing",
-                InboundMessageQueueModel.locked_at < stale_cutoff,
+                InboundMessageQueueModel.status == "pending",
+                or_(
+                    InboundMessageQueueModel.next_attempt_at.is_(None),
+                    InboundMessageQueueModel.next_attempt_at <= now,
+                ),
+                ~exists().where(busy.wa_id == InboundMessageQueueModel.wa_id, busy.status == "processing"),
+                ~exists().where(
+                    earlier.wa_id == InboundMessageQueueModel.wa_id,
+                    earlier.status == "pending",
+                    earlier.id < InboundMessageQueueModel.id,
+                ),
             )
-            .order_by(InboundMessageQueueModel.locked_at.asc())
+            .order_by(InboundMessageQueueModel.created_at.asc(), InboundMessageQueueModel.id.asc())
             .with_for_update(skip_locked=True)
             .limit(1)
         ).scalar_one_or_none()
@@ -150,60 +300,427 @@ def _claim_one(session: Session) -> InboundMessageQueueModel | None:
         return None
 
 
-async def worker_loop(stop_event: asyncio.Event) -> None:
-    """Simple worker loop: claim one item, process, repeat with small sleep."""
-    llm_service = cast(_LLMRunner, get_llm_service())
+async def queue_metrics_sampler(stop_event: asyncio.Event) -> None:
+    """Refresh queue length/age gauges periodically from a single task per process."""
     while not stop_event.is_set():
         try:
             with get_session() as session:
                 _update_queue_metrics(session)
-                item = _claim_one(session)
-                if item is None:
-                    await asyncio.sleep(QUEUE_POLL_INTERVAL_SECONDS)
-                    continue
-
-                payload_text: str = str(getattr(item, "payload", ""))
-                try:
-                    decoded = json.loads(payload_text)
-                    payload_obj = decoded if isinstance(decoded, dict) else {"_raw": decoded}
-                except Exception:
-                    payload_obj = {"_raw": payload_text}
-
-                try:
-                    # Process and mark done/failed
-                    await process_whatsapp_message(payload_obj, llm_service.run)  # type: ignore[no-untyped-call]
-                    session.execute(
-                        update(InboundMessageQueueModel)
-                        .where(InboundMessageQueueModel.id == item.id)
-                        .values(status="done", locked_at=None)
+        except Exception as e:
+            logging.debug(f"Inbound queue metrics sampling failed: {e}")
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=QUEUE_METRICS_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            continue
+
+
+def _decode_payload(item: InboundMessageQueueModel) -> dict[str, object]:
+    payload_text: str = str(getattr(item, "payload", ""))
+    try:
+        decoded = json.loads(payload_text)
+        return decoded if isinstance(decoded, dict) else {"_raw": decoded}
+    except Exception:
+        return {"_raw": payload_text}
+
+
+def _is_text_message(payload: dict[str, object]) -> bool:
+    try:
+        message = payload["entry"][0]["changes"][0]["value"]["messages"][0]  # type: ignore[index]
+        return bool(message["text"]["body"])
+    except Exception:
+        return False
+
+
+async def _await_quiet_period(wa_id: str) -> None:
+    """Wait until no new message arrived for wa_id within the coalescing window (bounded)."""
+    deadline = asyncio.get_running_loop().time() + INBOUND_COALESCE_MAX_WAIT_SECONDS
+    while True:
+        with get_session() as session:
+            # Compare in DB time: created_at is written with the server clock
+            db_now, newest = session.execute(
+                select(func.localtimestamp(), func.max(InboundMessageQueueModel.created_at)).where(
+                    InboundMessageQueueModel.wa_id == wa_id
+                )
+            ).one()
+        if newest is None:
+            return
+        quiet_for = (db_now - newest).total_seconds()
+        remaining = INBOUND_COALESCE_WINDOW_SECONDS - quiet_for
+        budget = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0 or budget <= 0:
+            return
+        await asyncio.sleep(min(remaining, budget))
+
+
+def _message_timestamp(payload: dict[str, object]) -> float | None:
+    try:
+        return float(payload["entry"][0]["changes"][0]["value"]["messages"][0]["timestamp"])  # type: ignore[index]
+    except Exception:
+        return None
+
+
+def _deferred_reply(payload: dict[str, object]) -> dict[str, object] | None:
+    """The reply job inside a queue payload written by ``_defer_reply``, if this item is one."""
+    job = payload.get("deferred_reply")
+    return job if isinstance(job, dict) else None
+
+
+def _defer_reply(
+    session: Session,
+    items: list[InboundMessageQueueModel],
+    wa_id: str,
+    deadline: float,
+    deferrals: int,
+    retry_after: float | None,
+) -> None:
+    """Hand an unanswered turn back to the queue as a reply job scheduled for a later attempt.
+
+    The customer's messages are already stored, so ``items`` are done; the new pending row only runs the
+    LLM over the conversation. Past the reply deadline the turn is dead-lettered instead.
+    """
+    delay = retry_after if retry_after is not None else _retry_delay_seconds(deferrals + 1)
+    retry_at = time.time() + delay
+    now = datetime.datetime.utcnow()
+    ids = [item.id for item in items]
+    if retry_at > deadline:
+        _dead_letter(session, items, "LLM reply deadline exceeded")
+        return
+    session.execute(
+        update(InboundMessageQueueModel)
+        .where(InboundMessageQueueModel.id.in_(ids))
+        .values(status="done", locked_at=None, next_attempt_at=None, last_error=None)
+    )
+    job = {"wa_id": wa_id, "deadline": deadline, "deferrals": deferrals + 1}
+    session.add(
+        InboundMessageQueueModel(
+            message_id=None,
+            wa_id=wa_id,
+            payload=json.dumps({"deferred_reply": job}),
+            status="pending",
+            attempts=0,
+            next_attempt_at=now + datetime.timedelta(seconds=delay),
+        )
+    )
+    session.commit()
+    INBOUND_QUEUE_REPLIES_DEFERRED.inc()
+
+
+def _dead_letter(session: Session, items: list[InboundMessageQueueModel], error: str) -> None:
+    """Fail ``items`` right away, whatever their attempt count; only a manual replay runs them again."""
+    session.execute(
+        update(InboundMessageQueueModel)
+        .where(InboundMessageQueueModel.id.in_([item.id for item in items]))
+        .values(status="failed", locked_at=None, next_attempt_at=None, last_error=error)
+    )
+    session.commit()
+    INBOUND_QUEUE_DEAD_LETTERED.inc(len(items))
+
+
+def _awaits_reply(wa_id: str) -> bool:
+    """True while the newest message of the conversation is still the customer's."""
+    rows = retrieve_context_rows(wa_id)
+    return bool(rows) and rows[-1][1] == "user"
+
+
+def _claim_followups(session: Session, item: InboundMessageQueueModel) -> list[InboundMessageQueueModel]:
+    """Claim the consecutive pending text messages queued after item for the same wa_id."""
+    rows = (
+        session.execute(
+            select(InboundMessageQueueModel)
+            .where(
+                InboundMessageQueueModel.wa_id == item.wa_id,
+                InboundMessageQueueModel.status == "pending",
+                InboundMessageQueueModel.id > item.id,
+            )
+            .order_by(InboundMessageQueueModel.id.asc())
+            .with_for_update(skip_locked=True)
+            .limit(INBOUND_COALESCE_MAX_MESSAGES - 1)
+        )
+        .scalars()
+        .all()
+    )
+    followups: list[InboundMessageQueueModel] = []
+    for row in rows:
+        # Stop at the first non-text message so media keeps its own reply, in order
+        if not _is_text_message(_decode_payload(row)):
+            break
+        followups.append(row)
+    if not followups:
+        session.rollback()
+        return []
+    now = datetime.datetime.utcnow()
+    for row in followups:
+        session.execute(
+            update(InboundMessageQueueModel)
+            .where(InboundMessageQueueModel.id == row.id)
+            .values(status="processing", locked_at=now, attempts=row.attempts + 1)
+        )
+    session.commit()
+    return followups
+
+
+async def _heartbeat(items: list[InboundMessageQueueModel]) -> None:
+    """Refresh ``locked_at`` of the claimed items (coalesced ones included) until cancelled.
+
+    A turn may outlive ``CLAIM_STALE_AFTER_SECONDS`` (coalescing wait, retries, failover, rate governor
+    queueing); without the refresh another worker would re-claim it and answer the customer concurrently.
+    """
+    while True:
+        await asyncio.sleep(CLAIM_HEARTBEAT_SECONDS)
+        try:
+            with get_session() as session:
+                session.execute(
+                    update(InboundMessageQueueModel)
+                    .where(
+                        InboundMessageQueueModel.id.in_([item.id for item in items]),
+                        InboundMessageQueueModel.status == "processing",
                     )
-                    session.commit()
-                    INBOUND_QUEUE_PROCESSED.inc()
-                except Exception as e:
-                    logging.error(f"Inbound queue item {item.id} failed: {e}")
-                    if (item.attempts or 0) + 1 >= MAX_PROCESSING_ATTEMPTS:
-                        # give up
-                        try:
-                            session.execute(
-                                update(InboundMessageQueueModel)
-                                .where(InboundMessageQueueModel.id == item.id)
-                                .values(status="failed", locked_at=None)
-                            )
-                            session.commit()
-                        except Exception:
-                            session.rollback()
-                    else:
-                        # Return to pending for retry later
-                        try:
-                            session.execute(
-                                update(InboundMessageQueueModel)
-                                .where(InboundMessageQueueModel.id == item.id)
-                                .values(status="pending", locked_at=None)
-                            )
-                            session.commit()
-                        except Exception:
-                            session.rollback()
-                    INBOUND_QUEUE_PROCESSING_ERRORS.inc()
+                    .values(locked_at=datetime.datetime.utcnow())
+                )
+                session.commit()
+        except Exception as e:
+            logging.warning(f"Inbound queue heartbeat failed for items {[item.id for item in items]}: {e}")
+
+
+def _mark_messages_stored(session: Session, items: list[InboundMessageQueueModel]) -> None:
+    """Flag items whose messages made it into the conversation, so their retries only run the reply."""
+    for item in items:
+        payload = _decode_payload(item)
+        payload["messages_stored"] = True
+        session.execute(
+            update(InboundMessageQueueModel)
+            .where(InboundMessageQueueModel.id == item.id)
+            .values(payload=json.dumps(payload, ensure_ascii=False))
+        )
+    session.commit()
+
+
+def _retry_delay_seconds(attempts: int) -> float:
+    """Exponential backoff for the retry after the given number of failed attempts."""
+    return float(min(RETRY_BACKOFF_BASE_SECONDS * (2 ** max(0, attempts - 1)), RETRY_BACKOFF_MAX_SECONDS))
+
+
+def _finish_items(
+    session: Session, items: list[InboundMessageQueueModel], succeeded: bool, error: str | None = None
+) -> None:
+    now = datetime.datetime.utcnow()
+    for item in items:
+        attempts = item.attempts or 0  # the claim's UPDATE already counted this attempt on the loaded item
+        values: dict[str, object] = {"locked_at": None}
+        if succeeded:
+            values.update(status="done", next_attempt_at=None, last_error=None)
+        elif attempts >= MAX_PROCESSING_ATTEMPTS:
+            values.update(status="failed", next_attempt_at=None, last_error=error)  # dead letter
+            INBOUND_QUEUE_DEAD_LETTERED.inc()
+        else:
+            # Return to pending, but only claimable once the backoff has elapsed
+            next_attempt_at = now + datetime.timedelta(seconds=_retry_delay_seconds(attempts))
+            values.update(status="pending", next_attempt_at=next_attempt_at, last_error=error)
+        try:
+            session.execute(
+                update(InboundMessageQueueModel).where(InboundMessageQueueModel.id == item.id).values(**values)
+            )
+            session.commit()
+        except Exception:
+            session.rollback()
+
+
+def _notify_workers(session: Session) -> None:
+    if _notify_supported():
+        session.execute(text("SELECT pg_notify(:channel, '')"), {"channel": QUEUE_NOTIFY_CHANNEL})
+
+
+def list_dead_letters(limit: int = 100) -> list[dict[str, object]]:
+    """Return the most recent dead-lettered (failed) items, newest first."""
+    with get_session() as session:
+        rows = (
+            session.execute(
+                select(InboundMessageQueueModel)
+                .where(InboundMessageQueueModel.status == "failed")
+                .order_by(InboundMessageQueueModel.id.desc())
+                .limit(limit)
+            )
+            .scalars()
+            .all()
+        )
+        return [
+            {
+                "id": row.id,
+                "message_id": row.message_id,
+                "wa_id": row.wa_id,
+                "attempts": row.attempts,
+                "last_error": row.last_error,
+                "created_at": row.created_at.isoformat() if row.created_at else None,
+                "updated_at": row.updated_at.isoformat() if row.updated_at else None,
+            }
+            for row in rows
+        ]
+
+
+def replay_dead_letters(ids: list[int] | None = None) -> int:
+    """Move failed items (all, or the given ids) back to pending with a fresh attempt budget."""
+    stmt = (
+        update(InboundMessageQueueModel)
+        .where(InboundMessageQueueModel.status == "failed")
+        .values(status="pending", attempts=0, next_attempt_at=None, locked_at=None, last_error=None)
+    )
+    if ids is not None:
+        stmt = stmt.where(InboundMessageQueueModel.id.in_(ids))
+    with get_session() as session:
+        replayed = int(session.execute(stmt).rowcount or 0)
+        if replayed:
+            _notify_workers(session)
+        session.commit()
+    return replayed
+
+
+def purge_dead_letters(ids: list[int] | None = None) -> int:
+    """Delete failed items (all, or the given ids)."""
+    stmt = delete(InboundMessageQueueModel).where(InboundMessageQueueModel.status == "failed")
+    if ids is not None:
+        stmt = stmt.where(InboundMessageQueueModel.id.in_(ids))
+    with get_session() as session:
+        purged = int(session.execute(stmt).rowcount or 0)
+        session.commit()
+    return purged
+
+
+def purge_done_items(
+    retention_days: int = INBOUND_QUEUE_RETENTION_DAYS, batch_size: int = RETENTION_DELETE_BATCH_SIZE
+) -> int:
+    """Delete done items older than retention_days in small batches to keep locks and WAL bursts short."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+    total = 0
+    while True:
+        batch_ids = (
+            select(InboundMessageQueueModel.id)
+            .where(InboundMessageQueueModel.status == "done", InboundMessageQueueModel.created_at < cutoff)
+            .limit(batch_size)
+            .scalar_subquery()
+        )
+        with get_session() as session:
+            deleted = int(
+                session.execute(
+                    delete(InboundMessageQueueModel)
+                    .where(InboundMessageQueueModel.id.in_(batch_ids))
+                    .execution_options(synchronize_session=False)
+                ).rowcount
+                or 0
+            )
+            session.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+async def _process_claimed(
+    item: InboundMessageQueueModel, items: list[InboundMessageQueueModel], llm_service: _LLMRunner
+) -> None:
+    """Answer a claimed item (and the text messages coalesced into ``items`` after it), then record the outcome.
+
+    Failures are retried with backoff and dead-lettered after ``MAX_PROCESSING_ATTEMPTS``. When the reply
+    failed after the messages were stored, the retries answer the stored conversation instead of storing
+    the messages again. A reply that failed after its turn ran tools is dead-lettered at once.
+    """
+    payloads = [_decode_payload(item)]
+    stored = bool(payloads[0].get("messages_stored"))
+    if INBOUND_COALESCE_WINDOW_SECONDS > 0 and item.wa_id and not stored and _is_text_message(payloads[0]):
+        try:
+            await _await_quiet_period(str(item.wa_id))
+            with get_session() as session:
+                followups = _claim_followups(session, item)
+        except Exception as e:
+            logging.warning(f"Inbound queue coalescing skipped for item {item.id}: {e}")
+            followups = []
+        if followups:
+            items.extend(followups)
+            payloads.extend(_decode_payload(row) for row in followups)
+            INBOUND_QUEUE_COALESCED.inc(len(followups))
+
+    job = _deferred_reply(payloads[0])
+    wa_id = str(item.wa_id or (job or {}).get("wa_id") or "")
+    if job is not None:
+        deadline = float(job.get("deadline") or 0)
+        deferrals = int(job.get("deferrals") or 0)
+    else:
+        deadline = (_message_timestamp(payloads[-1]) or time.time()) + LLM_REPLY_DEADLINE_SECONDS
+        deferrals = 0
+
+    error: str | None = None
+    reply_failed = False
+    try:
+        # In-process retries never outlive the customer's reply deadline
+        with retry_deadline(deadline - time.time()):
+            if job is not None or stored:
+                # A newer turn may have answered the conversation in the meantime
+                if await asyncio.to_thread(_awaits_reply, wa_id):
+                    await reply_to_conversation(wa_id, llm_service.run)
+            else:
+                # Earlier messages are stored as-is; the LLM answers them all with the last one.
+                # enqueue_inbound already rejected duplicate message ids via the unique index.
+                await process_whatsapp_message(  # type: ignore[no-untyped-call]
+                    payloads[-1], llm_service.run, preceding_bodies=payloads[:-1], deduplicated=True, raise_errors=True
+                )
+        succeeded = True
+    except RetryLaterError as e:
+        logging.warning(f"LLM reply for wa_id={wa_id} deferred ({e}); items {[i.id for i in items]}")
+        with get_session() as session:
+            _defer_reply(session, items, wa_id, deadline, deferrals, e.retry_after)
+        return
+    except ToolCallsRanError as e:
+        # The turn's tools already ran: another attempt would book, modify or cancel a second time
+        logging.error(
+            f"LLM reply for wa_id={wa_id} failed after running tools, not retried; items {[i.id for i in items]}: {e}"
+        )
+        with get_session() as session:
+            if job is None and not stored:
+                _mark_messages_stored(session, items)
+            _dead_letter(session, items, f"{type(e).__name__}: {e}")
+        INBOUND_QUEUE_PROCESSING_ERRORS.inc()
+        return
+    except Exception as e:
+        logging.error(f"Inbound queue item(s) {[i.id for i in items]} failed: {e}")
+        succeeded = False
+        error = f"{type(e).__name__}: {e}"
+        reply_failed = isinstance(e, ReplyFailedError) and job is None and not stored
+
+    with get_session() as session:
+        if reply_failed:
+            _mark_messages_stored(session, items)
+        _finish_items(session, items, succeeded=succeeded, error=error)
+    if succeeded:
+        INBOUND_QUEUE_PROCESSED.inc(len(items))
+    else:
+        INBOUND_QUEUE_PROCESSING_ERRORS.inc()
+
+
+async def worker_loop(stop_event: asyncio.Event, wakeup: QueueWakeup | None = None) -> None:
+    """Worker loop: claim one item and process it; when idle, block until notified or the fallback poll.
+
+    With coalescing enabled, a text message waits for the customer's quiet period and is answered
+    together with the text messages queued right after it in a single LLM turn.
+
+    The claim, the processing and the final status update each use their own short-lived session and
+    no session is held across an ``await``: the LLM call may run for minutes, and the scoped session
+    is shared by every task on the event loop thread. While the turn runs, a heartbeat keeps the claim
+    fresh so that only items of a dead worker are re-claimed.
+    """
+    llm_service = cast(_LLMRunner, get_llm_service())
+    wakeup = wakeup or QueueWakeup()
+    while not stop_event.is_set():
+        try:
+            with get_session() as session:
+                item = _claim_one(session)
+            if item is None:
+                await wakeup.wait(stop_event)
+                continue
+
+            items = [item]
+            heartbeat = asyncio.create_task(_heartbeat(items))
+            try:
+                await _process_claimed(item, items, llm_service)
+            finally:
+                heartbeat.cancel()
         except Exception as loop_err:
             logging.error(f"Inbound worker loop error: {loop_err}")
             await asyncio.sleep(QUEUE_POLL_INTERVAL_SECONDS)
@@ -211,9 +728,13 @@ async def worker_loop(stop_event: asyncio.Event) -> None:
 
 def spawn_workers(num_workers: int) -> tuple[asyncio.Event, list[asyncio.Task[None]]]:
     stop_event: asyncio.Event = asyncio.Event()
+    wakeup = QueueWakeup()
     tasks: list[asyncio.Task[None]] = []
+    if _notify_supported():
+        tasks.append(asyncio.create_task(notification_listener(stop_event, wakeup)))
+    tasks.append(asyncio.create_task(queue_metrics_sampler(stop_event)))
     for _ in range(max(1, int(num_workers))):
-        tasks.append(asyncio.create_task(worker_loop(stop_event)))
+        tasks.append(asyncio.create_task(worker_loop(stop_event, wakeup)))
     return stop_event, tasks
 
 
@@ -0,0 +1,142 @@
+"""Per-turn LLM instrumentation: where the reply time of a turn goes.
+
+A turn is one ``run`` of an LLM service and is opened with ``llm_turn``. Provider helpers time every
+model round trip with ``api_call`` and report usage with ``record_tokens``; the toolkit times each tool
+call with ``timed_tool``. Everything is exported on ``/metrics`` and summarized in one structured
+``llm_turn`` log record per turn (logger ``app.llm_turns``), e.g.::
+
+    llm_turn {"wa_id": "9665...", "provider": "anthropic", "model": "claude-...", "outcome": "ok",
+              "seconds": 6.2, "api_calls": 2, "api_seconds": 5.1, "tool_calls": 1, "tool_seconds": 0.9,
+              "tokens": {"input": 812, "cache_read": 3900, "output": 160}}
+
+Token kinds are input (not served from a prompt cache), output, cache_read and cache_write.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import time
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+
+from app.metrics import LLM_API_CALL_SECONDS, LLM_TOKENS, LLM_TOOL_SECONDS, LLM_TURN_ROUND_TRIPS, LLM_TURN_SECONDS
+
+_turn_logger = logging.getLogger("app.llm_turns")
+
+
+@dataclass
+class TurnRecord:
+    """Totals of one turn; only updated from the event loop running it (sync tools are timed around to_thread)."""
+
+    wa_id: str
+    service: str
+    started: float
+    provider: str | None = None
+    model: str | None = None
+    api_calls: int = 0
+    api_seconds: float = 0.0
+    tool_calls: int = 0
+    tool_seconds: float = 0.0
+    tokens: dict[str, int] = field(default_factory=dict)
+
+    def fields(self, outcome: str, seconds: float) -> dict[str, object]:
+        return {
+            "wa_id": self.wa_id,
+            "provider": self.provider or self.service,
+            "model": self.model,
+            "outcome": outcome,
+            "seconds": round(seconds, 3),
+            "api_calls": self.api_calls,
+            "api_seconds": round(self.api_seconds, 3),
+            "tool_calls": self.tool_calls,
+            "tool_seconds": round(self.tool_seconds, 3),
+            "tokens": dict(self.tokens),
+        }
+
+
+_current_turn: contextvars.ContextVar[TurnRecord | None] = contextvars.ContextVar("llm_turn", default=None)
+
+
+@contextlib.contextmanager
+def llm_turn(wa_id: str, service: str) -> Iterator[TurnRecord]:
+    """Measure one turn; a turn opened inside another (a routed provider attempt) is part of the outer one."""
+    outer = _current_turn.get()
+    if outer is not None:
+        yield outer
+        return
+    record = TurnRecord(wa_id, service, time.monotonic())
+    token = _current_turn.set(record)
+    outcome = "ok"
+    try:
+        yield record
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        _current_turn.reset(token)
+        seconds = time.monotonic() - record.started
+        provider = record.provider or service
+        LLM_TURN_SECONDS.labels(provider=provider, outcome=outcome).observe(seconds)
+        LLM_TURN_ROUND_TRIPS.labels(provider=provider).observe(record.api_calls)
+        fields = record.fields(outcome, seconds)
+        _turn_logger.info("llm_turn %s", json.dumps(fields, ensure_ascii=False), extra={"llm_turn": fields})
+
+
+@contextlib.contextmanager
+def detach_turn() -> Iterator[None]:
+    """Keep background work started from a turn (history summaries) out of its record."""
+    token = _current_turn.set(None)
+    try:
+        yield
+    finally:
+        _current_turn.reset(token)
+
+
+@contextlib.contextmanager
+def api_call(provider: str, model: str) -> Iterator[None]:
+    """Time one model round trip (a streamed call until its final message)."""
+    started = time.monotonic()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        seconds = time.monotonic() - started
+        LLM_API_CALL_SECONDS.labels(provider=provider, model=model, outcome=outcome).observe(seconds)
+        record = _current_turn.get()
+        if record is not None:
+            record.provider, record.model = provider, model
+            record.api_calls += 1
+            record.api_seconds += seconds
+
+
+def record_tokens(provider: str, model: str, **tokens: int | None) -> None:
+    """Count reported usage by kind (input, output, cache_read, cache_write); missing kinds are skipped."""
+    record = _current_turn.get()
+    for kind, count in tokens.items():
+        if not count:
+            continue
+        LLM_TOKENS.labels(provider=provider, model=model, kind=kind).inc(count)
+        if record is not None:
+            record.tokens[kind] = record.tokens.get(kind, 0) + count
+
+
+@contextlib.contextmanager
+def timed_tool(name: str) -> Iterator[None]:
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - started
+        LLM_TOOL_SECONDS.labels(tool=name).observe(seconds)
+        record = _current_turn.get()
+        if record is not None:
+            record.tool_calls += 1
+            record.tool_seconds += seconds
@@ -0,0 +1,97 @@
+"""Per-provider health and latency stats that drive LLM failover and hedging.
+
+Routing is enabled by listing secondary providers in LLM_FALLBACK_PROVIDERS (e.g. "openai,gemini").
+A provider that fails LLM_FAILOVER_ERROR_BUDGET turns in a row is skipped for
+LLM_FAILOVER_COOLDOWN_SECONDS, after which a single turn probes it again. With LLM_HEDGE_ENABLED a second
+provider is started when the first has not answered within its observed p95 turn latency.
+"""
+
+import math
+import os
+import time
+from collections import deque
+from collections.abc import Iterable
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+
+LLM_FALLBACK_PROVIDERS = [
+    p.strip().lower() for p in os.environ.get("LLM_FALLBACK_PROVIDERS", "").split(",") if p.strip()
+]
+# Wall-clock limit of one provider attempt at a turn (tool calls included) before failing over
+LLM_FAILOVER_TIMEOUT_SECONDS = _env_float("LLM_FAILOVER_TIMEOUT_SECONDS", 120)
+LLM_FAILOVER_ERROR_BUDGET = max(int(_env_float("LLM_FAILOVER_ERROR_BUDGET", 3)), 1)
+LLM_FAILOVER_COOLDOWN_SECONDS = _env_float("LLM_FAILOVER_COOLDOWN_SECONDS", 60)
+LLM_HEDGE_ENABLED = os.environ.get("LLM_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+# The p95 is only trusted once this many turns were observed; until then requests are not hedged
+LLM_HEDGE_MIN_SAMPLES = max(int(_env_float("LLM_HEDGE_MIN_SAMPLES", 20)), 1)
+LLM_HEDGE_MIN_DELAY_SECONDS = _env_float("LLM_HEDGE_MIN_DELAY_SECONDS", 2)
+LLM_ROUTING_STATS_WINDOW = max(int(_env_float("LLM_ROUTING_STATS_WINDOW", 200)), 1)
+
+
+class ProviderStats:
+    """Rolling latency/outcome window of one provider. Only touched from the event loop."""
+
+    def __init__(self, window: int = LLM_ROUTING_STATS_WINDOW) -> None:
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.tripped_until = 0.0
+
+    def record_success(self, latency: float) -> None:
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        self.tripped_until = 0.0
+
+    def record_failure(self, now: float | None = None) -> None:
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= LLM_FAILOVER_ERROR_BUDGET:
+            self.tripped_until = (now if now is not None else time.monotonic()) + LLM_FAILOVER_COOLDOWN_SECONDS
+
+    def available(self, now: float | None = None) -> bool:
+        return (now if now is not None else time.monotonic()) >= self.tripped_until
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def p95(self) -> float | None:
+        if len(self.latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+
+    def hedge_delay(self) -> float | None:
+        """Seconds to wait for this provider before starting a hedge, or None when not warmed up."""
+        p95 = self.p95()
+        return None if p95 is None else max(p95, LLM_HEDGE_MIN_DELAY_SECONDS)
+
+
+_provider_stats: dict[str, ProviderStats] = {}
+
+
+def provider_stats(provider: str) -> ProviderStats:
+    stats = _provider_stats.get(provider)
+    if stats is None:
+        stats = _provider_stats[provider] = ProviderStats()
+    return stats
+
+
+def reset_provider_stats() -> None:
+    _provider_stats.clear()
+
+
+def route_order(providers: Iterable[str]) -> list[str]:
+    """Configured order with providers over their error budget moved last (still tried as a last resort)."""
+    now = time.monotonic()
+    providers = list(dict.fromkeys(providers))
+    healthy = [p for p in providers if provider_stats(p).available(now)]
+    return healthy + [p for p in providers if p not in healthy]
@@ -1,13 +1,32 @@
 # app/services/llm_service.py
 import abc
+import asyncio
 import logging
+import time
 
 from app.config import config, get
-from app.services.anthropic_service import run_claude
+from app.decorators import ToolCallsRanError, retry_decorator
+from app.metrics import LLM_HEDGED_REQUESTS, LLM_PROVIDER_ATTEMPTS, LLM_PROVIDER_FAILOVERS
+from app.services.anthropic_service import complete_claude_async, run_claude_async
 from app.services.domain.config.config_service import get_config
-from app.services.gemini_service import run_gemini
-from app.services.openai_service import run_openai
+from app.services.gemini_service import complete_gemini_async, run_gemini_async
+from app.services.llm_instrumentation import llm_turn
+from app.services.llm_routing import (
+    LLM_FAILOVER_TIMEOUT_SECONDS,
+    LLM_FALLBACK_PROVIDERS,
+    LLM_HEDGE_ENABLED,
+    provider_stats,
+    route_order,
+)
+from app.services.openai_service import complete_openai_async, run_openai_async
+from app.services.toolkit.execution import ToolCallClaim, claim_tool_calls, claim_turn_tool_calls
 from app.services.toolkit.registry import DEFAULT_TOOL_REGISTRY, ToolRegistry
+from app.utils.reply_stream import (
+    LLM_STREAM_ENABLED,
+    ReplyInterruptedError,
+    activate_reply_stream,
+    active_reply_stream,
+)
 
 
 class BaseLLMService(abc.ABC):
@@ -23,7 +42,8 @@ class BaseLLMService(abc.ABC):
         self.system_prompt = system_prompt or config.get("SYSTEM_PROMPT")
         self.max_tokens = 4096
         self.timezone = config.get("TIMEZONE", "UTC")
-        self.stream = False
+        # Stream replies into the caller's reply stream (Claude and OpenAI); see app.utils.reply_stream
+        self.stream = LLM_STREAM_ENABLED
 
         # Default LLM-specific configurations
         # Claude
@@ -44,54 +64,228 @@ class BaseLLMService(abc.ABC):
         self.openai_text_format = "text"
         self.openai_store = True
 
+        # Smaller models for background housekeeping (rolling history summaries)
+        self.claude_summary_model = "claude-3-5-haiku-latest"
+        self.gemini_summary_model = "gemini-2.0-flash"
+        self.openai_summary_model = "gpt-5-mini"
+
     @abc.abstractmethod
-    def run(self, wa_id: str):
+    async def run(self, wa_id: str, *, retry: bool = True):
         """
         Execute the LLM request using the service and return a tuple (response_text, date_str, time_str).
+
+        Runs on the event loop: provider calls use async clients and tools never block the loop.
+        With ``retry=False`` a single attempt is made and errors are raised immediately (used by routing).
+        """
+        pass
+
+    @abc.abstractmethod
+    async def complete(self, system_prompt: str, prompt: str, max_tokens: int = 1024) -> str:
+        """
+        Run a single tool-free completion with the provider's summary model and return its text.
         """
         pass
 
 
 class AnthropicService(BaseLLMService):
-    def run(self, wa_id: str):
-        return run_claude(
-            wa_id=wa_id,
-            model=self.claude_model,
-            system_prompt=self.system_prompt,
-            max_tokens=self.max_tokens,
-            thinking=self.claude_thinking,
-            stream=self.stream,
-            timezone=self.timezone,
-            toolkit=self.toolkit,
-        )
+    async def run(self, wa_id: str, *, retry: bool = True):
+        runner = run_claude_async if retry else run_claude_async.__wrapped__
+        with llm_turn(wa_id, "anthropic"), claim_turn_tool_calls("anthropic"):
+            return await runner(
+                wa_id=wa_id,
+                model=self.claude_model,
+                system_prompt=self.system_prompt,
+                max_tokens=self.max_tokens,
+                thinking=self.claude_thinking,
+                stream=self.stream,
+                timezone=self.timezone,
+                toolkit=self.toolkit,
+            )
+
+    async def complete(self, system_prompt: str, prompt: str, max_tokens: int = 1024) -> str:
+        return await complete_claude_async(self.claude_summary_model, system_prompt, prompt, max_tokens)
 
 
 class GeminiService(BaseLLMService):
-    def run(self, wa_id: str):
-        return run_gemini(
-            wa_id=wa_id,
-            model=self.gemini_model,
-            system_prompt=self.system_prompt,
-            max_tokens=self.max_tokens,
-            timezone=self.timezone,
-            toolkit=self.toolkit,
-        )
+    async def run(self, wa_id: str, *, retry: bool = True):
+        runner = run_gemini_async if retry else run_gemini_async.__wrapped__
+        with llm_turn(wa_id, "gemini"), claim_turn_tool_calls("gemini"):
+            return await runner(
+                wa_id=wa_id,
+                model=self.gemini_model,
+                system_prompt=self.system_prompt,
+                max_tokens=self.max_tokens,
+                timezone=self.timezone,
+                toolkit=self.toolkit,
+            )
+
+    async def complete(self, system_prompt: str, prompt: str, max_tokens: int = 1024) -> str:
+        return await complete_gemini_async(self.gemini_summary_model, system_prompt, prompt, max_tokens)
 
 
 class OpenAIService(BaseLLMService):
-    def run(self, wa_id: str):
-        return run_openai(
-            wa_id=wa_id,
-            model=self.openai_model,
-            system_prompt=self.system_prompt,
-            max_tokens=self.max_tokens,
-            reasoning_effort=self.openai_reasoning_effort,
-            reasoning_summary=self.openai_reasoning_summary,
-            text_format=self.openai_text_format,
-            store=self.openai_store,
-            timezone=self.timezone,
-            toolkit=self.toolkit,
-        )
+    async def run(self, wa_id: str, *, retry: bool = True):
+        runner = run_openai_async if retry else run_openai_async.__wrapped__
+        with llm_turn(wa_id, "openai"), claim_turn_tool_calls("openai"):
+            return await runner(
+                wa_id=wa_id,
+                model=self.openai_model,
+                system_prompt=self.system_prompt,
+                max_tokens=self.max_tokens,
+                reasoning_effort=self.openai_reasoning_effort,
+                reasoning_summary=self.openai_reasoning_summary,
+                text_format=self.openai_text_format,
+                store=self.openai_store,
+                stream=self.stream,
+                timezone=self.timezone,
+                toolkit=self.toolkit,
+            )
+
+    async def complete(self, system_prompt: str, prompt: str, max_tokens: int = 1024) -> str:
+        return await complete_openai_async(self.openai_summary_model, system_prompt, prompt, max_tokens)
+
+
+class RoutingLLMService(BaseLLMService):
+    """
+    Routes each turn across several providers using the per-provider stats of app.services.llm_routing.
+
+    Providers are tried in order (those over their error budget last), each with a single attempt bounded by
+    LLM_FAILOVER_TIMEOUT_SECONDS, so an outage costs one failed attempt instead of hours of retries. With
+    LLM_HEDGE_ENABLED a turn that outlives the provider's p95 is also started on the next provider and the
+    first answer wins; only one attempt may run tools, and hedging is skipped while replies are streamed.
+    A turn that fails after running tools or sending part of its reply is not failed over or retried.
+    """
+
+    def __init__(self, providers: list[str], *, toolkit: ToolRegistry | None = None, system_prompt: str | None = None):
+        super().__init__(toolkit=toolkit, system_prompt=system_prompt)
+        self.providers = list(dict.fromkeys(providers))
+        self.services = {
+            provider: _create_service(provider, toolkit=toolkit, system_prompt=system_prompt)
+            for provider in self.providers
+        }
+
+    async def run(self, wa_id: str, *, retry: bool = True):
+        # One claim for every attempt at this turn, including those of in-process retries
+        claim = ToolCallClaim()
+        with llm_turn(wa_id, "router"):
+            return await (self._route(wa_id, claim) if retry else self._route.__wrapped__(self, wa_id, claim))
+
+    @retry_decorator
+    async def _route(self, wa_id: str, claim: ToolCallClaim):
+        order = route_order(self.providers)
+        reply = active_reply_stream() if self.stream else None
+        hedge = LLM_HEDGE_ENABLED and reply is None
+        last_error: Exception | None = None
+        i = 0
+        while i < len(order):
+            hedge_with = order[i + 1] if hedge and i + 1 < len(order) else None
+            tried: list[str] = []
+            try:
+                return await self._attempt_with_hedge(wa_id, order[i], hedge_with, tried, claim)
+            except Exception as e:
+                if reply is not None and reply.delivered:
+                    # The next provider would answer again after the part the customer already got
+                    if isinstance(e, ReplyInterruptedError):
+                        raise
+                    raise ReplyInterruptedError(f"{type(e).__name__}: {e}") from e
+                if claim.owner is not None:
+                    # The next provider (or a retry) would run the turn's tools again
+                    if isinstance(e, ToolCallsRanError):
+                        raise
+                    raise ToolCallsRanError(f"{type(e).__name__}: {e}") from e
+                last_error = e
+            i += len(tried)
+            if i < len(order):
+                LLM_PROVIDER_FAILOVERS.labels(from_provider=tried[-1], to_provider=order[i]).inc()
+                logging.warning(
+                    f"LLM provider {tried[-1]} failed for wa_id={wa_id}, failing over to {order[i]}: {last_error}"
+                )
+        raise last_error or RuntimeError("No LLM provider configured")
+
+    async def _attempt(self, provider: str, wa_id: str, *, claim: ToolCallClaim | None = None, stream: bool = True):
+        stats = provider_stats(provider)
+        started = time.monotonic()
+        try:
+            with activate_reply_stream(active_reply_stream() if stream else None), claim_tool_calls(claim, provider):
+                result = await asyncio.wait_for(
+                    self.services[provider].run(wa_id, retry=False), timeout=LLM_FAILOVER_TIMEOUT_SECONDS
+                )
+        except asyncio.CancelledError:
+            LLM_PROVIDER_ATTEMPTS.labels(provider=provider, outcome="cancelled").inc()
+            raise
+        except asyncio.TimeoutError:
+            stats.record_failure()
+            LLM_PROVIDER_ATTEMPTS.labels(provider=provider, outcome="timeout").inc()
+            logging.warning(
+                f"LLM provider {provider} timed out after {LLM_FAILOVER_TIMEOUT_SECONDS}s for wa_id={wa_id}"
+            )
+            raise
+        except Exception:
+            stats.record_failure()
+            LLM_PROVIDER_ATTEMPTS.labels(provider=provider, outcome="error").inc()
+            raise
+        stats.record_success(time.monotonic() - started)
+        LLM_PROVIDER_ATTEMPTS.labels(provider=provider, outcome="ok").inc()
+        return result
+
+    async def _attempt_with_hedge(
+        self, wa_id: str, provider: str, hedge_with: str | None, tried: list[str], claim: ToolCallClaim
+    ):
+        """Run ``provider``, hedged on ``hedge_with`` once it outlives its p95; ``tried`` gets every provider started."""
+        tried.append(provider)
+        delay = provider_stats(provider).hedge_delay() if hedge_with else None
+        if delay is None:
+            return await self._attempt(provider, wa_id, claim=claim)
+
+        tasks: dict[asyncio.Task, str] = {}
+
+        def cancel_others(owner: object) -> None:
+            for task, name in tasks.items():
+                if name != owner:
+                    task.cancel()
+
+        claim.on_claim = cancel_others
+        primary = asyncio.create_task(self._attempt(provider, wa_id, claim=claim))
+        tasks[primary] = provider
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            # Once the primary runs tools a hedge could only duplicate them
+            if not done and claim.owner is None:
+                tried.append(hedge_with)
+                tasks[asyncio.create_task(self._attempt(hedge_with, wa_id, claim=claim, stream=False))] = hedge_with
+            pending: set[asyncio.Task] = set(tasks)
+            error: BaseException | None = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled():
+                        continue
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if len(tasks) > 1:
+                        LLM_HEDGED_REQUESTS.labels(winner="primary" if task is primary else "hedge").inc()
+                    return task.result()
+            if len(tasks) > 1:
+                LLM_HEDGED_REQUESTS.labels(winner="none").inc()
+            raise error or RuntimeError(f"Hedged LLM attempts were cancelled for wa_id={wa_id}")
+        finally:
+            claim.on_claim = None
+            losers = [task for task in tasks if not task.done()]
+            for task in losers:
+                task.cancel()
+            if losers:
+                await asyncio.gather(*losers, return_exceptions=True)
+
+    async def complete(self, system_prompt: str, prompt: str, max_tokens: int = 1024) -> str:
+        last_error: Exception | None = None
+        for provider in route_order(self.providers):
+            try:
+                return await self.services[provider].complete(system_prompt, prompt, max_tokens)
+            except Exception as e:
+                last_error = e
+                logging.warning(f"LLM provider {provider} completion failed, trying the next one: {e}")
+        raise last_error or RuntimeError("No LLM provider configured")
 
 
 def _resolve_llm_provider() -> str:
@@ -107,18 +301,29 @@ def _resolve_llm_provider() -> str:
     return get("LLM_PROVIDER", "anthropic").lower()
 
 
+_SERVICE_CLASSES: dict[str, type[BaseLLMService]] = {
+    "anthropic": AnthropicService,
+    "gemini": GeminiService,
+    "openai": OpenAIService,
+}
+
+
+def _create_service(provider: str, *, toolkit: ToolRegistry | None = None, system_prompt: str | None = None):
+    service_cls = _SERVICE_CLASSES.get(provider)
+    if service_cls is None:
+        raise ValueError(f"Unknown LLM_PROVIDER: {provider}")
+    return service_cls(toolkit=toolkit, system_prompt=system_prompt)
+
+
 def get_llm_service(*, toolkit: ToolRegistry | None = None, system_prompt: str | None = None):
     """
     Factory function that returns an LLM service instance based on configuration.
     Supported values: 'anthropic', 'gemini', 'openai'.
-    Defaults to 'anthropic'.
+    Defaults to 'anthropic'. When LLM_FALLBACK_PROVIDERS lists other providers, a RoutingLLMService
+    is returned that fails over (and optionally hedges) from the configured provider to those.
     """
     provider = _resolve_llm_provider()
-    if provider == "anthropic":
-        return AnthropicService(toolkit=toolkit, system_prompt=system_prompt)
-    elif provider == "gemini":
-        return GeminiService(toolkit=toolkit, system_prompt=system_prompt)
-    elif provider == "openai":
-        return OpenAIService(toolkit=toolkit, system_prompt=system_prompt)
-    else:
-        raise ValueError(f"Unknown LLM_PROVIDER: {provider}")
+    providers = [provider, *(p for p in LLM_FALLBACK_PROVIDERS if p != provider)]
+    if len(providers) > 1:
+        return RoutingLLMService(providers, toolkit=toolkit, system_prompt=system_prompt)
+    return _create_service(provider, toolkit=toolkit, system_prompt=system_prompt)
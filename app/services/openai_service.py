@@ -1,24 +1,22 @@
 import asyncio
 import contextlib
-import html
 import inspect
 import json
 import logging
-import time
 
 import httpx
 from openai import (
     APIConnectionError,
     APIError,
     APITimeoutError,
+    AsyncOpenAI,
     AuthenticationError,
     BadRequestError,
-    OpenAI,
     RateLimitError,
 )
 
 from app.config import config
-from app.decorators.safety import retry_decorator
+from app.decorators.safety import ToolCallsRanError, retry_decorator
 from app.metrics import (
     FUNCTION_ERRORS,
     LLM_API_ERRORS,
@@ -26,26 +24,35 @@ from app.metrics import (
     LLM_EMPTY_RESPONSES,
     LLM_RETRY_ATTEMPTS,
     LLM_TOOL_EXECUTION_ERRORS,
+    OPENAI_RESPONSE_CHAIN_TURNS,
 )
-from app.services.toolkit.registry import DEFAULT_TOOL_REGISTRY, ToolRegistry
-from app.utils import append_message, parse_unix_timestamp
-from app.utils.http_client import sync_client
-from app.utils.service_utils import retrieve_messages
+from app.services.context_window import build_context, load_summary, schedule_summary_refresh, with_summary
+from app.services.llm_instrumentation import api_call, record_tokens
+from app.services.rate_governor import estimate_tokens, rate_limited
+from app.services.response_chain import chained_turn, drop_chain, is_broken_chain, save_chain
+from app.services.toolkit.execution import (
+    ToolAuditLog,
+    call_tool_async,
+    tool_audit_body,
+    tool_calls_ran,
+)
+from app.services.toolkit.registry import DEFAULT_TOOL_REGISTRY, ToolRegistry, compiled_tools
+from app.utils import parse_unix_timestamp
+from app.utils.http_client import async_llm_client
+from app.utils.reply_stream import ReplyInterruptedError, active_reply_stream
 
 # API key is still needed at module level for client initialization
 OPENAI_API_KEY = config["OPENAI_API_KEY"]
 VEC_STORE_ID = config["VEC_STORE_ID"]
-client = OpenAI(api_key=OPENAI_API_KEY, http_client=sync_client)
-
-_FUNCTION_DEFINITION_CACHE: dict[str, list[dict[str, object]]] = {}
+async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=async_llm_client)
 
 
 def get_function_definitions(toolkit: ToolRegistry) -> list[dict[str, object]]:
-    cache_key = toolkit.name or "default"
-    if cache_key in _FUNCTION_DEFINITION_CACHE:
-        return _FUNCTION_DEFINITION_CACHE[cache_key]
+    return compiled_tools(toolkit, "openai", _build_function_definitions)
 
-    definitions = [
+
+def _build_function_definitions(toolkit: ToolRegistry) -> list[dict[str, object]]:
+    return [
         {
             "type": "function",
             "name": t["name"],
@@ -55,8 +62,19 @@ def get_function_definitions(toolkit: ToolRegistry) -> list[dict[str, object]]:
         }
         for t in toolkit.definitions
     ]
-    _FUNCTION_DEFINITION_CACHE[cache_key] = definitions
-    return definitions
+
+
+def _request_tools(toolkit: ToolRegistry) -> list[dict[str, object]]:
+    """Tools of an initial request: the function definitions plus file search over VEC_STORE_ID, if set."""
+    return compiled_tools(toolkit, "openai:initial", _build_request_tools)
+
+
+def _build_request_tools(toolkit: ToolRegistry) -> list[dict[str, object]]:
+    vec_id = config.get("VEC_STORE_ID")
+    if not vec_id:
+        return get_function_definitions(toolkit)
+    return [*get_function_definitions(toolkit), {"type": "file_search", "vector_store_ids": [vec_id]}]
+
 
 # Control OpenAI SDK log verbosity via config (default WARNING)
 _openai_log_level_name = str(config.get("OPENAI_LOG_LEVEL", "WARNING")).upper()
@@ -125,7 +143,167 @@ def _is_retryable_openai_exception(e: Exception) -> bool:
     return isinstance(e, retryable_types)
 
 
-def run_responses(
+async def _run_turn_async(wa_id, system_prompt, store, **options):
+    """Run one turn on top of the stored response chain of ``wa_id``, or on its token-budgeted history.
+
+    Returns (message_text, created_at), or None when there is no conversation input yet.
+    """
+    chain = await asyncio.to_thread(chained_turn, wa_id) if store else None
+    if chain is not None:
+        summary = await asyncio.to_thread(load_summary, wa_id)
+        try:
+            result = await run_responses_async(
+                wa_id,
+                chain.messages,
+                system_prompt=with_summary(system_prompt, summary),
+                store=store,
+                previous_response_id=chain.response_id,
+                anchor_id=chain.last_id,
+                **options,
+            )
+        except Exception as e:
+            if not is_broken_chain(e):
+                raise
+            logging.info(f"OpenAI response chain of {wa_id} is no longer available, resending history: {e}")
+            OPENAI_RESPONSE_CHAIN_TURNS.labels(mode="broken").inc()
+            await asyncio.to_thread(drop_chain, wa_id)
+        else:
+            OPENAI_RESPONSE_CHAIN_TURNS.labels(mode="chained").inc()
+            return result
+    context = await asyncio.to_thread(build_context, wa_id, "openai")
+    schedule_summary_refresh(wa_id, context)
+    if not context.messages:
+        return None
+    OPENAI_RESPONSE_CHAIN_TURNS.labels(mode="full").inc()
+    return await run_responses_async(
+        wa_id,
+        context.messages,
+        system_prompt=with_summary(system_prompt, context.summary),
+        store=store,
+        anchor_id=context.last_id,
+        **options,
+    )
+
+
+def _pending_function_calls(response):
+    return any(item.type == "function_call" for item in response.output)
+
+
+def _record_openai_error(e, function):
+    """Emit error metrics for a failed OpenAI call and return the standardized error type."""
+    error_type = map_openai_error(e)
+    exception_type = type(e).__name__
+    if error_type == "unknown":
+        error_type = f"unknown::{exception_type}"
+    http_status = getattr(getattr(e, "response", None), "status_code", None)
+    LLM_API_ERRORS.labels(provider="openai", error_type=error_type).inc()
+    with contextlib.suppress(Exception):
+        LLM_API_ERRORS_DETAILED.labels(
+            provider="openai",
+            error_type=error_type,
+            exception_type=str(exception_type),
+            http_status=str(http_status or ""),
+            function=function,
+        ).inc()
+    return error_type
+
+
+def _start_function_calls(wa_id, fc_items, function_map, audit):
+    """Parse the function calls of one response into (fc, func, args) and persist their arguments."""
+    calls = []
+    for fc in fc_items:
+        args = json.loads(getattr(fc, "arguments", "{}") or "{}")
+        func = function_map.get(fc.name)
+        if func and "wa_id" in inspect.signature(func).parameters:
+            args["wa_id"] = wa_id
+        logging.debug(f"Tool call: {fc.name} with arguments: {args}")
+        audit.add("Tool", fc.name, tool_audit_body(args))
+        calls.append((fc, func, args))
+    return calls
+
+
+def _function_call_failed(fc, e):
+    FUNCTION_ERRORS.labels(function=fc.name).inc()
+    LLM_TOOL_EXECUTION_ERRORS.labels(tool_name=fc.name, provider="openai").inc()
+    error_msg = f"Error executing {fc.name}: {str(e)}"
+    logging.error(error_msg, exc_info=True)
+    return {"error": error_msg}
+
+
+def _function_not_found(fc):
+    LLM_TOOL_EXECUTION_ERRORS.labels(tool_name=fc.name, provider="openai").inc()
+    logging.warning(f"Function {fc.name} not found in tool registry")
+    return {}
+
+
+async def _execute_function_call_async(fc, func, args):
+    if not func:
+        return _function_not_found(fc)
+    try:
+        return await call_tool_async(func, args)
+    except Exception as e:
+        return _function_call_failed(fc, e)
+
+
+def _finish_function_calls(audit, calls, results):
+    """Record results in call order and build the input items submitting them."""
+    input_items = []
+    for (fc, func, _args), result in zip(calls, results, strict=True):
+        if func:
+            audit.add("Result", fc.name, tool_audit_body(result))
+        input_items.append({"type": "function_call", "call_id": fc.call_id, "name": fc.name, "arguments": fc.arguments})
+        input_items.append({"type": "function_call_output", "call_id": fc.call_id, "output": json.dumps(result)})
+    return input_items
+
+
+def _record_usage(model, response):
+    """Export token usage of a Responses API response; cached input is counted as cache_read."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    input_tokens = getattr(usage, "input_tokens", None) or 0
+    cached = getattr(getattr(usage, "input_tokens_details", None), "cached_tokens", None) or 0
+    record_tokens(
+        "openai",
+        model,
+        input=input_tokens - cached,
+        output=getattr(usage, "output_tokens", None),
+        cache_read=cached,
+    )
+
+
+def _rate_limited_tokens(response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    return (getattr(usage, "input_tokens", None) or 0) + (getattr(usage, "output_tokens", None) or 0)
+
+
+async def _create_response_async(reply, **kwargs):
+    """Create a response; with a reply stream the output text deltas are fed to it as they arrive."""
+    tokens = estimate_tokens([kwargs.get("instructions"), kwargs.get("input")], kwargs.get("max_output_tokens"))
+    async with rate_limited("openai", kwargs["model"], tokens) as grant:
+        with api_call("openai", kwargs["model"]):
+            if reply is None:
+                response = await async_client.responses.create(**kwargs)
+            else:
+                response = None
+                events = await async_client.responses.create(**kwargs, stream=True)
+                async for event in events:
+                    if event.type == "response.output_text.delta":
+                        reply.feed(event.delta)
+                    elif event.type in ("response.completed", "response.incomplete", "response.failed"):
+                        response = event.response
+        grant.settle(_rate_limited_tokens(response))
+    _record_usage(kwargs["model"], response)
+    if reply is not None:
+        reply.flush()
+    if response is None:
+        raise RuntimeError("OpenAI response stream ended without a final response")
+    return response
+
+
+async def run_responses_async(
     wa_id,
     input_chat,
     model,
@@ -137,8 +315,11 @@ def run_responses(
     store=True,
     verbosity="low",
     toolkit: ToolRegistry = DEFAULT_TOOL_REGISTRY,
+    reply=None,
+    previous_response_id=None,
+    anchor_id=None,
 ):
-    """Call the Responses API, handle function calls, and return final message, response id, and timestamp.
+    """Call the Responses API, handle function calls, and return (message_text, created_at).
 
     Args:
         wa_id (str): WhatsApp ID of the user
@@ -150,194 +331,79 @@ def run_responses(
         reasoning_summary (str): Reasoning summary mode ("auto", "none").
         text_format (str): Text format type.
         store (bool): Whether to store the response in OpenAI's system.
+        reply (ReplyStream, optional): Stream fed with the output text as it is generated.
+        previous_response_id (str, optional): Stored response that ``input_chat`` continues.
+        anchor_id (int, optional): Newest conversation id in the input; the final response is then kept
+            as the chain the next turn continues from.
     """
-    # Set up base kwargs with function tools
+    chain = {"previous_response_id": previous_response_id} if previous_response_id else {}
     function_definitions = get_function_definitions(toolkit)
     function_map = toolkit.functions
+    tools = _request_tools(toolkit)
 
-    kwargs = {
-        "model": model,
-        "input": input_chat,
-        "instructions": system_prompt,
-        "text": {"format": {"type": text_format}, "verbosity": verbosity},
-        "reasoning": {"effort": reasoning_effort, "summary": reasoning_summary},
-        "tools": function_definitions,
-        "store": store,
-    }
-
-    vec_id = config.get("VEC_STORE_ID")
-    # Add vector store and file_search tool if configured
-    if vec_id:
-        # Add file_search tool with vector_store_ids
-        kwargs["tools"] = [*function_definitions, {"type": "file_search", "vector_store_ids": [vec_id]}]
-
-    # Log request payload
     try:
-        response = client.responses.create(**kwargs)
+        response = await _create_response_async(
+            reply,
+            model=model,
+            input=input_chat,
+            instructions=system_prompt,
+            text={"format": {"type": text_format}, "verbosity": verbosity},
+            reasoning={"effort": reasoning_effort, "summary": reasoning_summary},
+            tools=tools,
+            store=store,
+            **chain,
+        )
     except Exception as e:
-        # Emit detailed metric for initial call
-        error_type = map_openai_error(e)
-        exception_type = type(e).__name__
-        if error_type == "unknown":
-            error_type = f"unknown::{exception_type}"
-        http_status = None
-        try:
-            http_status = getattr(getattr(e, "response", None), "status_code", None)
-        except Exception:
-            http_status = None
-        LLM_API_ERRORS.labels(provider="openai", error_type=error_type).inc()
-        with contextlib.suppress(Exception):
-            LLM_API_ERRORS_DETAILED.labels(
-                provider="openai",
-                error_type=error_type,
-                exception_type=str(exception_type),
-                http_status=str(http_status or ""),
-                function="run_responses_initial",
-            ).inc()
+        if not (previous_response_id and is_broken_chain(e)):
+            _record_openai_error(e, "run_responses_initial")
         raise
-    # handle any function calls with maximum iteration limit to prevent infinite loops
+
+    audit = ToolAuditLog(wa_id)
     max_iterations = 10
     iteration_count = 0
-
     while iteration_count < max_iterations:
         fc_items = [item for item in response.output if item.type == "function_call"]
         if not fc_items:
             logging.debug(f"OpenAI function call loop completed after {iteration_count} iterations")
             break
-
         iteration_count += 1
-        logging.debug(
-            f"OpenAI function call iteration {iteration_count}/{max_iterations}, processing {len(fc_items)} function calls"
-        )
 
-        input_items = []
-        for fc in fc_items:
-            args = json.loads(getattr(fc, "arguments", "{}"))
-            func = function_map.get(fc.name)
-
-            # Log function call name and arguments
-            logging.debug(f"Tool call: {fc.name} with arguments: {args}")
-            # Persist tool call into conversation history for sidebar chat
-            try:
-                persist_args = dict(args) if isinstance(args, dict) else {}
-                if func and "wa_id" in inspect.signature(func).parameters:
-                    persist_args["wa_id"] = wa_id
-                if isinstance(persist_args, dict) and len(persist_args) > 0:
-                    pretty = json.dumps(persist_args, ensure_ascii=False, indent=2)
-                    safe_json = html.escape(pretty)
-                    message_html = (
-                        f'<details class="details">'
-                        f"<summary>Tool: {fc.name}</summary>"
-                        f'<div><pre><code class="language-json">{safe_json}</code></pre></div>'
-                        f"</details>"
-                    )
-                else:
-                    message_html = f"Tool: {fc.name}"
-                now_ts = int(time.time())
-                date_str, time_str = parse_unix_timestamp(now_ts)
-                append_message(wa_id, "tool", message_html, date_str, time_str)
-            except Exception as persist_err:
-                logging.error(f"Failed to persist tool call message for {fc.name}: {persist_err}")
-
-            if func and "wa_id" in inspect.signature(func).parameters:
-                args["wa_id"] = wa_id
-
-            # Handle async functions properly
-            if func:
-                try:
-                    if inspect.iscoroutinefunction(func):
-                        # For async functions, run them in the event loop
-                        result = asyncio.run(func(**args))
-                    else:
-                        # For regular functions, call them directly
-                        result = func(**args)
-                    # Persist tool result as a follow-up message
-                    try:
-                        result_str = (
-                            json.dumps(result, ensure_ascii=False, indent=2)
-                            if isinstance(result, dict | list)
-                            else str(result)
-                        )
-                        safe_out = html.escape(result_str)
-                        result_html = (
-                            f'<details class="details">'
-                            f"<summary>Result: {fc.name}</summary>"
-                            f'<div><pre><code class="language-json">{safe_out}</code></pre></div>'
-                            f"</details>"
-                        )
-                        now_ts2 = int(time.time())
-                        d2, t2 = parse_unix_timestamp(now_ts2)
-                        append_message(wa_id, "tool", result_html, d2, t2)
-                    except Exception as persist_res_err:
-                        logging.error(f"Failed to persist tool result for {fc.name}: {persist_res_err}")
-                except Exception as e:
-                    # Use both metrics for now during transition
-                    FUNCTION_ERRORS.labels(function=fc.name).inc()
-                    LLM_TOOL_EXECUTION_ERRORS.labels(tool_name=fc.name, provider="openai").inc()
-                    error_msg = f"Error executing {fc.name}: {str(e)}"
-                    logging.error(error_msg, exc_info=True)
-                    result = {"error": error_msg}
-            else:
-                result = {}
-                LLM_TOOL_EXECUTION_ERRORS.labels(tool_name=fc.name, provider="openai").inc()
-                logging.warning(f"Function {fc.name} not found in tool registry")
-
-            input_items.append(
-                {"type": "function_call", "call_id": fc.call_id, "name": fc.name, "arguments": fc.arguments}
-            )
-            input_items.append({"type": "function_call_output", "call_id": fc.call_id, "output": json.dumps(result)})
-
-        # submit function call outputs
-        kwargs = {
-            "model": model,
-            "input": input_items,
-            "tools": function_definitions,
-            "store": store,
-            "previous_response_id": response.id,  # Link to previous response
-        }
+        calls = _start_function_calls(wa_id, fc_items, function_map, audit)
+        results = await asyncio.gather(*(_execute_function_call_async(fc, func, args) for fc, func, args in calls))
+        input_items = _finish_function_calls(audit, calls, results)
 
         try:
-            response = client.responses.create(**kwargs)
+            response = await _create_response_async(
+                reply,
+                model=model,
+                input=input_items,
+                tools=function_definitions,
+                store=store,
+                previous_response_id=response.id,
+            )
         except Exception as e:
-            # Emit detailed metric for iterative call
-            error_type = map_openai_error(e)
-            exception_type = type(e).__name__
-            if error_type == "unknown":
-                error_type = f"unknown::{exception_type}"
-            http_status = None
-            try:
-                http_status = getattr(getattr(e, "response", None), "status_code", None)
-            except Exception:
-                http_status = None
-            LLM_API_ERRORS.labels(provider="openai", error_type=error_type).inc()
-            with contextlib.suppress(Exception):
-                LLM_API_ERRORS_DETAILED.labels(
-                    provider="openai",
-                    error_type=error_type,
-                    exception_type=str(exception_type),
-                    http_status=str(http_status or ""),
-                    function="run_responses_iter",
-                ).inc()
+            _record_openai_error(e, "run_responses_iter")
             logging.error(f"Error creating OpenAI response in iteration {iteration_count}: {e}")
             break
 
+    await audit.aflush()
+    if store and anchor_id is not None and not _pending_function_calls(response):
+        await asyncio.to_thread(save_chain, wa_id, response, anchor_id)
     if iteration_count >= max_iterations:
         logging.warning(
             f"OpenAI function call loop reached maximum iterations ({max_iterations}), breaking to prevent infinite loop"
         )
-    # extract assistant message
     msg_items = [
         item for item in response.output if item.type == "message" and getattr(item, "role", None) == "assistant"
     ]
     text = None
     if msg_items:
-        content = msg_items[-1].content
-        text = "".join([c.text for c in content if c.type == "output_text"])
+        text = "".join([c.text for c in msg_items[-1].content if c.type == "output_text"])
     return text, response.created_at
 
 
 @retry_decorator
-def run_openai(
+async def run_openai_async(
     wa_id,
     model,
     system_prompt,
@@ -346,79 +412,50 @@ def run_openai(
     reasoning_summary="auto",
     text_format="text",
     store=True,
+    stream=False,
     timezone=None,
     verbosity="low",
     toolkit: ToolRegistry = DEFAULT_TOOL_REGISTRY,
 ):
     """
-    Run the OpenAI Responses API with existing conversation context.
+    Run the OpenAI Responses API with existing conversation context; tool calls run as coroutines.
+    With ``stream`` the reply text is fed to the caller's active reply stream as it is generated.
     Returns (response_text, date_str, time_str).
-
-    Args:
-        wa_id (str): WhatsApp ID of the user
-        model (str): OpenAI model to use.
-        system_prompt (str): System prompt to use.
-        max_tokens (int, optional): Maximum tokens for response. Not directly used by Responses API.
-        reasoning_effort (str): Reasoning effort level ("high", "medium", "low").
-        reasoning_summary (str): Reasoning summary mode ("auto", "none").
-        text_format (str): Text format type.
-        store (bool): Whether to store the response in OpenAI's system.
-        timezone (str, optional): Timezone for timestamps.
     """
-    # Use timezone from parameters or fallback to UTC
-
-    # Retrieve message history using centralized service
-    input_chat = retrieve_messages(wa_id)
-    # Guard: OpenAI Responses API requires one of input/previous_response_id/prompt/conversation_id
-    # Avoid 400 errors by short-circuiting when there is no input history yet
-    if not input_chat:
-        logging.warning(f"Skipping OpenAI call for wa_id={wa_id}: no conversation input available")
-        LLM_EMPTY_RESPONSES.labels(provider="openai", response_type="missing_input").inc()
-        return "", "", ""
-    # Call the synchronous Responses API function
+    reply = active_reply_stream() if stream else None
+    if reply is not None:
+        reply.restart()
     try:
-        new_message, created_at = run_responses(
+        result = await _run_turn_async(
             wa_id,
-            input_chat,
-            model,
             system_prompt,
-            max_tokens,
-            reasoning_effort,
-            reasoning_summary,
-            text_format,
             store,
-            verbosity,
-            toolkit,
+            model=model,
+            max_tokens=max_tokens,
+            reasoning_effort=reasoning_effort,
+            reasoning_summary=reasoning_summary,
+            text_format=text_format,
+            verbosity=verbosity,
+            toolkit=toolkit,
+            reply=reply,
         )
     except Exception as e:
-        error_type = map_openai_error(e)
-        exception_type = type(e).__name__
-        if error_type == "unknown":
-            error_type = f"unknown::{exception_type}"
-        # Try to extract HTTP status from SDK errors
-        http_status = None
-        try:
-            http_status = getattr(getattr(e, "response", None), "status_code", None)
-        except Exception:
-            http_status = None
-        logging.error(
-            f"OpenAI API ERROR for wa_id={wa_id}: {e} (type: {error_type}, exception={exception_type}, status={http_status})",
-            exc_info=True,
-        )
-        LLM_API_ERRORS.labels(provider="openai", error_type=error_type).inc()
-        with contextlib.suppress(Exception):
-            LLM_API_ERRORS_DETAILED.labels(
-                provider="openai",
-                error_type=error_type,
-                exception_type=str(exception_type),
-                http_status=str(http_status or ""),
-                function="run_openai",
-            ).inc()
-        # Only mark retry attempt when the exception is retry-eligible
+        error_type = _record_openai_error(e, "run_openai")
+        logging.error(f"OpenAI API ERROR for wa_id={wa_id}: {e} (type: {error_type})", exc_info=True)
+        if reply is not None and reply.delivered:
+            # Retrying would send the opening of the reply a second time
+            raise ReplyInterruptedError(f"{type(e).__name__}: {e}") from e
+        if tool_calls_ran():
+            # Retrying or deferring the turn would run its tools again
+            raise ToolCallsRanError(f"{type(e).__name__}: {e}") from e
         if _is_retryable_openai_exception(e):
             LLM_RETRY_ATTEMPTS.labels(provider="openai", error_type=error_type).inc()
-        # Re-raise so the retry mechanism can handle it properly
         raise
+    if result is None:
+        logging.warning(f"Skipping OpenAI call for wa_id={wa_id}: no conversation input available")
+        LLM_EMPTY_RESPONSES.labels(provider="openai", response_type="missing_input").inc()
+        return "", "", ""
+    new_message, created_at = result
 
     if new_message:
         logging.info(f"OpenAI runner produced message: {new_message[:50]}...")
@@ -428,3 +465,16 @@ def run_openai(
     logging.warning(f"OpenAI runner returned no message for wa_id={wa_id}")
     LLM_EMPTY_RESPONSES.labels(provider="openai", response_type="empty_content").inc()
     return "", "", ""
+
+
+async def complete_openai_async(model, system_prompt, prompt, max_tokens=1024):
+    """Single tool-free completion (used for background housekeeping such as history summaries)."""
+    response = await _create_response_async(
+        None,
+        model=model,
+        instructions=system_prompt,
+        input=prompt,
+        max_output_tokens=max_tokens,
+        store=False,
+    )
+    return response.output_text or ""
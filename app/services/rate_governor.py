@@ -0,0 +1,218 @@
+"""Client-side admission control for LLM API requests, per provider and model.
+
+Every provider request waits here for an in-flight slot and for room in the requests-per-minute and
+tokens-per-minute buckets, so bursts queue instead of tripping provider 429s. Waiters are admitted in
+priority order (customer replies, then system-agent turns, then background work such as summaries) and
+first come, first served within a priority. A 429 carrying Retry-After pauses admission for that model.
+
+Limits are configured per provider and apply per process: with several worker processes, divide the
+provider quota between them.
+
+    LLM_MAX_IN_FLIGHT[_<PROVIDER>]   concurrent requests (default 8, 0 disables the cap)
+    LLM_RPM_LIMIT[_<PROVIDER>]       requests per minute (default 0, unlimited)
+    LLM_TPM_LIMIT[_<PROVIDER>]       input + output tokens per minute (default 0, unlimited)
+
+Token use is estimated from the request size and max tokens up front and settled with the reported
+usage once the response is in.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+import weakref
+from collections.abc import AsyncIterator, Iterator
+
+from app.decorators.safety import retry_after_seconds
+from app.metrics import LLM_GOVERNOR_IN_FLIGHT, LLM_GOVERNOR_QUEUED, LLM_GOVERNOR_WAIT_SECONDS
+from app.services.context_window import LLM_CONTEXT_CHARS_PER_TOKEN
+
+PRIORITY_CUSTOMER = 0
+PRIORITY_SYSTEM_AGENT = 1
+PRIORITY_BACKGROUND = 2
+
+_PRIORITY_NAMES = {
+    PRIORITY_CUSTOMER: "customer",
+    PRIORITY_SYSTEM_AGENT: "system_agent",
+    PRIORITY_BACKGROUND: "background",
+}
+
+_current_priority: contextvars.ContextVar[int] = contextvars.ContextVar("llm_priority", default=PRIORITY_CUSTOMER)
+
+
+def _limit(name: str, provider: str, default: float) -> float:
+    for key in (f"{name}_{provider.upper()}", name):
+        value = os.environ.get(key)
+        if value:
+            try:
+                return max(float(value), 0.0)
+            except ValueError:
+                logging.warning(f"Ignoring invalid {key}={value!r}")
+    return default
+
+
+@contextlib.contextmanager
+def llm_priority(priority: int) -> Iterator[None]:
+    """Queue the LLM requests made in this context with ``priority`` (lower is served first)."""
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def estimate_tokens(payload: object, max_tokens: int | None) -> int:
+    """Up-front token estimate of a request: the size of its input ``payload`` plus the output it may produce."""
+    text = payload if isinstance(payload, str) else json.dumps(payload, default=str, ensure_ascii=False)
+    return int(len(text) / LLM_CONTEXT_CHARS_PER_TOKEN) + (max_tokens or 0)
+
+
+class _Bucket:
+    """Token bucket refilled continuously at ``per_minute`` / 60 per second; may go negative when settled."""
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        """Seconds until ``amount`` (capped at the capacity) is available; 0 when it is now."""
+        missing = min(amount, self.capacity) - self.level
+        return 0.0 if missing <= 0 else missing / self.rate
+
+
+class Grant:
+    """An admitted request; ``settle`` corrects the token bucket with the usage the provider reported."""
+
+    def __init__(self, governor: "RateGovernor", tokens: int) -> None:
+        self._governor = governor
+        self.tokens = tokens
+
+    def settle(self, actual_tokens: int | None) -> None:
+        if actual_tokens is None or self._governor.tokens is None:
+            return
+        self._governor.tokens.level -= actual_tokens - self.tokens
+        self.tokens = actual_tokens
+
+
+class RateGovernor:
+    """Admission queue of one provider model. Only touched from its event loop."""
+
+    def __init__(self, provider: str, model: str) -> None:
+        self.provider = provider
+        self.model = model
+        self.max_in_flight = int(_limit("LLM_MAX_IN_FLIGHT", provider, 8))
+        rpm = _limit("LLM_RPM_LIMIT", provider, 0)
+        tpm = _limit("LLM_TPM_LIMIT", provider, 0)
+        self.requests = _Bucket(rpm) if rpm else None
+        self.tokens = _Bucket(tpm) if tpm else None
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._waiters: list[tuple[int, int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tokens: int = 0) -> AsyncIterator[Grant]:
+        priority = _current_priority.get()
+        started = time.monotonic()
+        await self._acquire(priority, tokens)
+        LLM_GOVERNOR_WAIT_SECONDS.labels(
+            provider=self.provider, priority=_PRIORITY_NAMES.get(priority, str(priority))
+        ).observe(time.monotonic() - started)
+        try:
+            yield Grant(self, tokens)
+        except Exception as e:
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            retry_after = retry_after_seconds(e)
+            if status == 429 and retry_after:
+                self.pause(retry_after)
+            raise
+        finally:
+            self._release()
+
+    def pause(self, seconds: float) -> None:
+        """Admit nothing for ``seconds`` (the provider asked to back off)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def _acquire(self, priority: int, tokens: int) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), tokens, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Admitted just before the cancellation: hand the slot back
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                future.cancel()
+                self._dispatch()
+            raise
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Admit waiters in priority order while a slot and bucket room are available."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters:
+            _priority, _seq, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                break
+            now = time.monotonic()
+            delay = max(0.0, self.paused_until - now)
+            for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    delay = max(delay, bucket.wait_for(amount))
+            if delay > 0:
+                # Later waiters do not overtake the head of the queue; retry once the buckets refilled
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                break
+            heapq.heappop(self._waiters)
+            if self.requests is not None:
+                self.requests.level -= 1
+            if self.tokens is not None:
+                self.tokens.level -= tokens
+            self.in_flight += 1
+            future.set_result(None)
+        LLM_GOVERNOR_IN_FLIGHT.labels(provider=self.provider, model=self.model).set(self.in_flight)
+        LLM_GOVERNOR_QUEUED.labels(provider=self.provider, model=self.model).set(
+            sum(1 for *_rest, future in self._waiters if not future.done())
+        )
+
+
+# Governors are bound to the event loop they queue on (API process loop, worker loops, tests)
+_governors: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[tuple[str, str], RateGovernor]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def governor(provider: str, model: str) -> RateGovernor:
+    per_loop = _governors.setdefault(asyncio.get_running_loop(), {})
+    key = (provider, model)
+    if key not in per_loop:
+        per_loop[key] = RateGovernor(provider, model)
+    return per_loop[key]
+
+
+def rate_limited(provider: str, model: str, tokens: int = 0) -> contextlib.AbstractAsyncContextManager[Grant]:
+    """Wait for admission of one ``provider``/``model`` request expected to use about ``tokens`` tokens."""
+    return governor(provider, model).slot(tokens)
@@ -0,0 +1,154 @@
+"""Server-side conversation state for the OpenAI Responses API.
+
+With ``store`` enabled OpenAI keeps every response, so a turn can continue the previous one through
+``previous_response_id`` and send only the messages written since (new customer messages, staff replies)
+instead of the whole history. The chain of a conversation is its last response id plus the newest
+conversation row that response has seen. It is restarted from the token-budgeted history when it is
+older than OPENAI_RESPONSE_CHAIN_TTL_SECONDS, its server-side history grew past
+OPENAI_RESPONSE_CHAIN_MAX_INPUT_TOKENS, it no longer lines up with the stored conversation, or OpenAI
+rejects it.
+"""
+
+import datetime
+import logging
+import os
+from dataclasses import dataclass
+
+from openai import BadRequestError, NotFoundError
+
+from app.db import ResponseChainModel, get_session
+from app.services.context_window import token_budget
+from app.utils.service_utils import retrieve_context_rows
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+
+OPENAI_RESPONSE_CHAIN_ENABLED = os.environ.get("OPENAI_RESPONSE_CHAIN_ENABLED", "true").lower() in ("1", "true", "yes")
+# OpenAI keeps stored responses for 30 days; a week-old conversation starts over from the budgeted history
+OPENAI_RESPONSE_CHAIN_TTL_SECONDS = _env_float("OPENAI_RESPONSE_CHAIN_TTL_SECONDS", 7 * 24 * 3600)
+# Chained history is billed as input every turn: past this size the chain restarts with the summary instead
+OPENAI_RESPONSE_CHAIN_MAX_INPUT_TOKENS = int(
+    _env_float("OPENAI_RESPONSE_CHAIN_MAX_INPUT_TOKENS", 2 * max(token_budget("openai"), 0))
+)
+
+
+@dataclass(frozen=True)
+class ChainedTurn:
+    response_id: str
+    # Messages written since the chained response, oldest first
+    messages: list[dict[str, str]]
+    # Conversation id of the newest message sent with this turn
+    last_id: int
+
+
+def chained_turn(wa_id: str) -> ChainedTurn | None:
+    """The messages to send on top of the stored response of ``wa_id``, or None to send the full history."""
+    if not OPENAI_RESPONSE_CHAIN_ENABLED:
+        return None
+    try:
+        with get_session() as session:
+            record = session.get(ResponseChainModel, wa_id)
+            if record is None:
+                return None
+            response_id, anchor_id, reply = record.response_id, record.anchor_id, record.reply
+            input_tokens, updated_at = record.input_tokens, record.updated_at
+    except Exception as e:
+        logging.warning(f"Loading OpenAI response chain failed for {wa_id}: {e}")
+        return None
+    age = (datetime.datetime.utcnow() - updated_at).total_seconds()
+    if age > OPENAI_RESPONSE_CHAIN_TTL_SECONDS:
+        return None
+    if OPENAI_RESPONSE_CHAIN_MAX_INPUT_TOKENS > 0 and input_tokens > OPENAI_RESPONSE_CHAIN_MAX_INPUT_TOKENS:
+        return None
+
+    rows = retrieve_context_rows(wa_id)
+    ids = [row[0] for row in rows]
+    # The anchor must still be part of the history, otherwise the conversation was cleared or rewritten
+    if anchor_id not in ids:
+        return None
+    newer = rows[ids.index(anchor_id) + 1 :]
+    # The bot's reply to the chained turn is already part of the response; staff messages stored with the
+    # assistant role around it are not
+    for i, (_id, role, content) in enumerate(newer):
+        if role == "user":
+            break
+        if reply is not None and _same_text(content, reply):
+            newer = newer[:i] + newer[i + 1 :]
+            break
+    if not any(role == "user" for _id, role, _content in newer):
+        return None
+    return ChainedTurn(response_id, [{"role": role, "content": content} for _id, role, content in newer], newer[-1][0])
+
+
+def _same_text(stored: str, reply: str) -> bool:
+    # A streamed reply is stored as the paragraphs the customer received, re-joined
+    return " ".join(stored.split()) == " ".join(reply.split())
+
+
+def _reply_text(response) -> str | None:
+    messages = [
+        item
+        for item in getattr(response, "output", None) or []
+        if getattr(item, "type", None) == "message" and getattr(item, "role", None) == "assistant"
+    ]
+    if not messages:
+        return None
+    return "".join(part.text for part in messages[-1].content if getattr(part, "type", None) == "output_text")
+
+
+def save_chain(wa_id: str, response, anchor_id: int | None) -> None:
+    """Remember ``response`` as the state the next turn of ``wa_id`` continues from."""
+    response_id = getattr(response, "id", None)
+    if not OPENAI_RESPONSE_CHAIN_ENABLED or not response_id or anchor_id is None:
+        return
+    input_tokens = getattr(getattr(response, "usage", None), "input_tokens", None) or 0
+    reply = _reply_text(response)
+    now = datetime.datetime.utcnow()
+    try:
+        with get_session() as session:
+            record = session.get(ResponseChainModel, wa_id)
+            if record is None:
+                session.add(
+                    ResponseChainModel(
+                        wa_id=wa_id,
+                        response_id=response_id,
+                        anchor_id=anchor_id,
+                        input_tokens=input_tokens,
+                        reply=reply,
+                        updated_at=now,
+                    )
+                )
+            else:
+                record.response_id = response_id
+                record.anchor_id = anchor_id
+                record.input_tokens = input_tokens
+                record.reply = reply
+                record.updated_at = now
+            session.commit()
+    except Exception as e:
+        logging.warning(f"Saving OpenAI response chain failed for {wa_id}: {e}")
+
+
+def drop_chain(wa_id: str) -> None:
+    try:
+        with get_session() as session:
+            session.query(ResponseChainModel).filter(ResponseChainModel.wa_id == wa_id).delete(
+                synchronize_session=False
+            )
+            session.commit()
+    except Exception as e:
+        logging.warning(f"Dropping OpenAI response chain failed for {wa_id}: {e}")
+
+
+def is_broken_chain(e: Exception) -> bool:
+    """True when OpenAI rejected ``previous_response_id`` (expired, deleted or unknown response)."""
+    if isinstance(e, NotFoundError):
+        return True
+    if not isinstance(e, BadRequestError):
+        return False
+    return getattr(e, "param", None) == "previous_response_id" or "previous response" in str(e).lower()
@@ -0,0 +1,126 @@
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import inspect
+import json
+import logging
+from collections.abc import Callable, Iterator
+from html import escape
+from typing import Any
+
+from app.services.llm_instrumentation import timed_tool
+from app.utils import append_messages, parse_unix_timestamp
+
+
+class ToolCallClaim:
+    """Lets only one of the attempts at the same turn (hedges, failovers) run tools.
+
+    The first attempt that calls a tool owns the turn; ``on_claim`` is told its owner so the router
+    can cancel concurrent attempts. Tools are the only side effects, so a turn never books anything twice.
+    """
+
+    def __init__(self, on_claim: Callable[[object], None] | None = None) -> None:
+        self.owner: object | None = None
+        self.on_claim = on_claim
+
+    def claim(self, owner: object) -> bool:
+        if self.owner is None:
+            self.owner = owner
+            if self.on_claim is not None:
+                self.on_claim(owner)
+        return self.owner == owner
+
+
+_tool_call_claim: contextvars.ContextVar[tuple[ToolCallClaim, object] | None] = contextvars.ContextVar(
+    "tool_call_claim", default=None
+)
+
+
+@contextlib.contextmanager
+def claim_tool_calls(claim: ToolCallClaim | None, owner: object) -> Iterator[None]:
+    """Route tool calls made in this context through ``claim`` on behalf of ``owner``."""
+    token = _tool_call_claim.set((claim, owner) if claim is not None else None)
+    try:
+        yield
+    finally:
+        _tool_call_claim.reset(token)
+
+
+@contextlib.contextmanager
+def claim_turn_tool_calls(owner: object) -> Iterator[None]:
+    """Give the turn run in this context a claim owned by ``owner``, unless a caller (the router) set one."""
+    if _tool_call_claim.get() is not None:
+        yield
+        return
+    with claim_tool_calls(ToolCallClaim(), owner):
+        yield
+
+
+def tool_calls_ran() -> bool:
+    """True once the turn run in this context called a tool; the turn must not run again after that."""
+    claimed = _tool_call_claim.get()
+    return claimed is not None and claimed[0].owner is not None
+
+
+def _tool_name(function: Callable[..., Any]) -> str:
+    return getattr(function, "__name__", None) or type(function).__name__
+
+
+async def call_tool_async(function: Callable[..., Any], arguments: dict[str, Any]) -> Any:
+    """Run a tool from async code: coroutine tools are awaited, sync tools run in a worker thread."""
+    claimed = _tool_call_claim.get()
+    if claimed is not None and not claimed[0].claim(claimed[1]):
+        # Another attempt at this turn already runs tools: this one is abandoned like a cancelled task
+        raise asyncio.CancelledError()
+    with timed_tool(_tool_name(function)):
+        if inspect.iscoroutinefunction(function):
+            return await function(**arguments)
+        return await asyncio.to_thread(function, **arguments)
+
+
+def tool_audit_body(value: Any) -> str:
+    """Pretty-printed tool arguments/output as stored in the audit messages."""
+    if isinstance(value, dict | list):
+        return json.dumps(value, ensure_ascii=False, indent=2)
+    return str(value)
+
+
+def tool_audit_html(label: str, tool_name: str, body: str) -> str:
+    """Collapsible HTML block used to persist tool calls/results in the conversation history."""
+    return (
+        f'<details class="details">'
+        f"<summary>{label}: {tool_name}</summary>"
+        f'<div><pre><code class="language-json">{escape(body)}</code></pre></div>'
+        f"</details>"
+    )
+
+
+class ToolAuditLog:
+    """Collects the tool call/result audit messages of one LLM turn and writes them in one transaction.
+
+    Rows keep the order in which they were added and their own timestamps. Runners flush before they
+    return, so the audit rows always precede the assistant reply in the conversation.
+    """
+
+    def __init__(self, wa_id: str) -> None:
+        self.wa_id = wa_id
+        self._rows: list[tuple[str, str, str, str]] = []
+
+    def add(self, label: str, tool_name: str, body: str) -> None:
+        date_str, time_str = parse_unix_timestamp(int(datetime.datetime.now(datetime.timezone.utc).timestamp()))
+        self._rows.append(("tool", tool_audit_html(label, tool_name, body), date_str, time_str))
+
+    def flush(self) -> None:
+        """Write buffered rows; failures are logged and never break the tool loop."""
+        rows, self._rows = self._rows, []
+        if not rows:
+            return
+        try:
+            append_messages(self.wa_id, rows)
+        except Exception as e:
+            logging.error(f"Persist tool audit messages failed for {self.wa_id}: {e}")
+
+    async def aflush(self) -> None:
+        if self._rows:
+            await asyncio.to_thread(self.flush)
@@ -2,10 +2,12 @@ from __future__ import annotations
 
 from collections.abc import Callable, Mapping, Sequence
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, TypeVar
 
 from app.services.tool_schemas import FUNCTION_MAPPING, TOOL_DEFINITIONS
 
+T = TypeVar("T")
+
 
 @dataclass(frozen=True)
 class ToolRegistry:
@@ -24,3 +26,20 @@ DEFAULT_TOOL_REGISTRY = ToolRegistry(
     functions=FUNCTION_MAPPING,
 )
 
+
+# (provider form, id(registry)) -> (registry, compiled value); the registry is kept to pin its id
+_COMPILED_TOOLS: dict[tuple[str, int], tuple[ToolRegistry, Any]] = {}
+
+
+def compiled_tools(toolkit: ToolRegistry, form: str, build: Callable[[ToolRegistry], T]) -> T:
+    """
+    Provider-specific form of a registry's tools (schemas, declarations, request prefixes), built on first use.
+
+    Registries are immutable, so each ``form`` is built once per registry instance and shared by every turn;
+    callers must treat the result as read-only.
+    """
+    key = (form, id(toolkit))
+    entry = _COMPILED_TOOLS.get(key)
+    if entry is None or entry[0] is not toolkit:
+        entry = _COMPILED_TOOLS[key] = (toolkit, build(toolkit))
+    return entry[1]
@@ -0,0 +1,66 @@
+"""
+Tests for replaying cached answers to conversation-opening questions.
+"""
+
+import asyncio
+from unittest import mock
+
+from app.db import ConversationModel, CustomerModel, get_session, init_models
+from app.utils import answer_cache
+from app.utils.service_utils import context_cache
+from app.utils.whatsapp_utils import generate_response
+
+WA_IDS = ["966500000931", "966500000932", "966500000933"]
+
+
+def _cleanup() -> None:
+    context_cache.invalidate(*WA_IDS)
+    with get_session() as session:
+        session.query(ConversationModel).filter(ConversationModel.wa_id.in_(WA_IDS)).delete()
+        session.query(CustomerModel).filter(CustomerModel.wa_id.in_(WA_IDS)).delete()
+        session.commit()
+
+
+def test_normalize_question_folds_case_punctuation_and_arabic_variants():
+    assert answer_cache.normalize_question("  Where are you LOCATED?? 📍") == "where are you located"
+    assert answer_cache.normalize_question("أين موقعكم؟") == answer_cache.normalize_question("اين مَوقِعكـم")
+
+
+def test_opening_question_is_answered_from_cache_until_invalidated():
+    init_models()
+    _cleanup()
+    calls: list[str] = []
+
+    async def run_llm(wa_id: str):
+        calls.append(wa_id)
+        return "We are in Riyadh.", "2025-01-01", "10:00:00"
+
+    def ask(wa_id: str, text: str) -> str | None:
+        return asyncio.run(generate_response(text, wa_id, 1735725600, run_llm))
+
+    try:
+        with (
+            mock.patch.object(answer_cache, "LLM_ANSWER_CACHE_ENABLED", True),
+            mock.patch.object(answer_cache, "answer_cache", answer_cache.AnswerCache(10, 3600)),
+        ):
+            assert ask(WA_IDS[0], "Where are you located?") == "We are in Riyadh."
+            assert ask(WA_IDS[1], "where are you located") == "We are in Riyadh."
+            assert calls == [WA_IDS[0]]
+            with get_session() as session:
+                stored = session.query(ConversationModel.role, ConversationModel.message).filter(
+                    ConversationModel.wa_id == WA_IDS[1]
+                )
+                assert [tuple(row) for row in stored.order_by(ConversationModel.id)] == [
+                    ("user", "where are you located"),
+                    ("assistant", "We are in Riyadh."),
+                ]
+
+            # Mid-conversation questions depend on the history: never served from the cache
+            ask(WA_IDS[1], "Where are you located?")
+            assert calls == [WA_IDS[0], WA_IDS[1]]
+
+            answer_cache.invalidate_answers("vacations")
+            ask(WA_IDS[2], "Where are you located?")
+            assert calls[-1] == WA_IDS[2]
+    finally:
+        _cleanup()
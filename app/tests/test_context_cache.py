@@ -0,0 +1,70 @@
+"""
+Tests for the per-wa_id LLM context cache.
+"""
+
+from app.db import ConversationModel, CustomerModel, get_session, init_models
+from app.metrics import LLM_CONTEXT_CACHE_LOOKUPS
+from app.utils.service_utils import (
+    ConversationContextCache,
+    append_message,
+    clear_conversation_messages,
+    context_cache,
+    retrieve_messages,
+)
+
+WA_ID = "966500000915"
+
+
+def _lookups(result: str) -> float:
+    return LLM_CONTEXT_CACHE_LOOKUPS.labels(result=result)._value.get()
+
+
+def _cleanup() -> None:
+    context_cache.invalidate(WA_ID)
+    with get_session() as session:
+        session.query(ConversationModel).filter(ConversationModel.wa_id == WA_ID).delete()
+        session.query(CustomerModel).filter(CustomerModel.wa_id == WA_ID).delete()
+        session.commit()
+
+
+def test_cache_keeps_newest_rows_and_evicts_least_recent_conversation():
+    cache = ConversationContextCache(max_conversations=2)
+    cache.store("a", 2, [(1, "user", "one", "2025-01-01", "10:00"), (2, "assistant", "two", "2025-01-01", "10:01")])
+    cache.extend("a", [(3, "user", "three", "2025-01-01", "10:02")])
+    last_id, rows = cache.get("a", 2)
+    assert last_id == 3
+    assert [row[-1] for row in rows] == ["two", "three"]
+    # A different history limit does not reuse the entry
+    assert cache.get("a", 5) is None
+
+    cache.store("b", 2, [(4, "user", "b", "2025-01-01", "10:00")])
+    cache.store("c", 2, [(5, "user", "c", "2025-01-01", "10:00")])
+    assert cache.get("a", 2) is None
+    assert len(cache) == 2
+
+
+def test_retrieve_messages_is_served_from_cache_and_picks_up_external_rows():
+    init_models()
+    _cleanup()
+    try:
+        append_message(WA_ID, "user", "hello", "2025-01-01", "10:00:00")
+        assert retrieve_messages(WA_ID) == [{"role": "user", "content": "hello"}]
+
+        # Written through append_message in this process: the cache is extended in place
+        append_message(WA_ID, "secretary", "welcome", "2025-01-01", "10:00:05")
+        hits = _lookups("hit")
+        assert retrieve_messages(WA_ID)[-1] == {"role": "assistant", "content": "welcome"}
+        assert _lookups("hit") == hits + 1
+
+        # Written by another process: only the newer rows are read
+        with get_session() as session:
+            session.add(ConversationModel(wa_id=WA_ID, role="user", message="again", date="2025-01-01", time="10:01"))
+            session.commit()
+        deltas = _lookups("delta")
+        assert [m["content"] for m in retrieve_messages(WA_ID)] == ["hello", "welcome", "again"]
+        assert _lookups("delta") == deltas + 1
+
+        clear_conversation_messages(WA_ID)
+        assert retrieve_messages(WA_ID) == []
+    finally:
+        _cleanup()
@@ -0,0 +1,85 @@
+"""
+Tests for the token-budgeted context window and the rolling conversation summary.
+"""
+
+import asyncio
+from unittest import mock
+
+from app.db import ConversationModel, ConversationSummaryModel, CustomerModel, get_session, init_models
+from app.services import context_window
+from app.utils.service_utils import append_messages, context_cache
+
+WA_ID = "966500000916"
+
+
+def _cleanup() -> None:
+    context_cache.invalidate(WA_ID)
+    with get_session() as session:
+        session.query(ConversationSummaryModel).filter(ConversationSummaryModel.wa_id == WA_ID).delete()
+        session.query(ConversationModel).filter(ConversationModel.wa_id == WA_ID).delete()
+        session.query(CustomerModel).filter(CustomerModel.wa_id == WA_ID).delete()
+        session.commit()
+
+
+def test_window_keeps_newest_messages_within_budget_and_opens_with_user():
+    rows = [
+        (1, "user", "x" * 300),
+        (2, "assistant", "y" * 300),
+        (3, "user", "short question"),
+        (4, "assistant", "short answer"),
+        (5, "user", "latest"),
+    ]
+    with (
+        mock.patch.object(context_window, "retrieve_context_rows", return_value=rows),
+        mock.patch.object(context_window, "token_budget", return_value=120),
+        mock.patch.object(context_window, "LLM_CONTEXT_SUMMARY_ENABLED", False),
+    ):
+        window = context_window.build_context(WA_ID, "anthropic")
+
+    assert [m["content"] for m in window.messages] == ["short question", "short answer", "latest"]
+    assert window.summary is None
+
+
+def test_refresh_summary_folds_messages_outside_the_window():
+    init_models()
+    _cleanup()
+
+    class FakeService:
+        def __init__(self) -> None:
+            self.prompts: list[str] = []
+
+        async def complete(self, system_prompt: str, prompt: str, max_tokens: int = 1024) -> str:
+            self.prompts.append(prompt)
+            return f"summary #{len(self.prompts)}"
+
+    service = FakeService()
+    try:
+        append_messages(
+            WA_ID,
+            [("user" if i % 2 == 0 else "assistant", f"message {i}", "2025-01-01", f"10:{i:02d}") for i in range(8)],
+        )
+        rows = context_window.retrieve_context_rows(WA_ID)
+        before_id = rows[6][0]
+
+        with mock.patch("app.services.llm_service.get_llm_service", return_value=service):
+            asyncio.run(context_window.refresh_summary(WA_ID, before_id))
+            # Nothing new left of the window: no second summary call
+            asyncio.run(context_window.refresh_summary(WA_ID, before_id))
+
+        assert len(service.prompts) == 1
+        assert "message 5" in service.prompts[0] and "message 6" not in service.prompts[0]
+        with get_session() as session:
+            record = session.get(ConversationSummaryModel, WA_ID)
+            assert record.summary == "summary #1"
+            assert record.covered_until_id == rows[5][0]
+
+        with (
+            mock.patch.object(context_window, "token_budget", return_value=20),
+            mock.patch.object(context_window, "LLM_CONTEXT_SUMMARY_ENABLED", True),
+        ):
+            window = context_window.build_context(WA_ID, "openai")
+        assert window.summary == "summary #1"
+        first_in_window = next(row_id for row_id, _role, content in rows if content == window.messages[0]["content"])
+        assert window.summarize_before_id == first_in_window
+    finally:
+        _cleanup()
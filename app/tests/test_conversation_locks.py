@@ -0,0 +1,55 @@
+"""
+Tests for the per-wa_id conversation lock registry.
+"""
+
+import asyncio
+
+from app.utils.service_utils import ConversationLockRegistry
+
+
+def test_lock_serializes_same_wa_id_and_is_evicted_when_idle():
+    registry = ConversationLockRegistry()
+    active: list[int] = []
+    overlaps: list[int] = []
+
+    async def job(n: int) -> None:
+        async with registry.lock("966500000001"):
+            if active:
+                overlaps.append(n)
+            active.append(n)
+            await asyncio.sleep(0.01)
+            active.remove(n)
+
+    async def scenario() -> None:
+        await asyncio.gather(*(job(i) for i in range(5)))
+
+    asyncio.run(scenario())
+    assert overlaps == []
+    assert len(registry) == 0
+
+
+def test_cancelled_waiter_does_not_leak_lock_entry():
+    registry = ConversationLockRegistry()
+
+    async def scenario() -> int:
+        release = asyncio.Event()
+
+        async def holder() -> None:
+            async with registry.lock("966500000002"):
+                await release.wait()
+
+        async def waiter() -> None:
+            async with registry.lock("966500000002"):
+                pass
+
+        held = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        release.set()
+        await held
+        return len(registry)
+
+    assert asyncio.run(scenario()) == 0
@@ -0,0 +1,43 @@
+"""
+Tests for the inbound message id dedupe stores.
+"""
+
+import time
+
+from app.db import InboundMessageQueueModel, get_session, init_models
+from app.utils.dedupe import InMemoryDedupeStore, PostgresDedupeStore
+
+
+def test_in_memory_store_rejects_repeats_and_evicts_oldest():
+    store = InMemoryDedupeStore(max_entries=2, ttl_seconds=60)
+    assert store.claim("wamid.1") is True
+    assert store.claim("wamid.1") is False
+    store.claim("wamid.2")
+    store.claim("wamid.3")
+    # Capacity 2: the oldest id was evicted and counts as new again
+    assert store.claim("wamid.1") is True
+    assert store.claim("wamid.3") is False
+
+
+def test_in_memory_store_expires_entries_after_ttl():
+    store = InMemoryDedupeStore(max_entries=10, ttl_seconds=0.05)
+    assert store.claim("wamid.ttl") is True
+    time.sleep(0.1)
+    assert store.claim("wamid.ttl") is True
+
+
+def test_postgres_store_uses_queue_message_id_index():
+    init_models()
+    message_id = "wamid.dedupe-test"
+    with get_session() as session:
+        session.query(InboundMessageQueueModel).filter(InboundMessageQueueModel.message_id == message_id).delete()
+        session.commit()
+
+    store = PostgresDedupeStore()
+    try:
+        assert store.claim(message_id) is True
+        assert store.claim(message_id) is False
+    finally:
+        with get_session() as session:
+            session.query(InboundMessageQueueModel).filter(InboundMessageQueueModel.message_id == message_id).delete()
+            session.commit()
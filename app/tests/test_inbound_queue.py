@@ -0,0 +1,424 @@
+"""
+Tests for the DB-backed inbound message queue.
+"""
+
+import asyncio
+import datetime
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app.db import InboundMessageQueueModel, get_session, init_models
+from app.services.inbound_queue import (
+    MAX_PROCESSING_ATTEMPTS,
+    QueueWakeup,
+    _claim_followups,
+    _claim_one,
+    _finish_items,
+    enqueue_inbound,
+    extract_message_identity,
+    purge_dead_letters,
+    purge_done_items,
+    replay_dead_letters,
+)
+
+TEST_WA_PREFIX = "96670000"
+
+
+def _payload(wa_id: str, message_id: str, text: str = "hello") -> dict:
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [
+            {
+                "changes": [
+                    {
+                        "value": {
+                            "contacts": [{"wa_id": wa_id}],
+                            "messages": [
+                                {"id": message_id, "from": wa_id, "timestamp": "1700000000", "text": {"body": text}}
+                            ],
+                        }
+                    }
+                ]
+            }
+        ],
+    }
+
+
+@pytest.fixture(autouse=True)
+def clean_queue():
+    init_models()
+
+    def _clean():
+        with get_session() as session:
+            session.query(InboundMessageQueueModel).filter(
+                InboundMessageQueueModel.wa_id.like(f"{TEST_WA_PREFIX}%")
+            ).delete(synchronize_session=False)
+            session.commit()
+
+    _clean()
+    yield
+    _clean()
+
+
+def test_extract_message_identity():
+    assert extract_message_identity(_payload(f"{TEST_WA_PREFIX}01", "wamid.A")) == ("wamid.A", f"{TEST_WA_PREFIX}01")
+    assert extract_message_identity({"entry": []}) == (None, None)
+
+
+def test_enqueue_inbound_deduplicates_by_message_id():
+    wa_id = f"{TEST_WA_PREFIX}02"
+    created, _ = enqueue_inbound(_payload(wa_id, "wamid.dup"), "wamid.dup", wa_id)
+    assert created is True
+    created_again, existing_id = enqueue_inbound(_payload(wa_id, "wamid.dup"), "wamid.dup", wa_id)
+    assert created_again is False
+    assert existing_id is not None
+
+    with get_session() as session:
+        count = session.query(InboundMessageQueueModel).filter(InboundMessageQueueModel.wa_id == wa_id).count()
+    assert count == 1
+
+
+def _claim_test_item():
+    with get_session() as session:
+        return _claim_one(session)
+
+
+def _finish(item_id: int) -> None:
+    with get_session() as session:
+        session.get(InboundMessageQueueModel, item_id).status = "done"
+        session.commit()
+
+
+def test_claim_keeps_per_customer_order_and_skips_busy_customers():
+    wa_a, wa_b = f"{TEST_WA_PREFIX}10", f"{TEST_WA_PREFIX}11"
+    enqueue_inbound(_payload(wa_a, "wamid.a1"), "wamid.a1", wa_a)
+    enqueue_inbound(_payload(wa_a, "wamid.a2"), "wamid.a2", wa_a)
+    enqueue_inbound(_payload(wa_b, "wamid.b1"), "wamid.b1", wa_b)
+
+    first = _claim_test_item()
+    second = _claim_test_item()
+    assert (first.message_id, second.message_id) == ("wamid.a1", "wamid.b1")
+    # wa_a already has an item in processing, so its next message must wait
+    assert _claim_test_item() is None
+
+    _finish(first.id)
+    third = _claim_test_item()
+    assert third.message_id == "wamid.a2"
+
+
+def test_claim_followups_takes_consecutive_text_messages_only():
+    wa_id = f"{TEST_WA_PREFIX}20"
+    for message_id in ("wamid.c1", "wamid.c2", "wamid.c3"):
+        enqueue_inbound(_payload(wa_id, message_id), message_id, wa_id)
+    media = _payload(wa_id, "wamid.c4")
+    media["entry"][0]["changes"][0]["value"]["messages"][0] = {"id": "wamid.c4", "type": "image"}
+    enqueue_inbound(media, "wamid.c4", wa_id)
+    enqueue_inbound(_payload(wa_id, "wamid.c5"), "wamid.c5", wa_id)
+
+    with get_session() as session:
+        first = _claim_one(session)
+        followups = _claim_followups(session, first)
+    assert first.message_id == "wamid.c1"
+    assert [row.message_id for row in followups] == ["wamid.c2", "wamid.c3"]
+
+    with get_session() as session:
+        statuses = dict(
+            session.query(InboundMessageQueueModel.message_id, InboundMessageQueueModel.status).filter(
+                InboundMessageQueueModel.wa_id == wa_id
+            )
+        )
+    assert statuses["wamid.c3"] == "processing"
+    assert statuses["wamid.c4"] == "pending"
+
+
+def _fail(item) -> None:
+    with get_session() as session:
+        _finish_items(session, [item], succeeded=False, error="RuntimeError: boom")
+
+
+def test_failed_item_backs_off_then_dead_letters_and_replays():
+    wa_id = f"{TEST_WA_PREFIX}40"
+    enqueue_inbound(_payload(wa_id, "wamid.f1"), "wamid.f1", wa_id)
+
+    item = _claim_test_item()
+    _fail(item)
+    # Backoff keeps the item (and its customer) out of the claim query until next_attempt_at
+    assert _claim_test_item() is None
+
+    with get_session() as session:
+        session.query(InboundMessageQueueModel).filter(InboundMessageQueueModel.id == item.id).update(
+            {"attempts": MAX_PROCESSING_ATTEMPTS - 1, "next_attempt_at": None}
+        )
+        session.commit()
+    _fail(_claim_test_item())
+    with get_session() as session:
+        row = session.get(InboundMessageQueueModel, item.id)
+    assert (row.status, row.last_error) == ("failed", "RuntimeError: boom")
+
+    assert replay_dead_letters([item.id]) == 1
+    replayed = _claim_test_item()
+    assert replayed.id == item.id
+    _fail(replayed)
+    with get_session() as session:
+        session.query(InboundMessageQueueModel).filter(InboundMessageQueueModel.id == item.id).update(
+            {"status": "failed"}
+        )
+        session.commit()
+    assert purge_dead_letters([item.id]) == 1
+
+
+def test_purge_done_items_deletes_only_old_done_rows_in_batches():
+    wa_id = f"{TEST_WA_PREFIX}50"
+    for n in range(5):
+        enqueue_inbound(_payload(wa_id, f"wamid.r{n}"), f"wamid.r{n}", wa_id)
+    with get_session() as session:
+        rows = (
+            session.query(InboundMessageQueueModel)
+            .filter(InboundMessageQueueModel.wa_id == wa_id)
+            .order_by(InboundMessageQueueModel.id)
+            .all()
+        )
+        for row in rows[:3]:
+            row.status = "done"
+            row.created_at = datetime.datetime(2000, 1, 1)
+        rows[3].status = "done"
+        session.commit()
+
+    assert purge_done_items(retention_days=7, batch_size=2) >= 3
+    with get_session() as session:
+        remaining = session.query(InboundMessageQueueModel).filter(InboundMessageQueueModel.wa_id == wa_id).count()
+    assert remaining == 2
+
+
+def test_wakeup_notify_before_wait_is_not_lost():
+    async def scenario() -> float:
+        wakeup = QueueWakeup(listening=True)  # long fallback poll; only a notify can wake quickly
+        wakeup.notify()
+        started = time.monotonic()
+        await wakeup.wait(asyncio.Event())
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 1.0
+
+
+def test_worker_releases_db_connection_while_processing(monkeypatch):
+    import app.services.inbound_queue as inbound_queue
+    from app.db import engine
+
+    wa_id = f"{TEST_WA_PREFIX}30"
+    enqueue_inbound(_payload(wa_id, "wamid.w1"), "wamid.w1", wa_id)
+    checked_out_during_processing: list[int] = []
+
+    async def scenario() -> None:
+        stop_event = asyncio.Event()
+
+        async def fake_process(body, run_llm_function, **kwargs):
+            checked_out_during_processing.append(engine.pool.checkedout())
+            stop_event.set()
+
+        monkeypatch.setattr(inbound_queue, "process_whatsapp_message", fake_process)
+        monkeypatch.setattr(inbound_queue, "get_llm_service", lambda: type("Svc", (), {"run": None})())
+        await asyncio.wait_for(inbound_queue.worker_loop(stop_event, QueueWakeup()), timeout=10)
+
+    asyncio.run(scenario())
+    assert checked_out_during_processing == [0]
+    with get_session() as session:
+        item = session.query(InboundMessageQueueModel).filter(InboundMessageQueueModel.wa_id == wa_id).one()
+    assert item.status == "done"
+
+
+def test_long_turn_keeps_its_claim_fresh(monkeypatch):
+    import app.services.inbound_queue as inbound_queue
+
+    wa_id = f"{TEST_WA_PREFIX}31"
+    enqueue_inbound(_payload(wa_id, "wamid.h1"), "wamid.h1", wa_id)
+    monkeypatch.setattr(inbound_queue, "CLAIM_HEARTBEAT_SECONDS", 0.05)
+    locks: list[datetime.datetime] = []
+
+    def locked_at() -> datetime.datetime:
+        with get_session() as session:
+            item = session.query(InboundMessageQueueModel).filter(InboundMessageQueueModel.wa_id == wa_id).one()
+            return item.locked_at
+
+    async def scenario() -> None:
+        stop_event = asyncio.Event()
+
+        async def slow_process(body, run_llm_function, **kwargs):
+            locks.append(locked_at())
+            await asyncio.sleep(0.3)
+            locks.append(locked_at())
+            stop_event.set()
+
+        monkeypatch.setattr(inbound_queue, "process_whatsapp_message", slow_process)
+        monkeypatch.setattr(inbound_queue, "get_llm_service", lambda: type("Svc", (), {"run": None})())
+        await asyncio.wait_for(inbound_queue.worker_loop(stop_event, QueueWakeup()), timeout=10)
+
+    asyncio.run(scenario())
+    # Refreshed while processing, so another worker does not take the turn over as abandoned
+    assert locks[1] > locks[0]
+
+
+def test_worker_hands_an_unanswered_turn_back_as_a_scheduled_reply_job(monkeypatch):
+    import app.services.inbound_queue as inbound_queue
+    from app.decorators import RetryLaterError
+
+    wa_id = f"{TEST_WA_PREFIX}60"
+    enqueue_inbound(_payload(wa_id, "wamid.d1"), "wamid.d1", wa_id)
+    # The message was just sent, so its reply deadline is still ahead
+    monkeypatch.setattr(inbound_queue, "_message_timestamp", lambda _payload: time.time())
+    replies: list[str] = []
+
+    async def run_worker_once() -> None:
+        stop_event = asyncio.Event()
+
+        async def fake_process(body, run_llm_function, **kwargs):
+            stop_event.set()
+            raise RetryLaterError(120.0, attempts=3)
+
+        async def fake_reply(reply_wa_id, run_llm_function):
+            replies.append(reply_wa_id)
+            stop_event.set()
+
+        monkeypatch.setattr(inbound_queue, "process_whatsapp_message", fake_process)
+        monkeypatch.setattr(inbound_queue, "reply_to_conversation", fake_reply)
+        monkeypatch.setattr(inbound_queue, "_awaits_reply", lambda _wa_id: True)
+        monkeypatch.setattr(inbound_queue, "get_llm_service", lambda: type("Svc", (), {"run": None})())
+        await asyncio.wait_for(inbound_queue.worker_loop(stop_event, QueueWakeup()), timeout=10)
+
+    asyncio.run(run_worker_once())
+    with get_session() as session:
+        rows = (
+            session.query(InboundMessageQueueModel)
+            .filter(InboundMessageQueueModel.wa_id == wa_id)
+            .order_by(InboundMessageQueueModel.id)
+            .all()
+        )
+        assert [row.status for row in rows] == ["done", "pending"]
+        job = rows[1]
+        assert job.message_id is None
+        # Scheduled after the provider's Retry-After hint instead of sleeping in the worker
+        assert job.next_attempt_at > datetime.datetime.utcnow() + datetime.timedelta(seconds=100)
+        assert json.loads(job.payload)["deferred_reply"]["deferrals"] == 1
+        session.query(InboundMessageQueueModel).filter(InboundMessageQueueModel.id == job.id).update(
+            {"next_attempt_at": None}
+        )
+        session.commit()
+
+    asyncio.run(run_worker_once())
+    assert replies == [wa_id]
+    with get_session() as session:
+        assert session.get(InboundMessageQueueModel, job.id).status == "done"
+
+
+def test_failed_llm_reply_is_retried_then_dead_lettered(monkeypatch):
+    import app.services.inbound_queue as inbound_queue
+    from app.db import ConversationModel, CustomerModel
+    from app.utils import whatsapp_utils
+    from app.utils.service_utils import context_cache
+
+    wa_id = f"{TEST_WA_PREFIX}70"
+    enqueue_inbound(_payload(wa_id, "wamid.f1", "are you open today?"), "wamid.f1", wa_id)
+    monkeypatch.setattr(inbound_queue, "_message_timestamp", lambda _payload: time.time())
+    calls: list[str] = []
+
+    async def no_typing(message_id, stop_event):
+        await stop_event.wait()
+
+    async def run_worker_once() -> None:
+        stop_event = asyncio.Event()
+
+        async def failing_run(run_wa_id: str):
+            calls.append(run_wa_id)
+            stop_event.set()
+            raise RuntimeError("model crashed")
+
+        monkeypatch.setattr(inbound_queue, "get_llm_service", lambda: SimpleNamespace(run=failing_run))
+        await asyncio.wait_for(inbound_queue.worker_loop(stop_event, QueueWakeup()), timeout=10)
+
+    def item() -> InboundMessageQueueModel:
+        with get_session() as session:
+            return session.query(InboundMessageQueueModel).filter(InboundMessageQueueModel.wa_id == wa_id).one()
+
+    monkeypatch.setattr(whatsapp_utils, "_typing_indicator_keepalive", no_typing)
+    try:
+        for attempt in range(1, MAX_PROCESSING_ATTEMPTS + 1):
+            asyncio.run(run_worker_once())
+            row = item()
+            assert row.attempts == attempt
+            assert "model crashed" in row.last_error
+            if attempt < MAX_PROCESSING_ATTEMPTS:
+                # Backed off, not marked done without a reply
+                assert row.status == "pending"
+                assert row.next_attempt_at is not None
+                with get_session() as session:
+                    session.query(InboundMessageQueueModel).filter(InboundMessageQueueModel.id == row.id).update(
+                        {"next_attempt_at": None}
+                    )
+                    session.commit()
+
+        assert item().status == "failed"
+        assert calls == [wa_id] * MAX_PROCESSING_ATTEMPTS
+        # Retries only re-ran the reply: the customer's message is stored once
+        with get_session() as session:
+            stored = session.query(ConversationModel.role).filter(ConversationModel.wa_id == wa_id).all()
+        assert [tuple(r) for r in stored] == [("user",)]
+    finally:
+        context_cache.invalidate(wa_id)
+        with get_session() as session:
+            session.query(ConversationModel).filter(ConversationModel.wa_id == wa_id).delete()
+            session.query(CustomerModel).filter(CustomerModel.wa_id == wa_id).delete()
+            session.commit()
+
+
+def test_reply_failing_after_its_tools_ran_is_dead_lettered_without_retry(monkeypatch):
+    import httpx
+
+    import app.services.inbound_queue as inbound_queue
+    from app.db import ConversationModel, CustomerModel
+    from app.services import llm_service
+    from app.services.toolkit.execution import call_tool_async
+    from app.utils import whatsapp_utils
+    from app.utils.service_utils import context_cache
+
+    wa_id = f"{TEST_WA_PREFIX}71"
+    enqueue_inbound(_payload(wa_id, "wamid.t1", "book me for sunday"), "wamid.t1", wa_id)
+    monkeypatch.setattr(inbound_queue, "_message_timestamp", lambda _payload: time.time())
+    bookings: list[str] = []
+    stop_event = asyncio.Event()
+
+    def reserve_time_slot(day: str) -> dict:
+        bookings.append(day)
+        return {"success": True}
+
+    async def run(run_wa_id: str, *, retry: bool = True):
+        await call_tool_async(reserve_time_slot, {"day": "sunday"})
+        stop_event.set()
+        # The API call that would have turned the tool result into a reply
+        raise httpx.ConnectError("connection reset")
+
+    async def no_typing(message_id, stop_event):
+        await stop_event.wait()
+
+    router = llm_service.RoutingLLMService(["anthropic"])
+    router.services = {"anthropic": SimpleNamespace(run=run)}
+    monkeypatch.setattr(inbound_queue, "get_llm_service", lambda: router)
+    monkeypatch.setattr(whatsapp_utils, "_typing_indicator_keepalive", no_typing)
+    try:
+        asyncio.run(asyncio.wait_for(inbound_queue.worker_loop(stop_event, QueueWakeup()), timeout=10))
+
+        with get_session() as session:
+            row = session.query(InboundMessageQueueModel).filter(InboundMessageQueueModel.wa_id == wa_id).one()
+        assert bookings == ["sunday"]
+        # Dead-lettered on the first attempt instead of being rescheduled to book again
+        assert (row.status, row.attempts, row.next_attempt_at) == ("failed", 1, None)
+        assert row.last_error.startswith("ToolCallsRanError")
+        assert json.loads(row.payload)["messages_stored"] is True
+    finally:
+        context_cache.invalidate(wa_id)
+        with get_session() as session:
+            session.query(ConversationModel).filter(ConversationModel.wa_id == wa_id).delete()
+            session.query(CustomerModel).filter(CustomerModel.wa_id == wa_id).delete()
+            session.commit()
@@ -0,0 +1,80 @@
+"""
+Tests for the per-turn LLM latency and token instrumentation.
+"""
+
+import asyncio
+import logging
+from types import SimpleNamespace
+from unittest import mock
+
+from app.services import openai_service
+from app.services.llm_instrumentation import detach_turn, llm_turn, record_tokens
+from app.services.toolkit.execution import call_tool_async
+
+WA_ID = "966500000925"
+
+
+async def _lookup_hours(day: str) -> str:
+    await asyncio.sleep(0)
+    return f"open on {day}"
+
+
+def _response(response_id: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        id=response_id,
+        output=[],
+        usage=SimpleNamespace(
+            input_tokens=1000, output_tokens=50, input_tokens_details=SimpleNamespace(cached_tokens=800)
+        ),
+    )
+
+
+async def _turn() -> None:
+    with llm_turn(WA_ID, "router"), llm_turn(WA_ID, "openai"):
+        await openai_service._create_response_async(None, model="gpt-test", input=[])
+        await call_tool_async(_lookup_hours, {"day": "friday"})
+        await openai_service._create_response_async(None, model="gpt-test", input=[])
+        # Summaries started from the turn are not part of it
+        with detach_turn():
+            record_tokens("openai", "gpt-test", input=5000)
+
+
+def test_turn_record_aggregates_api_calls_tools_and_tokens(caplog):
+    responses = iter([_response("resp_1"), _response("resp_2")])
+
+    async def create(**kwargs):
+        return next(responses)
+
+    with (
+        mock.patch.object(openai_service.async_client.responses, "create", side_effect=create),
+        caplog.at_level(logging.INFO, logger="app.llm_turns"),
+    ):
+        asyncio.run(_turn())
+
+    # The routed provider turn is part of the router turn: one record
+    records = [r.llm_turn for r in caplog.records if hasattr(r, "llm_turn")]
+    assert len(records) == 1
+    turn = records[0]
+    assert turn["wa_id"] == WA_ID
+    assert turn["provider"] == "openai"
+    assert turn["model"] == "gpt-test"
+    assert turn["outcome"] == "ok"
+    assert turn["api_calls"] == 2
+    assert turn["tool_calls"] == 1
+    assert turn["tokens"] == {"input": 400, "output": 100, "cache_read": 1600}
+    assert turn["seconds"] >= turn["api_seconds"]
+
+
+def test_failed_turn_is_logged_with_error_outcome(caplog):
+    async def failing_turn():
+        with llm_turn(WA_ID, "gemini"):
+            raise RuntimeError("boom")
+
+    with caplog.at_level(logging.INFO, logger="app.llm_turns"):
+        try:
+            asyncio.run(failing_turn())
+        except RuntimeError:
+            pass
+
+    records = [r.llm_turn for r in caplog.records if hasattr(r, "llm_turn")]
+    assert [(r["provider"], r["outcome"], r["api_calls"]) for r in records] == [("gemini", "error", 0)]
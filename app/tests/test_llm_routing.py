@@ -0,0 +1,158 @@
+"""
+Tests for LLM provider failover and hedged requests.
+"""
+
+import asyncio
+from unittest import mock
+
+import httpx
+import pytest
+
+from app.decorators import ToolCallsRanError
+from app.services import llm_routing, llm_service
+from app.services.toolkit.execution import call_tool_async
+from app.utils.reply_stream import ReplyInterruptedError, ReplyStream, activate_reply_stream, active_reply_stream
+
+
+class _FakeService:
+    def __init__(
+        self,
+        name: str,
+        delay: float = 0.0,
+        error: Exception | None = None,
+        tool_at: float | None = None,
+        streamed: str | None = None,
+    ):
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.tool_at = tool_at
+        self.streamed = streamed
+        self.calls = 0
+        self.tool_runs = 0
+
+    async def run(self, wa_id: str, *, retry: bool = True):
+        self.calls += 1
+        if self.tool_at is not None:
+            await asyncio.sleep(self.tool_at)
+            await call_tool_async(self._book, {})
+        reply = active_reply_stream()
+        if self.streamed is not None and reply is not None:
+            reply.feed(self.streamed)
+            reply.flush()
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return f"answer from {self.name}", "2025-01-01", "10:00:00"
+
+    def _book(self) -> None:
+        self.tool_runs += 1
+
+    async def complete(self, system_prompt: str, prompt: str, max_tokens: int = 1024) -> str:
+        return self.name
+
+
+@pytest.fixture(autouse=True)
+def _fresh_stats():
+    llm_routing.reset_provider_stats()
+    yield
+    llm_routing.reset_provider_stats()
+
+
+def _router(*services: _FakeService) -> llm_service.RoutingLLMService:
+    router = llm_service.RoutingLLMService([s.name for s in services])
+    router.stream = False
+    router.services = {s.name: s for s in services}
+    return router
+
+
+def test_failing_provider_fails_over_and_is_demoted_after_its_error_budget():
+    primary = _FakeService("anthropic", error=RuntimeError("overloaded"))
+    secondary = _FakeService("openai")
+    router = _router(primary, secondary)
+
+    with mock.patch.object(llm_routing, "LLM_FAILOVER_ERROR_BUDGET", 2):
+        for _ in range(2):
+            assert asyncio.run(router.run("966500000001", retry=False))[0] == "answer from openai"
+
+    assert llm_routing.provider_stats("anthropic").consecutive_failures == 2
+    assert llm_routing.route_order(["anthropic", "openai"]) == ["openai", "anthropic"]
+    # A demoted provider is not tried first anymore
+    asyncio.run(router.run("966500000001", retry=False))
+    assert primary.calls == 2
+
+
+def test_slow_turn_is_hedged_on_the_next_provider():
+    primary = _FakeService("anthropic", delay=1.0)
+    secondary = _FakeService("openai", delay=0.05)
+    router = _router(primary, secondary)
+    for _ in range(llm_routing.LLM_HEDGE_MIN_SAMPLES):
+        llm_routing.provider_stats("anthropic").record_success(0.1)
+
+    with (
+        mock.patch.object(llm_service, "LLM_HEDGE_ENABLED", True),
+        mock.patch.object(llm_routing, "LLM_HEDGE_MIN_DELAY_SECONDS", 0.0),
+    ):
+        result = asyncio.run(asyncio.wait_for(router.run("966500000001", retry=False), timeout=0.8))
+
+    assert result[0] == "answer from openai"
+    assert secondary.calls == 1
+
+
+def test_only_one_hedged_attempt_runs_tools():
+    # The hedge reaches its tool call first: the primary is cancelled before running its own
+    primary = _FakeService("anthropic", tool_at=0.4)
+    secondary = _FakeService("openai", tool_at=0.05, delay=0.05)
+    router = _router(primary, secondary)
+    for _ in range(llm_routing.LLM_HEDGE_MIN_SAMPLES):
+        llm_routing.provider_stats("anthropic").record_success(0.1)
+
+    with (
+        mock.patch.object(llm_service, "LLM_HEDGE_ENABLED", True),
+        mock.patch.object(llm_routing, "LLM_HEDGE_MIN_DELAY_SECONDS", 0.0),
+    ):
+        result = asyncio.run(router.run("966500000001", retry=False))
+
+    assert result[0] == "answer from openai"
+    assert (primary.tool_runs, secondary.tool_runs) == (0, 1)
+
+
+@pytest.mark.parametrize(
+    ("delay", "error", "cause"),
+    [(0.0, httpx.ConnectError("connection reset"), httpx.ConnectError), (1.0, None, asyncio.TimeoutError)],
+)
+def test_no_failover_or_retry_once_a_tool_ran(delay, error, cause):
+    primary = _FakeService("anthropic", delay=delay, error=error, tool_at=0.0)
+    secondary = _FakeService("openai")
+    router = _router(primary, secondary)
+
+    with (
+        mock.patch.object(llm_service, "LLM_FAILOVER_TIMEOUT_SECONDS", 0.2),
+        pytest.raises(ToolCallsRanError) as raised,
+    ):
+        asyncio.run(router.run("966500000001"))
+
+    # The primary's error is surfaced instead of booking again on the secondary or in a retry
+    assert isinstance(raised.value.__cause__, cause)
+    assert (primary.calls, primary.tool_runs, secondary.calls) == (1, 1, 0)
+
+
+def test_no_failover_once_part_of_the_reply_was_sent():
+    primary = _FakeService("anthropic", error=RuntimeError("stream dropped"), streamed="Checking.")
+    secondary = _FakeService("openai", streamed="Sunday is free.")
+    router = _router(primary, secondary)
+    router.stream = True
+    sent: list[str] = []
+
+    async def send(chunk: str) -> None:
+        sent.append(chunk)
+
+    async def scenario() -> str:
+        stream = ReplyStream(send, max_chars=4096, min_chars=0)
+        with activate_reply_stream(stream), pytest.raises(ReplyInterruptedError):
+            await router.run("966500000001")
+        return await stream.close()
+
+    assert asyncio.run(scenario()) == "Checking."
+    assert sent == ["Checking."]
+    assert (primary.calls, secondary.calls) == (1, 0)
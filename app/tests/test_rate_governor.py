@@ -0,0 +1,55 @@
+"""
+Tests for the per-provider LLM rate governor.
+"""
+
+import asyncio
+import time
+
+from app.services.rate_governor import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_CUSTOMER,
+    PRIORITY_SYSTEM_AGENT,
+    llm_priority,
+    rate_limited,
+)
+
+
+def test_waiters_are_admitted_by_priority_within_the_in_flight_cap(monkeypatch):
+    monkeypatch.setenv("LLM_MAX_IN_FLIGHT_PRIORITYTEST", "1")
+    admitted: list[str] = []
+
+    async def request(name: str, priority: int) -> None:
+        with llm_priority(priority):
+            async with rate_limited("prioritytest", "model"):
+                admitted.append(name)
+                await asyncio.sleep(0.01)
+
+    async def scenario() -> None:
+        first = asyncio.create_task(request("first", PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        await asyncio.gather(
+            first,
+            request("summary", PRIORITY_BACKGROUND),
+            request("operator", PRIORITY_SYSTEM_AGENT),
+            request("customer", PRIORITY_CUSTOMER),
+        )
+
+    asyncio.run(scenario())
+    assert admitted == ["first", "customer", "operator", "summary"]
+
+
+def test_token_bucket_delays_requests_until_settled_usage_leaves_room(monkeypatch):
+    # 6000 tokens per minute refill at 100 tokens per second
+    monkeypatch.setenv("LLM_TPM_LIMIT_TPMTEST", "6000")
+
+    async def scenario(actual_tokens: int) -> float:
+        async with rate_limited("tpmtest", "model", 6000) as grant:
+            grant.settle(actual_tokens)
+        started = time.monotonic()
+        async with rate_limited("tpmtest", "model", 50):
+            return time.monotonic() - started
+
+    # The estimate used the whole minute: the next request waits for the refill
+    assert 0.3 < asyncio.run(scenario(6000)) < 1.5
+    # The response used far less than estimated: the difference is returned right away
+    assert asyncio.run(scenario(1000)) < 0.1
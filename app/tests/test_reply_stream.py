@@ -0,0 +1,166 @@
+"""
+Tests for streaming LLM replies to WhatsApp paragraph by paragraph.
+"""
+
+import asyncio
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+import pytest
+from anthropic import APIConnectionError
+
+from app.services import anthropic_service
+from app.services.context_window import ContextWindow
+from app.services.toolkit import execution
+from app.services.toolkit.registry import ToolRegistry
+from app.utils.reply_stream import ReplyInterruptedError, ReplyStream, activate_reply_stream, take_chunks
+
+
+def test_take_chunks_splits_on_paragraphs_within_the_limit():
+    # Complete paragraphs are packed together as long as they fit
+    chunks, rest = take_chunks("first paragraph\n\nsecond paragraph\n\nthird", max_chars=40)
+    assert chunks == ["first paragraph\n\nsecond paragraph"]
+    assert rest == "third"
+    chunks, rest = take_chunks("first paragraph\n\nsecond paragraph\n\nthird", max_chars=20)
+    assert chunks == ["first paragraph", "second paragraph"]
+
+    # Short paragraphs are held back until the chunk is long enough
+    chunks, rest = take_chunks("hi\n\nthere", max_chars=40, min_chars=10)
+    assert chunks == [] and rest == "hi\n\nthere"
+
+    # A paragraph over the limit is cut at the last space that fits
+    chunks, rest = take_chunks("aaaa bbbb cccc dddd", max_chars=10, final=True)
+    assert chunks == ["aaaa bbbb", "cccc dddd"] and rest == ""
+
+
+def test_reply_stream_sends_chunks_in_order_and_coalesces_deltas():
+    sent: list[str] = []
+    deltas: list[str] = []
+
+    async def send(chunk: str) -> None:
+        # Earlier chunks are slower: order must still be kept
+        await asyncio.sleep(0.05 if not sent else 0)
+        sent.append(chunk)
+
+    async def scenario() -> str:
+        stream = ReplyStream(send, deltas.append, max_chars=100, min_chars=0, broadcast_interval=60)
+        for delta in ["Hello", " there.\n", "\nSecond ", "part.\n\nTail"]:
+            stream.feed(delta)
+        return await stream.close()
+
+    text = asyncio.run(scenario())
+    assert sent == ["Hello there.", "Second part.", "Tail"]
+    assert text == "Hello there.\n\nSecond part.\n\nTail"
+    # First delta goes out immediately, the rest is coalesced until close
+    assert deltas == ["Hello", " there.\n\nSecond part.\n\nTail"]
+
+
+class _FakeMessageStream:
+    def __init__(self, texts: list[str], final, error: Exception | None = None) -> None:
+        self._texts = texts
+        self._final = final
+        self._error = error
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        return None
+
+    @property
+    async def text_stream(self):
+        for text in self._texts:
+            await asyncio.sleep(0)
+            yield text
+        if self._error is not None:
+            raise self._error
+
+    async def get_final_message(self):
+        return self._final
+
+
+def _lookup_registry() -> ToolRegistry:
+    return ToolRegistry(
+        name="stream-tools",
+        definitions=[{"name": "lookup", "description": "", "schema": {"type": "object"}}],
+        functions={"lookup": lambda: {"success": True}},
+    )
+
+
+def _tool_turn() -> SimpleNamespace:
+    lookup = SimpleNamespace(type="tool_use", id="t1", name="lookup", input={})
+    return SimpleNamespace(stop_reason="tool_use", content=[SimpleNamespace(type="text", text="Checking."), lookup])
+
+
+def test_claude_async_streams_text_of_each_response_into_the_reply_stream():
+    final = SimpleNamespace(stop_reason="end_turn", content=[SimpleNamespace(type="text", text="Sunday is free.")])
+    streams = iter(
+        [_FakeMessageStream(["Checking."], _tool_turn()), _FakeMessageStream(["Sunday ", "is free."], final)]
+    )
+    registry = _lookup_registry()
+    sent: list[str] = []
+
+    async def send(chunk: str) -> None:
+        sent.append(chunk)
+
+    async def scenario():
+        stream = ReplyStream(send, max_chars=4096, min_chars=0)
+        with activate_reply_stream(stream):
+            result = await anthropic_service.run_claude_async.__wrapped__(
+                "966500000001", "claude-test", max_tokens=64, stream=True, toolkit=registry
+            )
+        return result, await stream.close()
+
+    with (
+        mock.patch.object(
+            anthropic_service.async_client.beta.messages, "stream", side_effect=lambda **_: next(streams)
+        ),
+        mock.patch.object(
+            anthropic_service, "build_context", return_value=ContextWindow([{"role": "user", "content": "hi"}])
+        ),
+        mock.patch.object(execution, "append_messages"),
+    ):
+        (reply_text, _date, _time), delivered = asyncio.run(scenario())
+
+    assert reply_text == "Sunday is free."
+    assert sent == ["Checking.", "Sunday is free."]
+    assert delivered == "Checking.\n\nSunday is free."
+
+
+def test_failure_after_part_of_the_reply_was_sent_is_not_retried():
+    dropped = APIConnectionError(request=httpx.Request("POST", "https://api.anthropic.com/v1/messages"))
+    streams = [_FakeMessageStream(["Checking."], _tool_turn()), _FakeMessageStream(["Sunday "], None, dropped)]
+    opened: list[_FakeMessageStream] = []
+    sent: list[str] = []
+
+    def open_stream(**_):
+        opened.append(streams[len(opened) % 2])
+        return opened[-1]
+
+    async def send(chunk: str) -> None:
+        sent.append(chunk)
+
+    async def scenario() -> str:
+        stream = ReplyStream(send, max_chars=4096, min_chars=0)
+        with activate_reply_stream(stream), pytest.raises(ReplyInterruptedError):
+            await anthropic_service.run_claude_async(
+                "966500000001", "claude-test", max_tokens=64, stream=True, toolkit=_lookup_registry()
+            )
+        # The caller keeps what was sent and drops the cut-off paragraph
+        stream.restart()
+        return await stream.close()
+
+    with (
+        mock.patch.object(anthropic_service.async_client.beta.messages, "stream", side_effect=open_stream),
+        mock.patch.object(
+            anthropic_service, "build_context", return_value=ContextWindow([{"role": "user", "content": "hi"}])
+        ),
+        mock.patch.object(execution, "append_messages"),
+    ):
+        delivered = asyncio.run(scenario())
+
+    # A retry would have sent "Checking." a second time
+    assert len(opened) == 2
+    assert sent == ["Checking."]
+    assert delivered == "Checking."
@@ -0,0 +1,156 @@
+"""
+Tests for continuing OpenAI turns on the stored response instead of resending the history.
+"""
+
+import asyncio
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+from openai import NotFoundError
+
+from app.db import ConversationModel, CustomerModel, ResponseChainModel, get_session, init_models
+from app.services import openai_service, response_chain
+from app.utils.service_utils import append_messages, context_cache
+
+WA_ID = "966500000922"
+
+
+def _cleanup() -> None:
+    context_cache.invalidate(WA_ID)
+    with get_session() as session:
+        session.query(ResponseChainModel).filter(ResponseChainModel.wa_id == WA_ID).delete()
+        session.query(ConversationModel).filter(ConversationModel.wa_id == WA_ID).delete()
+        session.query(CustomerModel).filter(CustomerModel.wa_id == WA_ID).delete()
+        session.commit()
+
+
+def _fake_create(requests: list[dict], expired: set[str]):
+    async def create(**kwargs):
+        requests.append(kwargs)
+        if kwargs.get("previous_response_id") in expired:
+            request = httpx.Request("POST", "https://api.openai.com/v1/responses")
+            raise NotFoundError("Previous response not found", response=httpx.Response(404, request=request), body=None)
+        message = SimpleNamespace(
+            type="message", role="assistant", content=[SimpleNamespace(type="output_text", text="reply")]
+        )
+        return SimpleNamespace(
+            id=f"resp_{len(requests)}",
+            created_at=1700000000,
+            output=[message],
+            usage=SimpleNamespace(input_tokens=100),
+        )
+
+    return create
+
+
+def _reply(text: str) -> SimpleNamespace:
+    message = SimpleNamespace(
+        type="message", role="assistant", content=[SimpleNamespace(type="output_text", text=text)]
+    )
+    return SimpleNamespace(id="resp_1", output=[message], usage=SimpleNamespace(input_tokens=100))
+
+
+def _last_id() -> int:
+    with get_session() as session:
+        return max(row.id for row in session.query(ConversationModel).filter(ConversationModel.wa_id == WA_ID))
+
+
+def _turn() -> str:
+    result = asyncio.run(openai_service.run_openai_async.__wrapped__(WA_ID, "gpt-test", "You are helpful.", store=True))
+    return result[0]
+
+
+def test_turns_continue_the_stored_response_with_only_new_messages():
+    init_models()
+    _cleanup()
+    requests: list[dict] = []
+    expired: set[str] = set()
+    try:
+        with mock.patch.object(
+            openai_service.async_client.responses, "create", side_effect=_fake_create(requests, expired)
+        ):
+            append_messages(WA_ID, [("user", "first question", "2025-01-01", "10:00")])
+            assert _turn() == "reply"
+            assert "previous_response_id" not in requests[0]
+            assert [m["content"] for m in requests[0]["input"]] == ["first question"]
+
+            # The stored reply is already part of resp_1: only the new question is sent
+            append_messages(
+                WA_ID,
+                [("assistant", "reply", "2025-01-01", "10:01"), ("user", "second question", "2025-01-01", "10:02")],
+            )
+            _turn()
+            assert requests[1]["previous_response_id"] == "resp_1"
+            assert requests[1]["input"] == [{"role": "user", "content": "second question"}]
+
+            # An expired chain is dropped and the turn resends the history
+            expired.add("resp_2")
+            append_messages(
+                WA_ID,
+                [("assistant", "reply", "2025-01-01", "10:03"), ("user", "third question", "2025-01-01", "10:04")],
+            )
+            assert _turn() == "reply"
+            assert requests[2]["previous_response_id"] == "resp_2"
+            assert "previous_response_id" not in requests[3]
+            assert [m["content"] for m in requests[3]["input"]][-1] == "third question"
+            assert len(requests[3]["input"]) == 5
+
+        with get_session() as session:
+            assert session.get(ResponseChainModel, WA_ID).response_id == "resp_4"
+    finally:
+        _cleanup()
+
+
+def test_staff_messages_around_the_bot_reply_are_sent_with_the_next_turn():
+    init_models()
+    _cleanup()
+    try:
+        append_messages(WA_ID, [("user", "can I come on sunday?", "2025-01-01", "10:00")])
+        response_chain.save_chain(WA_ID, _reply("Sunday is free.\nShall I book it?"), _last_id())
+        append_messages(
+            WA_ID,
+            [
+                ("assistant", "Dr. Sara is away on sunday.", "2025-01-01", "10:01"),
+                # Streamed replies are stored as the paragraphs that were sent
+                ("assistant", "Sunday is free.\n\nShall I book it?", "2025-01-01", "10:01"),
+                ("assistant", "We can offer monday instead.", "2025-01-01", "10:02"),
+                ("user", "monday works", "2025-01-01", "10:03"),
+            ],
+        )
+
+        turn = response_chain.chained_turn(WA_ID)
+
+        assert turn is not None and turn.response_id == "resp_1"
+        assert turn.messages == [
+            {"role": "assistant", "content": "Dr. Sara is away on sunday."},
+            {"role": "assistant", "content": "We can offer monday instead."},
+            {"role": "user", "content": "monday works"},
+        ]
+        assert turn.last_id == _last_id()
+    finally:
+        _cleanup()
+
+
+def test_chain_is_not_continued_without_a_new_customer_message_or_its_anchor():
+    init_models()
+    _cleanup()
+    try:
+        append_messages(WA_ID, [("user", "hello", "2025-01-01", "10:00")])
+        anchor_id = _last_id()
+        response_chain.save_chain(WA_ID, _reply("Hi!"), anchor_id)
+        append_messages(WA_ID, [("assistant", "Hi!", "2025-01-01", "10:01")])
+        # Nothing new from the customer: there is no turn to continue
+        assert response_chain.chained_turn(WA_ID) is None
+
+        append_messages(WA_ID, [("user", "are you open?", "2025-01-01", "10:02")])
+        assert response_chain.chained_turn(WA_ID).messages == [{"role": "user", "content": "are you open?"}]
+
+        # The anchor left the history (conversation cleared): start over from the full history
+        context_cache.invalidate(WA_ID)
+        with get_session() as session:
+            session.query(ConversationModel).filter(ConversationModel.id == anchor_id).delete()
+            session.commit()
+        assert response_chain.chained_turn(WA_ID) is None
+    finally:
+        _cleanup()
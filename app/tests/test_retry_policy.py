@@ -0,0 +1,64 @@
+"""
+Tests for the deadline-aware LLM retry policy.
+"""
+
+import asyncio
+from unittest import mock
+
+import httpx
+import pytest
+
+from app.decorators import RetryLaterError, retry_deadline, retry_decorator, safety
+
+
+def _rate_limited(retry_after: str) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "https://llm.example/v1/messages")
+    response = httpx.Response(429, headers={"retry-after": retry_after}, request=request)
+    return httpx.HTTPStatusError("rate limited", request=request, response=response)
+
+
+def test_transient_errors_are_retried_with_backoff_capped_at_seconds():
+    calls = 0
+
+    @retry_decorator
+    async def flaky() -> str:
+        nonlocal calls
+        calls += 1
+        if calls < 3:
+            raise httpx.ConnectError("connection reset")
+        return "ok"
+
+    with mock.patch.object(safety, "LLM_RETRY_BACKOFF_MAX_SECONDS", 0.01):
+        assert asyncio.run(flaky()) == "ok"
+    assert calls == 3
+
+
+def test_retry_after_past_the_deadline_asks_the_caller_to_retry_later():
+    calls = 0
+
+    @retry_decorator
+    async def overloaded() -> str:
+        nonlocal calls
+        calls += 1
+        raise _rate_limited("30")
+
+    async def scenario() -> None:
+        with retry_deadline(5):
+            await overloaded()
+
+    with pytest.raises(RetryLaterError) as excinfo:
+        asyncio.run(scenario())
+    # Waiting 30s would overrun the 5s deadline: no in-process sleep at all
+    assert calls == 1
+    assert excinfo.value.retry_after == pytest.approx(30)
+    assert isinstance(excinfo.value.__cause__, httpx.HTTPStatusError)
+
+
+def test_retry_after_headers_are_parsed():
+    assert safety.retry_after_seconds(_rate_limited("2")) == 2
+    request = httpx.Request("POST", "https://llm.example")
+    error = httpx.HTTPStatusError(
+        "", request=request, response=httpx.Response(429, headers={"retry-after-ms": "1500"}, request=request)
+    )
+    assert safety.retry_after_seconds(error) == 1.5
+    assert safety.retry_after_seconds(ValueError()) is None
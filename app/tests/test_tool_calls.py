@@ -0,0 +1,231 @@
+"""
+Tests for tool execution in the LLM tool loops.
+"""
+
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+import pytest
+from anthropic import APIConnectionError
+
+from app.decorators import ToolCallsRanError, safety
+from app.metrics import LLM_TOKENS
+from app.services import anthropic_service, llm_service, openai_service
+from app.services.context_window import ContextWindow
+from app.services.toolkit import execution
+from app.services.toolkit.registry import ToolRegistry
+
+_HELLO_CONTEXT = ContextWindow([{"role": "user", "content": "hi"}])
+
+
+def _slow_registry(started: list[str]) -> ToolRegistry:
+    def slow_lookup(day: str) -> dict:
+        started.append(threading.current_thread().name)
+        time.sleep(0.2)
+        return {"success": True, "day": day}
+
+    async def async_lookup(day: str) -> dict:
+        await asyncio.sleep(0.2)
+        return {"success": True, "day": day}
+
+    definitions = [
+        {"name": "slow_lookup", "description": "", "schema": {"type": "object"}},
+        {"name": "async_lookup", "description": "", "schema": {"type": "object"}},
+    ]
+    return ToolRegistry(
+        name="test-tools",
+        definitions=definitions,
+        functions={"slow_lookup": slow_lookup, "async_lookup": async_lookup},
+    )
+
+
+def _claude_responses():
+    tool_turn = SimpleNamespace(
+        stop_reason="tool_use",
+        content=[
+            SimpleNamespace(type="tool_use", id="t1", name="slow_lookup", input={"day": "sun"}),
+            SimpleNamespace(type="tool_use", id="t2", name="slow_lookup", input={"day": "mon"}),
+            SimpleNamespace(type="tool_use", id="t3", name="async_lookup", input={"day": "tue"}),
+        ],
+    )
+    final = SimpleNamespace(stop_reason="end_turn", content=[SimpleNamespace(type="text", text="done")])
+    return tool_turn, final
+
+
+def test_claude_async_runs_all_tool_uses_of_a_turn_concurrently():
+    tool_turn, final = _claude_responses()
+    requests: list[list] = []
+
+    async def create(**kwargs):
+        requests.append(list(kwargs["messages"]))
+        return tool_turn if len(requests) == 1 else final
+
+    with (
+        mock.patch.object(anthropic_service.async_client.beta.messages, "create", side_effect=create),
+        mock.patch.object(anthropic_service, "build_context", return_value=_HELLO_CONTEXT),
+        mock.patch.object(execution, "append_messages") as append_messages,
+    ):
+        started = time.monotonic()
+        result = asyncio.run(
+            anthropic_service.run_claude_async.__wrapped__(
+                "966500000001", "claude-test", max_tokens=64, toolkit=_slow_registry([])
+            )
+        )
+        elapsed = time.monotonic() - started
+
+    assert result[0] == "done"
+    assert len(requests) == 2
+    assert elapsed < 0.5
+    assistant_turn, tool_results = requests[1][-2], requests[1][-1]
+    assert [block.id for block in assistant_turn["content"]] == ["t1", "t2", "t3"]
+    assert [block["tool_use_id"] for block in tool_results["content"]] == ["t1", "t2", "t3"]
+    # All audit rows of the turn are written once, in call order
+    append_messages.assert_called_once()
+    rows = append_messages.call_args.args[1]
+    summaries = [row[1].split("<summary>")[1].split("</summary>")[0] for row in rows]
+    assert summaries == [
+        "Tool: slow_lookup",
+        "Tool: slow_lookup",
+        "Tool: async_lookup",
+        "Result: slow_lookup",
+        "Result: slow_lookup",
+        "Result: async_lookup",
+    ]
+
+
+def test_claude_turn_is_not_retried_after_its_tools_ran():
+    tool_turn, _final = _claude_responses()
+    requests: list[int] = []
+    started: list[str] = []
+
+    async def create(**kwargs):
+        requests.append(len(kwargs["messages"]))
+        if len(requests) == 1:
+            return tool_turn
+        raise APIConnectionError(request=httpx.Request("POST", "https://api.anthropic.com/v1/messages"))
+
+    service = llm_service.AnthropicService(toolkit=_slow_registry(started))
+    service.stream = False
+    with (
+        mock.patch.object(anthropic_service.async_client.beta.messages, "create", side_effect=create),
+        mock.patch.object(anthropic_service, "build_context", return_value=_HELLO_CONTEXT),
+        mock.patch.object(execution, "append_messages"),
+        mock.patch.object(safety, "LLM_RETRY_BACKOFF_MAX_SECONDS", 0.01),
+        pytest.raises(ToolCallsRanError) as raised,
+    ):
+        asyncio.run(service.run("966500000001"))
+
+    # The connection error after the tools ran is surfaced instead of retrying the whole tool loop
+    assert isinstance(raised.value.__cause__, APIConnectionError)
+    assert len(requests) == 2
+    assert len(started) == 2
+
+
+def test_openai_async_submits_all_function_outputs_together():
+    calls = [
+        SimpleNamespace(type="function_call", name="slow_lookup", arguments='{"day": "sun"}', call_id="c1"),
+        SimpleNamespace(type="function_call", name="async_lookup", arguments='{"day": "mon"}', call_id="c2"),
+    ]
+    message = SimpleNamespace(
+        type="message", role="assistant", content=[SimpleNamespace(type="output_text", text="done")]
+    )
+    requests: list[dict] = []
+
+    async def create(**kwargs):
+        requests.append(kwargs)
+        output = calls if len(requests) == 1 else [message]
+        return SimpleNamespace(id=f"resp_{len(requests)}", created_at=1700000000, output=output)
+
+    with (
+        mock.patch.object(openai_service.async_client.responses, "create", side_effect=create),
+        mock.patch.object(execution, "append_messages"),
+    ):
+        started = time.monotonic()
+        text, _ = asyncio.run(
+            openai_service.run_responses_async(
+                "966500000001", [{"role": "user", "content": "hi"}], "gpt-test", "", toolkit=_slow_registry([])
+            )
+        )
+        elapsed = time.monotonic() - started
+
+    assert text == "done"
+    assert elapsed < 0.35
+    follow_up = requests[1]
+    assert follow_up["previous_response_id"] == "resp_1"
+    assert [item["call_id"] for item in follow_up["input"]] == ["c1", "c1", "c2", "c2"]
+
+
+def test_claude_requests_cache_history_and_tool_transcript_and_export_usage():
+    tool_turn, final = _claude_responses()
+    usage = SimpleNamespace(
+        input_tokens=10, output_tokens=5, cache_read_input_tokens=1200, cache_creation_input_tokens=300
+    )
+    tool_turn.usage = final.usage = usage
+    requests: list[dict] = []
+
+    async def create(**kwargs):
+        requests.append(kwargs)
+        return tool_turn if len(requests) == 1 else final
+
+    history = ContextWindow(
+        [
+            {"role": "user", "content": "hi"},
+            {"role": "assistant", "content": "hello"},
+            {"role": "user", "content": "any slots on sunday?"},
+        ],
+        summary="Customer booked last week.",
+    )
+    registry = _slow_registry([])
+    registry = ToolRegistry(
+        name="cached-tools",
+        definitions=[{**d, "cache_control": {"type": "ephemeral"}} for d in registry.definitions],
+        functions=registry.functions,
+    )
+    cache_reads = LLM_TOKENS.labels(provider="anthropic", model="claude-test", kind="cache_read")._value.get()
+
+    with (
+        mock.patch.object(anthropic_service.async_client.beta.messages, "create", side_effect=create),
+        mock.patch.object(anthropic_service, "build_context", return_value=history),
+        mock.patch.object(execution, "append_messages"),
+    ):
+        asyncio.run(
+            anthropic_service.run_claude_async.__wrapped__(
+                "966500000001", "claude-test", max_tokens=64, toolkit=registry
+            )
+        )
+
+    def breakpoints(request: dict) -> list[str]:
+        marked = [f"system:{i}" for i, block in enumerate(request["system"]) if "cache_control" in block]
+        marked += [f"tool:{tool['name']}" for tool in request["tools"] if "cache_control" in tool]
+        for i, message in enumerate(request["messages"]):
+            if isinstance(message["content"], list) and any(
+                isinstance(block, dict) and "cache_control" in block for block in message["content"]
+            ):
+                marked.append(f"message:{i}")
+        return marked
+
+    # System prompt and summary, then the newest history message; no room left for tool breakpoints
+    assert breakpoints(requests[0]) == ["system:0", "system:1", "message:2"]
+    # Follow-up: the stable history breakpoint stays and the tool results get their own
+    assert breakpoints(requests[1]) == ["system:0", "system:1", "message:2", "message:4"]
+    # The conversation itself is not mutated by the markers
+    assert history.messages[2] == {"role": "user", "content": "any slots on sunday?"}
+    assert (
+        LLM_TOKENS.labels(provider="anthropic", model="claude-test", kind="cache_read")._value.get()
+        == cache_reads + 2400
+    )
+
+
+def test_tool_specs_are_compiled_once_per_registry():
+    first = _slow_registry([])
+    second = _slow_registry([])
+
+    assert anthropic_service._tool_specs(first, 1) is anthropic_service._tool_specs(first, 1)
+    assert anthropic_service._tool_specs(second, 1) is not anthropic_service._tool_specs(first, 1)
+    assert openai_service.get_function_definitions(first) is openai_service.get_function_definitions(first)
+    # Registries sharing a name no longer share specs
+    assert openai_service.get_function_definitions(second) is not openai_service.get_function_definitions(first)
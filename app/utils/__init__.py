@@ -4,6 +4,9 @@ from .logging_utils import log_http_response as log_http_response
 from .service_utils import (
     append_message as append_message,
 )
+from .service_utils import (
+    append_messages as append_messages,
+)
 from .service_utils import (
     filter_past_time_slots as filter_past_time_slots,
 )
@@ -0,0 +1,175 @@
+"""Opt-in cache of LLM answers to questions that open a conversation.
+
+A first message such as "where are you located" or "what are your hours" reaches the model with the same
+input every time: the system prompt, the configuration and the question. When LLM_ANSWER_CACHE_ENABLED is
+set, such an answer is kept and replayed to the next customer who opens with the same question, skipping
+the LLM round-trip. Only answers produced without tool calls are stored.
+
+Entries are keyed on the normalized question text and a content version covering the app configuration,
+the vacation periods, the system prompt and the local date, so answers never outlive the data they were
+generated from. Updates of the configuration or vacations also clear the cache of the process right away
+(``invalidate_answers``). Entries expire after LLM_ANSWER_CACHE_TTL_SECONDS.
+"""
+
+import datetime
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import exists, func, select
+
+from app.config import config
+from app.db import ConversationModel, VacationPeriodModel, get_session
+from app.metrics import LLM_ANSWER_CACHE_INVALIDATIONS, LLM_ANSWER_CACHE_LOOKUPS
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+
+LLM_ANSWER_CACHE_ENABLED = os.environ.get("LLM_ANSWER_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+LLM_ANSWER_CACHE_TTL_SECONDS = _env_float("LLM_ANSWER_CACHE_TTL_SECONDS", 6 * 3600)
+LLM_ANSWER_CACHE_MAX_ENTRIES = int(_env_float("LLM_ANSWER_CACHE_MAX_ENTRIES", 500))
+# Shorter openers ("hi", "ok") are greetings or replies to something else, not questions worth caching
+LLM_ANSWER_CACHE_MIN_CHARS = int(_env_float("LLM_ANSWER_CACHE_MIN_CHARS", 10))
+
+# Arabic diacritics and tatweel, and letter variants customers use interchangeably
+_ARABIC_MARKS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+_ARABIC_VARIANTS = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ى": "ي", "ة": "ه"})
+
+
+def normalize_question(text: str) -> str:
+    """Case, punctuation, emoji, whitespace and Arabic spelling variants folded away."""
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    text = _ARABIC_MARKS.sub("", text).translate(_ARABIC_VARIANTS)
+    kept = (" " if unicodedata.category(ch)[0] in "PSZC" else ch for ch in text)
+    return " ".join("".join(kept).split())
+
+
+class AnswerCache:
+    """LRU of answers with a TTL; shared by the event loop and worker threads."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, answer = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return answer
+
+    def put(self, key: str, answer: str) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+answer_cache = AnswerCache(LLM_ANSWER_CACHE_MAX_ENTRIES, LLM_ANSWER_CACHE_TTL_SECONDS)
+
+
+def invalidate_answers(reason: str) -> None:
+    """Drop every cached answer; called when the configuration or the vacation periods change."""
+    if not LLM_ANSWER_CACHE_ENABLED:
+        return
+    answer_cache.clear()
+    LLM_ANSWER_CACHE_INVALIDATIONS.labels(reason=reason).inc()
+
+
+def content_version(session) -> str:
+    """Fingerprint of everything besides the question that shapes an opening answer."""
+    from app.services.domain.config.config_models import AppConfigModel
+
+    config_row = session.execute(select(func.max(AppConfigModel.id), func.max(AppConfigModel.updated_at))).one()
+    vacation_row = session.execute(
+        select(
+            func.count(VacationPeriodModel.id),
+            func.max(VacationPeriodModel.id),
+            func.max(VacationPeriodModel.updated_at),
+        )
+    ).one()
+    try:
+        today = datetime.datetime.now(ZoneInfo(config.get("TIMEZONE") or "UTC")).date()
+    except Exception:
+        today = datetime.datetime.utcnow().date()
+    parts = [
+        tuple(config_row),
+        tuple(vacation_row),
+        config.get("SYSTEM_PROMPT"),
+        config.get("VACATION_MESSAGE"),
+        config.get("LLM_PROVIDER"),
+        today,
+    ]
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+def answer_key(wa_id: str, question: str) -> str | None:
+    """Cache key of ``question`` when it opens the conversation of ``wa_id``, otherwise None.
+
+    Must be called before the question is stored.
+    """
+    if not LLM_ANSWER_CACHE_ENABLED:
+        return None
+    normalized = normalize_question(question)
+    if len(normalized) < LLM_ANSWER_CACHE_MIN_CHARS:
+        return None
+    try:
+        with get_session() as session:
+            if session.execute(select(exists().where(ConversationModel.wa_id == wa_id))).scalar():
+                return None
+            version = content_version(session)
+    except Exception as e:
+        logging.warning(f"Answer cache lookup skipped for {wa_id}: {e}")
+        return None
+    return hashlib.sha256(f"{version}\n{normalized}".encode()).hexdigest()
+
+
+def cached_answer(key: str | None) -> str | None:
+    if key is None:
+        return None
+    answer = answer_cache.get(key)
+    LLM_ANSWER_CACHE_LOOKUPS.labels(result="hit" if answer else "miss").inc()
+    return answer
+
+
+def store_answer(key: str | None, wa_id: str, answer: str | None) -> None:
+    """Keep ``answer`` unless the turn called tools (its answer then depends on live data)."""
+    if key is None or not answer:
+        return
+    try:
+        with get_session() as session:
+            used_tools = session.execute(
+                select(exists().where(ConversationModel.wa_id == wa_id, ConversationModel.role == "tool"))
+            ).scalar()
+    except Exception as e:
+        logging.warning(f"Answer cache store skipped for {wa_id}: {e}")
+        return
+    if used_tools:
+        LLM_ANSWER_CACHE_LOOKUPS.labels(result="uncacheable").inc()
+        return
+    answer_cache.put(key, answer)
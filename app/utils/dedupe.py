@@ -0,0 +1,111 @@
+"""Idempotency stores for inbound WhatsApp message ids.
+
+Meta may deliver the same message more than once. ``claim_message_id`` records a message id and
+reports whether it is new, using the backend selected by MESSAGE_DEDUPE_BACKEND:
+
+- ``memory`` (default): per-process LRU with TTL eviction.
+- ``postgres``: shared across processes and restarts through the unique ``message_id`` index of
+  ``inbound_message_queue``; entries expire with the queue retention job.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Protocol
+
+MESSAGE_DEDUPE_BACKEND = os.environ.get("MESSAGE_DEDUPE_BACKEND", "memory").lower()
+
+try:
+    MESSAGE_DEDUPE_TTL_SECONDS = float(os.environ.get("MESSAGE_DEDUPE_TTL_SECONDS", "86400"))
+except ValueError:
+    MESSAGE_DEDUPE_TTL_SECONDS = 86400.0
+
+try:
+    MESSAGE_DEDUPE_MAX_ENTRIES = int(os.environ.get("MESSAGE_DEDUPE_MAX_ENTRIES", "10000"))
+except ValueError:
+    MESSAGE_DEDUPE_MAX_ENTRIES = 10000
+
+
+class DedupeStore(Protocol):
+    def claim(self, message_id: str) -> bool:
+        """Record message_id; return True if it was not seen before (the caller should process it)."""
+        ...
+
+
+class InMemoryDedupeStore:
+    """Bounded LRU of message ids with TTL eviction, local to the current process."""
+
+    def __init__(
+        self, max_entries: int = MESSAGE_DEDUPE_MAX_ENTRIES, ttl_seconds: float = MESSAGE_DEDUPE_TTL_SECONDS
+    ) -> None:
+        self._entries: OrderedDict[str, float] = OrderedDict()
+        self._max_entries = max(1, max_entries)
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+    def claim(self, message_id: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._entries.get(message_id)
+            if expires_at is not None and expires_at > now:
+                return False
+            self._entries[message_id] = now + self._ttl_seconds
+            self._entries.move_to_end(message_id)
+            # Oldest entries sit at the front: drop expired ones and anything over capacity
+            while self._entries:
+                oldest_id, oldest_expiry = next(iter(self._entries.items()))
+                if oldest_expiry > now and len(self._entries) <= self._max_entries:
+                    break
+                del self._entries[oldest_id]
+            return True
+
+
+class PostgresDedupeStore:
+    """Claims message ids through the unique index on ``inbound_message_queue.message_id``.
+
+    Unknown ids are inserted as ``done`` marker rows. The retention job deletes them together with
+    processed queue items.
+    """
+
+    def claim(self, message_id: str) -> bool:
+        from sqlalchemy import text
+        from sqlalchemy.dialects.postgresql import insert
+
+        from app.db import InboundMessageQueueModel, get_session
+
+        stmt = (
+            insert(InboundMessageQueueModel)
+            .values(message_id=message_id, payload="{}", status="done", attempts=0)
+            .on_conflict_do_nothing(index_elements=["message_id"], index_where=text("message_id IS NOT NULL"))
+            .returning(InboundMessageQueueModel.id)
+        )
+        with get_session() as session:
+            inserted_id = session.execute(stmt).scalar_one_or_none()
+            session.commit()
+        return inserted_id is not None
+
+
+_store: DedupeStore | None = None
+
+
+def get_dedupe_store() -> DedupeStore:
+    global _store
+    if _store is None:
+        if MESSAGE_DEDUPE_BACKEND == "postgres":
+            _store = PostgresDedupeStore()
+        else:
+            if MESSAGE_DEDUPE_BACKEND != "memory":
+                logging.warning(f"Unknown MESSAGE_DEDUPE_BACKEND={MESSAGE_DEDUPE_BACKEND!r}; using memory")
+            _store = InMemoryDedupeStore()
+    return _store
+
+
+def claim_message_id(message_id: str) -> bool:
+    """Return True if message_id is new. Store failures fail open so a message is never silently lost."""
+    try:
+        return get_dedupe_store().claim(message_id)
+    except Exception as e:
+        logging.warning(f"Message dedupe store failed for {message_id}: {e}")
+        return True
@@ -24,6 +24,14 @@ async_client = httpx.AsyncClient(
     verify=ssl_context,
 )
 
+# Asynchronous client dedicated to LLM SDKs (AsyncAnthropic/AsyncOpenAI): long reads, and a larger pool
+# since every in-flight conversation holds a connection while the model generates
+async_llm_client = httpx.AsyncClient(
+    verify=ssl_context,
+    timeout=httpx.Timeout(600.0, connect=10.0, read=600.0, write=30.0),
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=200),
+)
+
 # Client health check and reset lock
 _client_lock = asyncio.Lock()
 
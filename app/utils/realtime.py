@@ -1,8 +1,11 @@
 import asyncio
 import contextlib
 import datetime
+import itertools
 import json
 import logging
+import queue
+import threading
 from dataclasses import dataclass
 from typing import Any
 from zoneinfo import ZoneInfo
@@ -11,9 +14,22 @@ from fastapi import APIRouter, FastAPI, WebSocket, WebSocketDisconnect
 from prometheus_client import generate_latest
 
 from app.config import config
+from app.utils.answer_cache import invalidate_answers
 
 NOTIFICATION_HISTORY_LIMIT = 100
 
+# Standalone inbound workers (app.worker) have no WebSocket clients; they publish their events on this
+# Postgres channel and every API process re-broadcasts them to its own clients.
+BROADCAST_RELAY_CHANNEL = "realtime_broadcast"
+BROADCAST_RELAY_MAX_PAYLOAD_BYTES = 7900  # NOTIFY payloads are limited to 8000 bytes
+BROADCAST_RELAY_RECONNECT_SECONDS = 5.0
+BROADCAST_RELAY_QUEUE_SIZE = 1000  # events waiting for the publisher thread; newer ones are dropped beyond it
+BROADCAST_RELAY_BATCH_SIZE = 100  # events published per round trip
+_broadcast_relay_enabled = False
+_broadcast_relay_queue: "queue.Queue[str]" = queue.Queue(maxsize=BROADCAST_RELAY_QUEUE_SIZE)
+# Postgres folds identical payloads of one transaction into one notification; a sequence keeps them apart
+_broadcast_relay_seq = itertools.count()
+
 
 def _utc_iso_now() -> str:
     dt = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
@@ -792,6 +808,7 @@ async def websocket_endpoint(websocket: WebSocket) -> None:
                             for s_date, e_date, title in pairs:
                                 session.add(VacationPeriodModel(start_date=s_date, end_date=e_date, title=title))
                             session.commit()
+                        invalidate_answers("vacations")
                     except Exception as e:
                         logging.error(f"DB persist failed: {e}")
                         await conn.send_json(
@@ -833,9 +850,81 @@ async def broadcast(
     # Include source in data if provided to track event origin (assistant vs frontend)
     if source:
         data = {**data, "_source": source}
+    if _broadcast_relay_enabled:
+        _publish_broadcast_relay(event_type, data, affected_entities)
+        return
     await manager.broadcast(event_type, data, affected_entities)
 
 
+def enable_broadcast_relay() -> None:
+    """Publish events through Postgres instead of the local manager (for processes without WebSocket clients)."""
+    global _broadcast_relay_enabled
+    if _broadcast_relay_enabled:
+        return
+    _broadcast_relay_enabled = True
+    threading.Thread(target=_broadcast_relay_publisher, name="broadcast-relay", daemon=True).start()
+
+
+def _publish_broadcast_relay(event_type: str, data: dict[str, Any], affected_entities: list[str] | None) -> None:
+    """Hand an event to the publisher thread; never blocks the caller (stream deltas come from the event loop)."""
+    payload = json.dumps(
+        {"type": event_type, "data": data, "affected": affected_entities, "seq": next(_broadcast_relay_seq)},
+        ensure_ascii=False,
+        default=str,
+    )
+    if len(payload.encode("utf-8")) > BROADCAST_RELAY_MAX_PAYLOAD_BYTES:
+        logging.warning(f"broadcast relay dropped oversized event: {event_type}")
+        return
+    try:
+        _broadcast_relay_queue.put_nowait(payload)
+    except queue.Full:
+        logging.warning(f"broadcast relay queue full, dropped event: {event_type}")
+
+
+def _broadcast_relay_publisher() -> None:
+    """Publish queued events in order, everything queued since the last round trip in one statement."""
+    from sqlalchemy import text
+
+    from app.db import engine
+
+    # unnest yields the payloads in array order, and notifications are delivered in the order they were sent
+    statement = text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload")
+    while True:
+        payloads = [_broadcast_relay_queue.get()]
+        with contextlib.suppress(queue.Empty):
+            while len(payloads) < BROADCAST_RELAY_BATCH_SIZE:
+                payloads.append(_broadcast_relay_queue.get_nowait())
+        try:
+            with engine.begin() as conn:
+                conn.execute(statement, {"channel": BROADCAST_RELAY_CHANNEL, "payloads": payloads})
+        except Exception as e:
+            logging.warning(f"broadcast relay publish failed for {len(payloads)} events: {e}")
+
+
+async def broadcast_relay_listener(stop_event: asyncio.Event) -> None:
+    """Re-broadcast events published by standalone inbound workers to this process's clients."""
+    import psycopg
+
+    from app.db import psycopg_conninfo
+
+    while not stop_event.is_set():
+        try:
+            conn = await psycopg.AsyncConnection.connect(psycopg_conninfo(), autocommit=True)
+            async with conn:
+                await conn.execute(f"LISTEN {BROADCAST_RELAY_CHANNEL}")
+                async for notify in conn.notifies():
+                    try:
+                        event = json.loads(notify.payload)
+                        await manager.broadcast(event["type"], event["data"], event.get("affected"))
+                    except Exception as e:
+                        logging.debug(f"broadcast relay event skipped: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"broadcast relay LISTEN connection failed: {e}")
+        await asyncio.sleep(BROADCAST_RELAY_RECONNECT_SECONDS)
+
+
 def enqueue_broadcast(
     event_type: str, data: dict[str, Any], affected_entities: list[str] | None = None, source: str | None = None
 ) -> None:
@@ -843,6 +932,10 @@ def enqueue_broadcast(
     if source:
         data = {**data, "_source": source}
 
+    if _broadcast_relay_enabled:
+        _publish_broadcast_relay(event_type, data, affected_entities)
+        return
+
     # Prefer scheduling on the current running loop if present (i.e., inside ASGI handlers)
     try:
         loop = asyncio.get_running_loop()
@@ -0,0 +1,175 @@
+"""Incremental delivery of an LLM reply while it is still being generated.
+
+The inbound message handler activates a ``ReplyStream`` for the turn and streaming-capable runners feed
+text deltas into ``active_reply_stream()``. Completed paragraphs are packed into messages of at most
+``max_chars`` and handed to ``send`` in order, without holding up the stream, while the raw deltas are
+forwarded (coalesced) to an optional observer such as the dashboard broadcast.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import logging
+import os
+import time
+from collections.abc import Awaitable, Callable, Iterator
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+
+LLM_STREAM_ENABLED = os.environ.get("LLM_STREAM_ENABLED", "false").lower() in ("1", "true", "yes")
+# Shorter paragraphs wait for the next one so a reply is not sent one line per message
+LLM_STREAM_MIN_CHARS = int(_env_float("LLM_STREAM_MIN_CHARS", 200))
+LLM_STREAM_BROADCAST_INTERVAL_SECONDS = _env_float("LLM_STREAM_BROADCAST_INTERVAL_SECONDS", 0.25)
+
+PARAGRAPH_SEPARATOR = "\n\n"
+
+_current_reply_stream: contextvars.ContextVar["ReplyStream | None"] = contextvars.ContextVar(
+    "current_reply_stream", default=None
+)
+
+
+class ReplyInterruptedError(Exception):
+    """An attempt failed after part of its reply reached the customer; it must not be generated again."""
+
+
+def take_chunks(buffer: str, max_chars: int, min_chars: int = 0, final: bool = False) -> tuple[list[str], str]:
+    """Split complete paragraphs off ``buffer``; returns (chunks of at most ``max_chars``, remainder).
+
+    A chunk ends on a paragraph boundary once it holds at least ``min_chars``. A single paragraph longer
+    than ``max_chars`` is cut at the last line break or space that fits. With ``final`` the remainder is
+    returned as a chunk too.
+    """
+    chunks: list[str] = []
+    while buffer:
+        cut = buffer.rfind(PARAGRAPH_SEPARATOR, 0, max_chars + len(PARAGRAPH_SEPARATOR))
+        if cut != -1 and len(buffer[:cut].strip()) >= min_chars:
+            chunk, buffer = buffer[:cut], buffer[cut + len(PARAGRAPH_SEPARATOR) :]
+        elif len(buffer) > max_chars:
+            cut = max(buffer.rfind("\n", 0, max_chars), buffer.rfind(" ", 0, max_chars))
+            if cut <= 0:
+                cut = max_chars
+            chunk, buffer = buffer[:cut], buffer[cut:]
+        elif final:
+            chunk, buffer = buffer, ""
+        else:
+            break
+        chunk = chunk.strip()
+        if chunk:
+            chunks.append(chunk)
+    return chunks, buffer
+
+
+class ReplyStream:
+    """Collects streamed text of one reply and sends it paragraph by paragraph.
+
+    ``feed`` never waits on the network: chunks are sent by a chain of tasks that preserves their order.
+    ``chunks`` holds everything handed to ``send`` so the caller can store exactly what the customer got.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[object]],
+        on_delta: Callable[[str], None] | None = None,
+        *,
+        max_chars: int,
+        min_chars: int = LLM_STREAM_MIN_CHARS,
+        broadcast_interval: float = LLM_STREAM_BROADCAST_INTERVAL_SECONDS,
+    ) -> None:
+        self._send = send
+        self._on_delta = on_delta
+        self.max_chars = max_chars
+        self.min_chars = min_chars
+        self.broadcast_interval = broadcast_interval
+        self.chunks: list[str] = []
+        self._buffer = ""
+        self._pending_delta = ""
+        self._last_delta_at = 0.0
+        self._sending: asyncio.Task | None = None
+
+    @property
+    def delivered(self) -> bool:
+        return bool(self.chunks)
+
+    @property
+    def text(self) -> str:
+        return PARAGRAPH_SEPARATOR.join(self.chunks)
+
+    def feed(self, delta: str) -> None:
+        if not delta:
+            return
+        self._buffer += delta
+        self._observe(delta)
+        chunks, self._buffer = take_chunks(self._buffer, self.max_chars, self.min_chars)
+        for chunk in chunks:
+            self._enqueue(chunk)
+
+    def flush(self) -> None:
+        """Send whatever is buffered; runners call this when a streamed response ends."""
+        chunks, self._buffer = take_chunks(self._buffer, self.max_chars, final=True)
+        for chunk in chunks:
+            self._enqueue(chunk)
+
+    def restart(self) -> None:
+        """Drop unsent text of a failed attempt.
+
+        Runners restart before generating the reply again, which they only do while nothing was ``delivered``;
+        past that point they raise ReplyInterruptedError and the caller finishes with what was sent.
+        """
+        self._buffer = ""
+
+    async def close(self) -> str:
+        """Flush, wait until every chunk was handed to ``send`` and return the delivered text."""
+        self.flush()
+        self._emit_delta()
+        if self._sending is not None:
+            await self._sending
+        return self.text
+
+    def _enqueue(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self._sending = asyncio.get_running_loop().create_task(self._deliver(self._sending, chunk))
+
+    async def _deliver(self, previous: asyncio.Task | None, chunk: str) -> None:
+        if previous is not None:
+            await previous
+        try:
+            await self._send(chunk)
+        except Exception as e:
+            logging.error(f"Sending streamed reply chunk failed: {e}")
+
+    def _observe(self, delta: str) -> None:
+        if self._on_delta is None:
+            return
+        self._pending_delta += delta
+        if time.monotonic() - self._last_delta_at >= self.broadcast_interval:
+            self._emit_delta()
+
+    def _emit_delta(self) -> None:
+        if self._on_delta is None or not self._pending_delta:
+            return
+        delta, self._pending_delta = self._pending_delta, ""
+        self._last_delta_at = time.monotonic()
+        try:
+            self._on_delta(delta)
+        except Exception as e:
+            logging.debug(f"Reply stream delta observer failed: {e}")
+
+
+def active_reply_stream() -> ReplyStream | None:
+    """The reply stream of the turn being generated in this context, if the caller opened one."""
+    return _current_reply_stream.get()
+
+
+@contextlib.contextmanager
+def activate_reply_stream(stream: ReplyStream | None) -> Iterator[ReplyStream | None]:
+    token = _current_reply_stream.set(stream)
+    try:
+        yield stream
+    finally:
+        _current_reply_stream.reset(token)
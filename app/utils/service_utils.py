@@ -1,8 +1,12 @@
 import asyncio
 import datetime
 import logging
+import os
 import platform
 import re
+import threading
+import time
+from collections import OrderedDict
 from datetime import timedelta
 from zoneinfo import ZoneInfo
 
@@ -12,11 +16,168 @@ from hijri_converter import convert
 from sqlalchemy import and_, select, text
 
 from app.config import config
-from app.db import ConversationModel, CustomerModel, ReservationModel, VacationPeriodModel, get_session
+from app.db import (
+    ConversationModel,
+    ConversationSummaryModel,
+    CustomerModel,
+    ReservationModel,
+    ResponseChainModel,
+    VacationPeriodModel,
+    get_session,
+)
 from app.i18n import get_message
+from app.metrics import (
+    CONVERSATION_LOCK_WAIT_SECONDS,
+    CONVERSATION_LOCK_WAITERS,
+    CONVERSATION_LOCKS_LIVE,
+    LLM_CONTEXT_CACHE_LOOKUPS,
+)
 
-# Global in-memory dictionary to store asyncio locks per user (wa_id)
-global_locks = {}
+
+class ConversationLockRegistry:
+    """Per-wa_id asyncio locks that are dropped as soon as nobody holds or waits on them.
+
+    Each entry is refcounted by the coroutines currently holding or waiting for it, so the
+    registry only grows with concurrently active conversations, not with every customer ever seen.
+    """
+
+    def __init__(self):
+        self._locks = {}  # wa_id -> [asyncio.Lock, refcount]
+
+    def __len__(self):
+        return len(self._locks)
+
+    def lock(self, wa_id):
+        return _ConversationLock(self, wa_id)
+
+    def _acquire_entry(self, wa_id):
+        entry = self._locks.get(wa_id)
+        if entry is None:
+            entry = self._locks[wa_id] = [asyncio.Lock(), 0]
+            CONVERSATION_LOCKS_LIVE.set(len(self._locks))
+        entry[1] += 1
+        return entry[0]
+
+    def _release_entry(self, wa_id):
+        entry = self._locks.get(wa_id)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._locks[wa_id]
+            CONVERSATION_LOCKS_LIVE.set(len(self._locks))
+
+
+class _ConversationLock:
+    """Async context manager handed out by ConversationLockRegistry.lock()."""
+
+    def __init__(self, registry, wa_id):
+        self._registry = registry
+        self._wa_id = wa_id
+
+    async def __aenter__(self):
+        lock = self._registry._acquire_entry(self._wa_id)
+        started = time.perf_counter()
+        CONVERSATION_LOCK_WAITERS.inc()
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._registry._release_entry(self._wa_id)
+            raise
+        finally:
+            CONVERSATION_LOCK_WAITERS.dec()
+            CONVERSATION_LOCK_WAIT_SECONDS.observe(time.perf_counter() - started)
+        self._lock = lock
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._lock.release()
+        self._registry._release_entry(self._wa_id)
+        return False
+
+
+class ConversationContextCache:
+    """LRU of the recent conversation rows used as LLM context, keyed by wa_id.
+
+    Each entry keeps the newest ``limit`` rows (ordered by date and time, like the history query) and
+    the highest conversation id seen. Writers in this process extend entries in place, so building the
+    next prompt skips the history query but still runs one indexed query for rows with id >= ``last_id``:
+    other processes (the API writing secretary messages, other inbound workers) append to the same
+    conversations, and a process cannot tell whether it wrote the newest row. In steady state that
+    query returns only the cached last row.
+    """
+
+    def __init__(self, max_conversations):
+        self._entries = OrderedDict()  # wa_id -> _ContextEntry
+        self._max_conversations = max_conversations
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def enabled(self):
+        return self._max_conversations > 0
+
+    def get(self, wa_id, limit):
+        """Return (last_id, rows) for wa_id, or None when nothing usable is cached."""
+        with self._lock:
+            entry = self._entries.get(wa_id)
+            if entry is None or entry.limit != limit:
+                return None
+            self._entries.move_to_end(wa_id)
+            return entry.last_id, list(entry.rows)
+
+    def store(self, wa_id, limit, rows):
+        """Replace the entry for wa_id with freshly loaded (id, role, message, date, time) rows."""
+        if not self.enabled or not rows:
+            return
+        with self._lock:
+            entry = _ContextEntry(limit)
+            entry.extend(rows)
+            self._entries[wa_id] = entry
+            self._entries.move_to_end(wa_id)
+            while len(self._entries) > self._max_conversations:
+                self._entries.popitem(last=False)
+
+    def extend(self, wa_id, rows):
+        """Add rows just written for wa_id; no-op unless the conversation is cached."""
+        with self._lock:
+            entry = self._entries.get(wa_id)
+            if entry is not None:
+                entry.extend(rows)
+
+    def invalidate(self, *wa_ids):
+        with self._lock:
+            for wa_id in wa_ids:
+                self._entries.pop(wa_id, None)
+
+
+class _ContextEntry:
+    __slots__ = ("last_id", "limit", "rows")
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.last_id = 0
+        self.rows = []  # (date, time, id, role, message), oldest first
+
+    def extend(self, rows):
+        for row_id, role, message, date_str, time_str in rows:
+            self.rows.append((str(date_str or ""), str(time_str or ""), row_id, role, message))
+            self.last_id = max(self.last_id, row_id)
+        self.rows.sort(key=lambda row: (row[0], row[1]))
+        if self.limit > 0 and len(self.rows) > self.limit:
+            del self.rows[: len(self.rows) - self.limit]
+
+
+try:
+    LLM_CONTEXT_CACHE_MAX_CONVERSATIONS = int(os.environ.get("LLM_CONTEXT_CACHE_MAX_CONVERSATIONS", "1000"))
+except ValueError:
+    LLM_CONTEXT_CACHE_MAX_CONVERSATIONS = 1000
+
+# Global registry of asyncio locks per user (wa_id)
+global_locks = ConversationLockRegistry()
+context_cache = ConversationContextCache(LLM_CONTEXT_CACHE_MAX_CONVERSATIONS)
 SYSTEM_AGENT_WA_ID = str(config.get("SYSTEM_AGENT_WA_ID", "12125550123"))
 SYSTEM_AGENT_DISPLAY_NAME = config.get("SYSTEM_AGENT_NAME") or "Calendar AI Assistant"
 
@@ -115,7 +276,14 @@ def clear_conversation_messages(wa_id: str) -> dict[str, object]:
                 .filter(ConversationModel.wa_id == wa_id)
                 .delete(synchronize_session=False)
             )
+            session.query(ConversationSummaryModel).filter(ConversationSummaryModel.wa_id == wa_id).delete(
+                synchronize_session=False
+            )
+            session.query(ResponseChainModel).filter(ResponseChainModel.wa_id == wa_id).delete(
+                synchronize_session=False
+            )
             session.commit()
+        context_cache.invalidate(wa_id)
         return format_response(True, data={"deleted": int(deleted)})
     except Exception as exc:
         logging.error("Failed to clear conversation for %s: %s", wa_id, exc, exc_info=True)
@@ -668,28 +836,67 @@ def append_message(wa_id, role, message, date_str, time_str):
                 default_name = SYSTEM_AGENT_DISPLAY_NAME if wa_id == SYSTEM_AGENT_WA_ID else None
                 session.add(CustomerModel(wa_id=wa_id, customer_name=default_name))
                 session.flush()
-            session.add(
-                ConversationModel(
-                    wa_id=wa_id,
-                    role=role,
-                    message=message,
-                    date=date_str,
-                    time=time_str,
-                )
+            row = ConversationModel(
+                wa_id=wa_id,
+                role=role,
+                message=message,
+                date=date_str,
+                time=time_str,
             )
+            session.add(row)
+            session.flush()
+            row_id = row.id
             session.commit()
+        context_cache.extend(wa_id, [(row_id, role, message, date_str, time_str)])
     except Exception as e:
         logging.error(f"Error appending message to database: {e}")
 
 
+def append_messages(wa_id, messages):
+    """
+    Append several messages for one WhatsApp user in a single transaction.
+
+    Same semantics as append_message, but the customer check, the inserts and the commit happen once
+    for the whole batch. Rows are inserted in the given order.
+
+    Args:
+        wa_id (str): WhatsApp user identifier.
+        messages (list[tuple[str, str, str, str]]): (role, message, date_str, time_str) tuples.
+
+    Returns:
+        None
+    """
+    if not messages:
+        return
+    try:
+        with get_session() as session:
+            existing = session.get(CustomerModel, wa_id)
+            if existing is None:
+                default_name = SYSTEM_AGENT_DISPLAY_NAME if wa_id == SYSTEM_AGENT_WA_ID else None
+                session.add(CustomerModel(wa_id=wa_id, customer_name=default_name))
+                session.flush()
+            rows = [
+                ConversationModel(wa_id=wa_id, role=role, message=message, date=date_str, time=time_str)
+                for role, message, date_str, time_str in messages
+            ]
+            session.add_all(rows)
+            session.flush()
+            row_ids = [row.id for row in rows]
+            session.commit()
+        context_cache.extend(
+            wa_id,
+            [(row_id, *message) for row_id, message in zip(row_ids, messages, strict=True)],
+        )
+    except Exception as e:
+        logging.error(f"Error appending {len(messages)} messages to database: {e}")
+
+
 def get_lock(wa_id):
     """
-    Retrieve or create an asyncio.Lock for the given WhatsApp ID.
-    Also record a flag in the sqlite database under the key "locks" for tracking.
+    Return an async context manager that serializes work for the given WhatsApp ID.
+    The underlying lock is evicted once it is released and has no waiters.
     """
-    if wa_id not in global_locks:
-        global_locks[wa_id] = asyncio.Lock()
-    return global_locks[wa_id]
+    return global_locks.lock(wa_id)
 
 
 def is_valid_number(phone_number, ar=False):
@@ -724,46 +931,108 @@ def retrieve_messages(wa_id):
     """
     Retrieve message history for a user from the database and format for service consumption.
     """
+    return [{"role": role, "content": content} for _id, role, content in retrieve_context_rows(wa_id)]
+
+
+def context_messages_limit():
+    """Maximum number of stored messages considered as LLM context (0 means no limit)."""
     try:
-        # Ensure a thread record exists
-        make_thread(wa_id)
-        # Use centralized conversation retrieval, but limit history for performance
-        try:
-            conv_limit = int(config.get("LLM_CONTEXT_MESSAGES_LIMIT", 30))
-        except Exception:
-            conv_limit = 30
-        response = get_all_conversations(wa_id=wa_id, limit=conv_limit if conv_limit > 0 else 0)
-        if not response.get("success", False):
-            return []
-        data = response.get("data", {})
-        normalized_wa_id = str(wa_id)
-        # Extract messages list for this user
-        messages = data.get(wa_id) or data.get(normalized_wa_id, [])
-        # Ensure chronological order (ascending) when a limited, descending list is returned
-        try:
-            messages = sorted(messages, key=lambda m: (str(m.get("date", "")), str(m.get("time", ""))))
-        except Exception:
-            pass
-        input_chat = []
-        for msg in messages:
-            try:
-                role = str(msg.get("role") or "")
-            except Exception:
-                role = ""
-            normalized_role = role.strip().lower()
-            # Skip tool-call records from LLM prompt context
-            if normalized_role == "tool":
-                continue
-            llm_role = "assistant" if normalized_role != "user" else "user"
-            if normalized_wa_id == SYSTEM_AGENT_WA_ID and normalized_role in {"secretary", "admin"}:
-                llm_role = "user"
-            input_chat.append({"role": llm_role, "content": msg["message"]})
-        return input_chat
+        return max(int(config.get("LLM_CONTEXT_MESSAGES_LIMIT", 30)), 0)
+    except Exception:
+        return 30
+
+
+def retrieve_context_rows(wa_id):
+    """
+    Return the recent LLM context of a user as (conversation id, llm role, content), oldest first.
+
+    Recent history is served from the per-process context cache; only rows written since the cached
+    ones are read, and a cold or stale entry is reloaded with the history query.
+    """
+    try:
+        conv_limit = context_messages_limit()
+        rows = _cached_context_rows(wa_id, conv_limit)
+        if rows is None:
+            # Ensure a thread record exists
+            make_thread(wa_id)
+            rows = _load_context_rows(wa_id, conv_limit)
+        return _format_llm_messages(wa_id, rows)
     except Exception as e:
         logging.error(f"Error retrieving messages from database: {e}")
         return []
 
 
+def _cached_context_rows(wa_id, conv_limit):
+    """Return cached (id, role, message) rows brought up to date, or None if the history must be reloaded."""
+    if not context_cache.enabled:
+        return None
+    cached = context_cache.get(wa_id, conv_limit)
+    if cached is None:
+        LLM_CONTEXT_CACHE_LOOKUPS.labels(result="miss").inc()
+        return None
+    last_id, _rows = cached
+    # The last cached row must still belong to wa_id; anything after it was written by another process
+    with get_session() as session:
+        newer = session.execute(
+            select(
+                ConversationModel.id,
+                ConversationModel.role,
+                ConversationModel.message,
+                ConversationModel.date,
+                ConversationModel.time,
+            )
+            .where(ConversationModel.wa_id == wa_id, ConversationModel.id >= last_id)
+            .order_by(ConversationModel.id.asc())
+        ).all()
+    if not newer or newer[0].id != last_id:
+        LLM_CONTEXT_CACHE_LOOKUPS.labels(result="stale").inc()
+        context_cache.invalidate(wa_id)
+        return None
+    if len(newer) > 1:
+        LLM_CONTEXT_CACHE_LOOKUPS.labels(result="delta").inc()
+        context_cache.extend(wa_id, [tuple(row) for row in newer[1:]])
+        cached = context_cache.get(wa_id, conv_limit)
+        if cached is None:
+            return None
+    else:
+        LLM_CONTEXT_CACHE_LOOKUPS.labels(result="hit").inc()
+    return [(row_id, role, message) for _date, _time, row_id, role, message in cached[1]]
+
+
+def _load_context_rows(wa_id, conv_limit):
+    """Read the newest conv_limit messages (all when 0), cache them and return them oldest first."""
+    with get_session() as session:
+        stmt = select(
+            ConversationModel.id,
+            ConversationModel.role,
+            ConversationModel.message,
+            ConversationModel.date,
+            ConversationModel.time,
+        ).where(ConversationModel.wa_id == wa_id)
+        if conv_limit > 0:
+            stmt = stmt.order_by(ConversationModel.date.desc(), ConversationModel.time.desc()).limit(conv_limit)
+        rows = [tuple(row) for row in session.execute(stmt).all()]
+    context_cache.store(wa_id, conv_limit, rows)
+    # Ensure chronological order (ascending)
+    rows.sort(key=lambda row: (str(row[3] or ""), str(row[4] or "")))
+    return [(row_id, role, message) for row_id, role, message, _date, _time in rows]
+
+
+def _format_llm_messages(wa_id, rows):
+    normalized_wa_id = str(wa_id)
+    input_chat = []
+    for row_id, role, message in rows:
+        normalized_role = str(role or "").strip().lower()
+        # Skip tool-call records from LLM prompt context
+        if normalized_role == "tool":
+            continue
+        llm_role = "assistant" if normalized_role != "user" else "user"
+        if normalized_wa_id == SYSTEM_AGENT_WA_ID and normalized_role in {"secretary", "admin"}:
+            llm_role = "user"
+        input_chat.append((row_id, llm_role, message))
+    return input_chat
+
+
 def make_thread(wa_id, customer_name=None):
     """
     Ensures that a customer record exists for the given WhatsApp ID (wa_id).
@@ -1603,6 +1872,11 @@ def delete_user(wa_id):
     with get_session() as session:
         session.query(ReservationModel).filter(ReservationModel.wa_id == wa_id).delete(synchronize_session=False)
         session.query(ConversationModel).filter(ConversationModel.wa_id == wa_id).delete(synchronize_session=False)
+        session.query(ConversationSummaryModel).filter(ConversationSummaryModel.wa_id == wa_id).delete(
+            synchronize_session=False
+        )
+        session.query(ResponseChainModel).filter(ResponseChainModel.wa_id == wa_id).delete(synchronize_session=False)
         session.query(CustomerModel).filter(CustomerModel.wa_id == wa_id).delete(synchronize_session=False)
         session.commit()
+    context_cache.invalidate(wa_id)
     return format_response(True, message=get_message("user_deleted"))
@@ -4,15 +4,19 @@ import inspect
 import json
 import logging
 import re
-from collections import deque
+import time
 
 import httpx
 
 from app.config import config
+from app.decorators import RetryLaterError, ToolCallsRanError
 from app.metrics import WHATSAPP_MESSAGE_FAILURES, WHATSAPP_MESSAGE_FAILURES_BY_REASON
+from app.utils.answer_cache import answer_key, cached_answer, store_answer
+from app.utils.dedupe import claim_message_id
 from app.utils.http_client import ensure_client_healthy
 from app.utils.realtime import enqueue_broadcast
-from app.utils.service_utils import append_message, get_all_conversations, get_lock, parse_unix_timestamp
+from app.utils.reply_stream import ReplyStream, activate_reply_stream, active_reply_stream
+from app.utils.service_utils import append_message, get_lock, parse_unix_timestamp
 
 from .logging_utils import log_http_response
 
@@ -20,9 +24,10 @@ from .logging_utils import log_http_response
 WHATSAPP_TEXT_MAX_CHARS = 4096
 TYPING_KEEPALIVE_INTERVAL_SECONDS = 15
 
-# In-memory LRU of recently processed WhatsApp message IDs to avoid duplicate processing
-_recent_message_ids_queue: deque[str] = deque(maxlen=1000)
-_recent_message_ids_set = set()
+
+class ReplyFailedError(Exception):
+    """The LLM reply failed after the customer's messages were stored: a retry only owes the reply."""
+
 
 # Map wa_id -> last inbound WhatsApp message id (from webhook)
 _last_inbound_message_id_by_wa: dict[str, str] = {}
@@ -408,16 +413,50 @@ async def mark_message_as_read(message_id: str):
         return {"status": "error", "message": "Failed to mark as read"}, 500
 
 
-async def process_whatsapp_message(body, run_llm_function):
+def _preceding_text_messages(preceding_bodies, deduplicated=False):
+    """Extract (text, timestamp) pairs from earlier webhook payloads, skipping duplicate deliveries."""
+    preceding = []
+    for preceding_body in preceding_bodies or []:
+        try:
+            message = preceding_body["entry"][0]["changes"][0]["value"]["messages"][0]
+            text = message["text"]["body"]
+        except (KeyError, IndexError, TypeError):
+            continue
+        message_id = message.get("id")
+        if message_id and not deduplicated and not claim_message_id(message_id):
+            continue
+        if text:
+            preceding.append((text, message.get("timestamp")))
+    return preceding
+
+
+async def process_whatsapp_message(
+    body, run_llm_function, preceding_bodies=None, deduplicated=False, raise_errors=False
+):
     """
     Processes an incoming WhatsApp message and generates a response using the provided LLM function.
 
     Args:
         body (dict): The incoming message payload from WhatsApp webhook.
         run_llm_function (callable): The function to use for generating responses.
+        preceding_bodies (list[dict], optional): Earlier text payloads from the same customer that
+            were coalesced into this turn. They are stored before ``body`` and answered together with it.
+        deduplicated (bool, optional): True when the caller already guarantees each message id is handled
+            once (the inbound queue enforces it with its unique message_id index).
+        raise_errors (bool, optional): Raise processing errors instead of only logging them, so the caller
+            (the inbound queue) can retry and eventually dead-letter the message.
 
     Returns:
         None
+
+    Raises:
+        RetryLaterError: When the LLM stayed unavailable past its retry budget. The customer's messages
+            are stored by then; only the reply is still owed (see ``reply_to_conversation``).
+        ReplyFailedError: With ``raise_errors``, when the reply failed or came back empty after the
+            customer's messages were stored.
+        ToolCallsRanError: With ``raise_errors``, when the reply failed after its turn ran tools; it must
+            not be answered again.
+        Exception: With ``raise_errors``, any error raised before the messages were stored.
     """
     try:
         wa_id = body["entry"][0]["changes"][0]["value"]["contacts"][0]["wa_id"]
@@ -425,16 +464,9 @@ async def process_whatsapp_message(body, run_llm_function):
         message_id = message.get("id")
 
         # Idempotency: skip already processed message IDs (Meta may deliver duplicates)
-        if message_id:
-            if message_id in _recent_message_ids_set:
-                logging.warning(f"Duplicate delivery detected for message_id={message_id}. Skipping.")
-                return
-            _recent_message_ids_queue.append(message_id)
-            _recent_message_ids_set.add(message_id)
-            # Trim set to queue size if needed
-            while len(_recent_message_ids_set) > _recent_message_ids_queue.maxlen:
-                evicted = _recent_message_ids_queue.popleft()
-                _recent_message_ids_set.discard(evicted)
+        if message_id and not deduplicated and not claim_message_id(message_id):
+            logging.warning(f"Duplicate delivery detected for message_id={message_id}. Skipping.")
+            return
         # Track last inbound message id per wa_id for secretary typing indicators
         with contextlib.suppress(Exception):
             _set_last_inbound_message_id(wa_id, message_id)
@@ -464,63 +496,129 @@ async def process_whatsapp_message(body, run_llm_function):
             if run_llm_function is None:
                 logging.error("No LLM function provided for processing message")
                 return
-            typing_keepalive_stop: asyncio.Event | None = None
-            typing_keepalive_task: asyncio.Task | None = None
-            lock = get_lock(wa_id)
-            async with lock:
-                # Display typing indicator while we prepare the response
-                try:
-                    with contextlib.suppress(Exception):
-                        enqueue_broadcast(
-                            "conversation_typing",
-                            {"wa_id": wa_id, "state": "start"},
-                            affected_entities=[wa_id],
-                            source="assistant",  # Typing indicator is always backend/LLM-initiated
-                        )
-                    if message_id:
-                        typing_keepalive_stop = asyncio.Event()
-                        typing_keepalive_task = asyncio.create_task(
-                            _typing_indicator_keepalive(message_id, typing_keepalive_stop)
-                        )
-                    else:
-                        with contextlib.suppress(Exception):
-                            await send_typing_indicator_for_wa(wa_id)
-                except Exception:
-                    pass
+            await _respond(
+                wa_id,
+                message_id,
+                lambda: generate_response(
+                    message_body,
+                    wa_id,
+                    timestamp,
+                    run_llm_function,
+                    preceding=_preceding_text_messages(preceding_bodies, deduplicated),
+                    raise_errors=raise_errors,
+                ),
+            )
 
-                try:
-                    response_text = await generate_response(message_body, wa_id, timestamp, run_llm_function)
-                finally:
-                    if typing_keepalive_stop:
-                        typing_keepalive_stop.set()
-                    if typing_keepalive_task:
-                        with contextlib.suppress(Exception):
-                            await typing_keepalive_task
-
-            # Only send a response if we got one back from the LLM
-            if response_text:
-                response_text = process_text_for_whatsapp(response_text)
-                try:
-                    result = await send_whatsapp_message(wa_id, response_text)
-                    # Log non-2xx responses and continue gracefully
-                    if isinstance(result, tuple):
-                        logging.warning(f"WhatsApp send returned error: {result}")
-                    else:
-                        logging.info(f"WhatsApp message sent successfully to {wa_id}")
-                except Exception as e:
-                    # Don't let WhatsApp sending failures trigger LLM retries
-                    logging.error(f"Exception while sending WhatsApp message to {wa_id}: {e}", exc_info=True)
-            # Regardless of success, clear typing state for UI
+    except RetryLaterError:
+        # The caller (inbound queue) reschedules the reply; the customer's messages are already stored
+        raise
+    except Exception as e:
+        if raise_errors:
+            raise
+        logging.error(f"Error processing WhatsApp message: {e}", exc_info=True)
+
+
+async def reply_to_conversation(wa_id, run_llm_function):
+    """
+    Answer the conversation as stored, without a new inbound message (a reply deferred by RetryLaterError,
+    or one whose earlier attempt failed with ReplyFailedError).
+
+    Raises:
+        RetryLaterError: When the LLM is still unavailable and the reply should be rescheduled again.
+        ReplyFailedError: When the reply failed or came back empty.
+        ToolCallsRanError: When the reply failed after its turn ran tools.
+    """
+    await _respond(
+        wa_id,
+        get_last_inbound_message_id(wa_id),
+        lambda: _run_llm_reply(wa_id, run_llm_function, raise_errors=True),
+    )
+
+
+async def _respond(wa_id, message_id, produce_reply):
+    """Produce a reply under the conversation lock with typing indicators shown, then send it."""
+    typing_keepalive_stop: asyncio.Event | None = None
+    typing_keepalive_task: asyncio.Task | None = None
+    error: Exception | None = None
+    response_text = None
+    lock = get_lock(wa_id)
+    async with lock:
+        # Display typing indicator while we prepare the response
+        try:
             with contextlib.suppress(Exception):
                 enqueue_broadcast(
                     "conversation_typing",
-                    {"wa_id": wa_id, "state": "stop"},
+                    {"wa_id": wa_id, "state": "start"},
                     affected_entities=[wa_id],
                     source="assistant",  # Typing indicator is always backend/LLM-initiated
                 )
+            if message_id:
+                typing_keepalive_stop = asyncio.Event()
+                typing_keepalive_task = asyncio.create_task(
+                    _typing_indicator_keepalive(message_id, typing_keepalive_stop)
+                )
+            else:
+                with contextlib.suppress(Exception):
+                    await send_typing_indicator_for_wa(wa_id)
+        except Exception:
+            pass
 
-    except Exception as e:
-        logging.error(f"Error processing WhatsApp message: {e}", exc_info=True)
+        reply_stream = _whatsapp_reply_stream(wa_id)
+        try:
+            with activate_reply_stream(reply_stream):
+                response_text = await produce_reply()
+        except Exception as e:
+            # Give the lock and the typing indicator back (instead of waiting out the provider) before raising
+            error = e
+        finally:
+            if typing_keepalive_stop:
+                typing_keepalive_stop.set()
+            if typing_keepalive_task:
+                with contextlib.suppress(Exception):
+                    await typing_keepalive_task
+
+    # Only send a response if we got one back from the LLM and it was not streamed already
+    if response_text and not reply_stream.delivered:
+        response_text = process_text_for_whatsapp(response_text)
+        try:
+            result = await send_whatsapp_message(wa_id, response_text)
+            # Log non-2xx responses and continue gracefully
+            if isinstance(result, tuple):
+                logging.warning(f"WhatsApp send returned error: {result}")
+            else:
+                logging.info(f"WhatsApp message sent successfully to {wa_id}")
+        except Exception as e:
+            # Don't let WhatsApp sending failures trigger LLM retries
+            logging.error(f"Exception while sending WhatsApp message to {wa_id}: {e}", exc_info=True)
+    # Regardless of success, clear typing state for UI
+    with contextlib.suppress(Exception):
+        enqueue_broadcast(
+            "conversation_typing",
+            {"wa_id": wa_id, "state": "stop"},
+            affected_entities=[wa_id],
+            source="assistant",  # Typing indicator is always backend/LLM-initiated
+        )
+    if error is not None:
+        raise error
+
+
+def _whatsapp_reply_stream(wa_id):
+    """Reply stream that sends completed paragraphs to the customer and live text to the dashboard."""
+
+    async def send(chunk):
+        result = await send_whatsapp_message(wa_id, process_text_for_whatsapp(chunk))
+        if isinstance(result, tuple):
+            logging.warning(f"WhatsApp streamed send returned error: {result}")
+
+    def broadcast(delta):
+        enqueue_broadcast(
+            "conversation_stream",
+            {"wa_id": wa_id, "delta": delta},
+            affected_entities=[wa_id],
+            source="assistant",
+        )
+
+    return ReplyStream(send, broadcast, max_chars=WHATSAPP_TEXT_MAX_CHARS)
 
 
 async def test_whatsapp_api_config():
@@ -623,7 +721,7 @@ def is_valid_whatsapp_message(body):
     )
 
 
-async def generate_response(message_body, wa_id, timestamp, run_llm_function):
+async def generate_response(message_body, wa_id, timestamp, run_llm_function, preceding=None, raise_errors=False):
     """
     Generate a response from Claude and update the conversation.
 
@@ -632,29 +730,47 @@ async def generate_response(message_body, wa_id, timestamp, run_llm_function):
         wa_id (str): The user's WhatsApp ID.
         timestamp (int): Unix timestamp of the message.
         run_llm_function (callable): Function to generate AI responses.
+        preceding (list[tuple[str, int]], optional): Earlier (text, timestamp) user messages to
+            store before ``message_body`` so a single LLM call answers all of them.
+        raise_errors (bool, optional): Raise ReplyFailedError instead of returning None when no reply
+            was generated.
 
     Returns:
         str or None: The generated response text, or None if no valid response was generated.
     """
     date_str, time_str = parse_unix_timestamp(timestamp)
+    # Only a question that opens the conversation on its own can be answered from the cache
+    cache_key = None if preceding else await asyncio.to_thread(answer_key, wa_id, message_body)
 
-    # Check for messages that might already be processed
-    # Get last 5 messages to check for duplicates
-    response = get_all_conversations(wa_id=wa_id, limit=5)
-    if response.get("success", False):
-        messages = response.get("data", {}).get(wa_id) or response.get("data", {}).get(str(wa_id), [])
-
-        # Check if this message is already in the conversation history
-        for msg in messages:
-            if msg["role"] == "user" and msg["message"] == message_body and msg["time"] == time_str:
-                logging.warning(
-                    f"Duplicate message detected for wa_id={wa_id}: '{message_body}'. Skipping processing."
-                )
-                return None
+    # Save coalesced earlier messages first so the history keeps the customer's order
+    for preceding_body, preceding_timestamp in preceding or []:
+        p_date_str, p_time_str = parse_unix_timestamp(preceding_timestamp or timestamp)
+        append_message(wa_id, "user", preceding_body, date_str=p_date_str, time_str=p_time_str)
 
     # Save the user message BEFORE running LLM
     append_message(wa_id, "user", message_body, date_str=date_str, time_str=time_str)
 
+    cached = cached_answer(cache_key)
+    if cached:
+        reply_date_str, reply_time_str = parse_unix_timestamp(int(time.time()))
+        append_message(wa_id, "assistant", cached, date_str=reply_date_str, time_str=reply_time_str)
+        return cached
+
+    return await _run_llm_reply(
+        wa_id,
+        run_llm_function,
+        on_reply=(lambda reply: asyncio.to_thread(store_answer, cache_key, wa_id, reply)) if cache_key else None,
+        raise_errors=raise_errors,
+    )
+
+
+async def _run_llm_reply(wa_id, run_llm_function, on_reply=None, raise_errors=False):
+    """Run the LLM over the stored conversation and store its reply; returns the reply text or None.
+
+    ``on_reply`` is awaited with a complete reply only; a reply that failed after part of it was streamed is
+    stored as the customer received it and not generated again. With ``raise_errors`` a failed or empty
+    reply raises ReplyFailedError (ToolCallsRanError once the turn ran tools) instead of returning None.
+    """
     # Call LLM function: async -> get coroutine, sync -> run in thread
     try:
         if inspect.iscoroutinefunction(run_llm_function):
@@ -663,14 +779,40 @@ async def generate_response(message_body, wa_id, timestamp, run_llm_function):
             call = asyncio.to_thread(run_llm_function, wa_id)
         new_message, assistant_date_str, assistant_time_str = await call
 
+        # A streaming runner already sent the reply; store exactly what the customer received
+        reply_stream = active_reply_stream()
+        if reply_stream is not None and await reply_stream.close():
+            new_message = reply_stream.text
+
         if new_message:
             append_message(
                 wa_id, "assistant", new_message, date_str=assistant_date_str, time_str=assistant_time_str
             )
+            if on_reply is not None:
+                with contextlib.suppress(Exception):
+                    await on_reply(new_message)
             return new_message
         else:
             logging.warning(f"Empty or None response received from LLM for wa_id={wa_id}")
+            if raise_errors:
+                raise ReplyFailedError("Empty or None response received from LLM")
             return None
     except Exception as e:
+        reply_stream = active_reply_stream()
+        if reply_stream is not None and reply_stream.delivered:
+            # Part of the reply already reached the customer: finish with it rather than answer again
+            logging.warning(f"LLM reply for wa_id={wa_id} failed after it was partly sent, keeping that part: {e}")
+            reply_stream.restart()
+            await reply_stream.close()
+            date_str, time_str = parse_unix_timestamp(int(time.time()))
+            append_message(wa_id, "assistant", reply_stream.text, date_str=date_str, time_str=time_str)
+            return reply_stream.text
+        if isinstance(e, (RetryLaterError, ReplyFailedError)):
+            raise
         logging.error(f"Error generating response: {e}")
+        if raise_errors:
+            if isinstance(e, ToolCallsRanError):
+                # Not a ReplyFailedError: answering the turn again would repeat its bookings
+                raise
+            raise ReplyFailedError(f"{type(e).__name__}: {e}") from e
         return None
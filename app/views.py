@@ -7,6 +7,7 @@ import json
 import logging
 from zoneinfo import ZoneInfo
 
+import orjson
 from fastapi import (APIRouter, BackgroundTasks, Body, Depends, HTTPException,
                      Query, Request)
 from fastapi.responses import JSONResponse, RedirectResponse
@@ -27,8 +28,16 @@ from app.services.assistant_functions import (cancel_reservation, modify_id,
                                               undo_cancel_reservation)
 from app.services.domain.customer.customer_service import CustomerService
 from app.services.domain.dashboard import DashboardAnalyticsService
+from app.services.inbound_queue import (INBOUND_QUEUE_ENABLED,
+                                        enqueue_inbound,
+                                        extract_message_identity,
+                                        list_dead_letters,
+                                        purge_dead_letters,
+                                        replay_dead_letters)
 from app.services.llm_service import get_llm_service
+from app.services.rate_governor import PRIORITY_SYSTEM_AGENT, llm_priority
 from app.services.system_tool_schemas import SYSTEM_TOOL_REGISTRY
+from app.utils.answer_cache import invalidate_answers
 from app.utils.realtime import (NOTIFICATION_HISTORY_LIMIT, broadcast,
                                 enqueue_broadcast)
 from app.utils.service_utils import (append_message,
@@ -114,14 +123,32 @@ async def _process_and_release(body, run_llm_function):
         task_semaphore.release()
 
 
+WEBHOOK_LOG_PREVIEW_CHARS = 300
+
+
+def _webhook_summary(body, raw_body: bytes) -> str:
+    """Short description of a webhook payload for logs (the full body can be large and contain PII)."""
+    try:
+        value = body["entry"][0]["changes"][0]["value"]
+        messages = value.get("messages") or []
+        statuses = value.get("statuses") or []
+        kinds = ",".join(str(m.get("type", "?")) for m in messages[:5])
+        return f"{len(raw_body)} bytes, messages={len(messages)} [{kinds}], statuses={len(statuses)}"
+    except Exception:
+        return f"{len(raw_body)} bytes: {raw_body[:WEBHOOK_LOG_PREVIEW_CHARS]!r}"
+
+
 @router.post("/webhook")
-async def webhook_post(request: Request, background_tasks: BackgroundTasks, _=Depends(verify_signature)):
+async def webhook_post(background_tasks: BackgroundTasks, raw_body: bytes = Depends(verify_signature)):
     """
     Process incoming webhook events from WhatsApp API.
     """
     try:
-        body = await request.json()
-        logging.info(f"Request body: {body}")
+        # verify_signature already read and authenticated the raw bytes; parse them once
+        body = orjson.loads(raw_body)
+        if not isinstance(body, dict):
+            raise ValueError("webhook payload is not a JSON object")
+        logging.info(f"Webhook received: {_webhook_summary(body, raw_body)}")
     except Exception:
         logging.error("Failed to decode JSON")
         INVALID_HTTP_REQUESTS.inc()
@@ -173,6 +200,20 @@ async def webhook_post(request: Request, background_tasks: BackgroundTasks, _=De
                 return JSONResponse(content={"status": "ok", "ignored": True})
         except Exception:
             pass
+
+        if INBOUND_QUEUE_ENABLED:
+            # Durable path: persist and ack; inbound queue workers do all processing
+            message_id, wa_id = extract_message_identity(body)
+            try:
+                created, _ = await asyncio.to_thread(
+                    enqueue_inbound, body, message_id, wa_id, raw_body.decode("utf-8", errors="replace")
+                )
+            except Exception as e:
+                logging.error(f"Failed to enqueue inbound message {message_id}: {e}")
+                # Non-2xx makes Meta redeliver instead of silently losing the message
+                raise HTTPException(status_code=503, detail="Failed to enqueue message")
+            return JSONResponse(content={"status": "ok", "queued": created})
+
         # Try to acquire semaphore without blocking the response
         if task_semaphore.locked() and task_semaphore._value == 0:
             # Log current semaphore status
@@ -202,7 +243,7 @@ async def webhook_post(request: Request, background_tasks: BackgroundTasks, _=De
 
         return JSONResponse(content={"status": "ok"})
     else:
-        logging.warning(f"Unknown webhook payload structure: {body}")
+        logging.warning(f"Unknown webhook payload structure: {_webhook_summary(body, raw_body)}")
         INVALID_HTTP_REQUESTS.inc()
         with contextlib.suppress(Exception):
             INVALID_HTTP_REQUESTS_BY_REASON.labels(
@@ -273,7 +314,9 @@ async def api_send_whatsapp_message(background_tasks: BackgroundTasks, payload:
         async def process_system_agent_response():
             try:
                 llm_service = get_llm_service(toolkit=SYSTEM_TOOL_REGISTRY, system_prompt=SYSTEM_AGENT_PROMPT)
-                response_text, response_date, response_time = llm_service.run(wa_id)
+                # Operator requests yield the provider quota to customer replies
+                with llm_priority(PRIORITY_SYSTEM_AGENT):
+                    response_text, response_date, response_time = await llm_service.run(wa_id)
 
                 if response_text:
                     append_message(wa_id, "assistant", response_text, response_date, response_time)
@@ -1049,6 +1092,7 @@ async def api_update_vacation_periods(payload: dict = Body(...)):
             for s_date, e_date, title in normalized:
                 session.add(VacationPeriodModel(start_date=s_date, end_date=e_date, title=title))
             session.commit()
+        invalidate_answers("vacations")
 
         # Broadcast updated vacations
         with contextlib.suppress(Exception):
@@ -1120,6 +1164,7 @@ async def api_undo_vacation_update(payload: dict = Body(...)):
             for s_date, e_date, title in normalized:
                 session.add(VacationPeriodModel(start_date=s_date, end_date=e_date, title=title))
             session.commit()
+        invalidate_answers("vacations")
 
         with contextlib.suppress(Exception):
             enqueue_broadcast(
@@ -1175,3 +1220,38 @@ async def api_get_notifications(limit: int = NOTIFICATION_HISTORY_LIMIT):
     except Exception as e:
         logging.error(f"Error loading notifications: {e}")
         return JSONResponse(content={"success": False, "message": "failed_to_load"}, status_code=500)
+
+
+def _dead_letter_ids(payload: dict):
+    """Return the requested item ids, or None to target every dead-lettered item."""
+    ids = payload.get("ids")
+    if ids is None:
+        return None
+    if not isinstance(ids, list):
+        raise HTTPException(status_code=400, detail="ids must be a list")
+    try:
+        return [int(i) for i in ids]
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="ids must be integers")
+
+
+@router.get("/inbound-queue/dead-letters")
+async def api_list_dead_letters(limit: int = 100, _=Depends(check_auth)):
+    """List inbound messages that exhausted their processing attempts."""
+    limit = max(1, min(int(limit), 1000))
+    items = await asyncio.to_thread(list_dead_letters, limit)
+    return JSONResponse(content={"success": True, "data": items})
+
+
+@router.post("/inbound-queue/dead-letters/replay")
+async def api_replay_dead_letters(payload: dict = Body(default={}), _=Depends(check_auth)):
+    """Requeue dead-lettered messages ({"ids": [...]}, or all when ids is omitted)."""
+    replayed = await asyncio.to_thread(replay_dead_letters, _dead_letter_ids(payload))
+    return JSONResponse(content={"success": True, "replayed": replayed})
+
+
+@router.post("/inbound-queue/dead-letters/purge")
+async def api_purge_dead_letters(payload: dict = Body(default={}), _=Depends(check_auth)):
+    """Delete dead-lettered messages ({"ids": [...]}, or all when ids is omitted)."""
+    purged = await asyncio.to_thread(purge_dead_letters, _dead_letter_ids(payload))
+    return JSONResponse(content={"success": True, "purged": purged})
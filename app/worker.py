@@ -0,0 +1,107 @@
+"""Standalone inbound queue workers, so the LLM tier can scale apart from the API tier.
+
+Usage:
+    python -m app.worker --processes 4 --workers 2
+
+Each process runs its own event loop with ``--workers`` queue workers. Run the API with
+INBOUND_QUEUE_IN_PROCESS_WORKERS=false so only these processes consume the queue. Realtime events
+raised while processing are relayed to the API processes through Postgres NOTIFY.
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+
+from app.config import configure_logging, load_config
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+
+async def _serve(num_workers: int) -> None:
+    from app.services.inbound_queue import spawn_workers, stop_workers
+    from app.utils.http_client import async_client, async_llm_client, sync_client
+    from app.utils.realtime import enable_broadcast_relay
+
+    enable_broadcast_relay()
+    shutdown = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, shutdown.set)
+
+    stop_event, tasks = spawn_workers(num_workers)
+    logging.info(f"inbound worker process {os.getpid()} started with {num_workers} workers")
+    await shutdown.wait()
+    logging.info(f"inbound worker process {os.getpid()} stopping")
+    await stop_workers(stop_event, tasks)
+    await async_client.aclose()
+    await async_llm_client.aclose()
+    sync_client.close()
+
+
+def run_worker_process(num_workers: int, metrics_port: int | None = None) -> None:
+    """Entry point of a single worker process."""
+    configure_logging()
+    load_config()
+    if metrics_port:
+        # Each process has its own registry; expose it for Prometheus to scrape
+        from prometheus_client import start_http_server
+
+        start_http_server(metrics_port)
+    try:
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    asyncio.run(_serve(max(1, num_workers)))
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Run inbound message queue workers outside the API process.")
+    parser.add_argument("--processes", type=int, default=_env_int("INBOUND_WORKER_PROCESSES", 1))
+    parser.add_argument("--workers", type=int, default=_env_int("INBOUND_QUEUE_WORKERS", 2), help="per process")
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=_env_int("INBOUND_WORKER_METRICS_PORT", 0),
+        help="first Prometheus port; process i listens on port + i (0 disables)",
+    )
+    args = parser.parse_args(argv)
+
+    if args.processes <= 1:
+        run_worker_process(args.workers, args.metrics_port or None)
+        return
+
+    ctx = multiprocessing.get_context("spawn")
+    processes = [
+        ctx.Process(
+            target=run_worker_process,
+            args=(args.workers, args.metrics_port + i if args.metrics_port else None),
+            name=f"inbound-worker-{i}",
+        )
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    def _forward(signum: int, _frame: object) -> None:
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)  # type: ignore[arg-type]
+
+    signal.signal(signal.SIGTERM, _forward)
+    signal.signal(signal.SIGINT, _forward)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()